@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+'''Measures how quickly automagic_imaging.compression compresses a raw image
+in chunks with each codec and level, with different numbers of processes, and
+how small the result is.
+
+A synthetic raw image (a mix of text, zeros, and random data, roughly like a
+system volume) is generated first, unless an existing raw image is given with
+--image; on OS X, 'hdiutil convert -format UDRO' makes one from any image.
+'''
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Prefer the copy of automagic_imaging in this checkout over an installed one.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import automagic_imaging
+
+def generate(path, size, seed=0):
+    '''Writes a synthetic raw image of 'size' bytes to 'path'.'''
+    rng = random.Random(seed)
+    words = ['System', 'Library', 'Frameworks', 'Resources', 'Contents', 'plist',
+             'English.lproj', 'Info', 'version', 'CFBundleIdentifier', 'com.apple']
+    written = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            kind = rng.random()
+            length = min(rng.randint(4096, 1024 * 1024), size - written)
+            if kind < 0.5:
+                # Text, such as property lists and scripts.
+                text = ' '.join(rng.choice(words) for i in range(length // 8 + 1))
+                block = text[:length]
+            elif kind < 0.7:
+                # Free space.
+                block = '\0' * length
+            else:
+                # Already compressed data, such as images and archives.
+                block = os.urandom(length)
+            f.write(block)
+            written += len(block)
+
+def numbers(value):
+    return [int(x) for x in value.split(',') if x.strip()]
+
+def main():
+    cores = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser(description="Benchmark chunked image compression.")
+    parser.add_argument('-i', '--image',
+                        help="benchmark an existing raw image instead of a synthetic one")
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help="size of the synthetic image in megabytes (default: 256)")
+    parser.add_argument('-f', '--formats',
+                        help="comma-separated formats to try, such as 'zlib-1,lzma-6' (default: "
+                             "every auto-tuning candidate that is available)")
+    parser.add_argument('-p', '--processes', type=numbers, default=sorted(set([1, cores])),
+                        help="comma-separated numbers of processes to try (default: 1," + str(cores) + ")")
+    parser.add_argument('-c', '--chunk-size', type=int,
+                        help="chunk size in kilobytes (default: " +
+                             str(automagic_imaging.compression.chunk_size // 1024) + ")")
+    parser.add_argument('-t', '--tune', action='store_true',
+                        help="also report which format auto-tuning would pick")
+    args = parser.parse_args()
+
+    if args.formats:
+        formats = [automagic_imaging.compression.parse(x) for x in args.formats.split(',')]
+        if None in formats or ('auto', None) in formats:
+            parser.error("Only chunked formats (such as 'zlib-6') can be benchmarked.")
+    else:
+        formats = [x for x in automagic_imaging.compression.candidates
+                   if x[0] in automagic_imaging.compression.available()]
+    chunk_size = args.chunk_size and args.chunk_size * 1024
+
+    directory = tempfile.mkdtemp(prefix='automagic_compression_')
+    path = args.image
+    if not path:
+        path = os.path.join(directory, 'synthetic.raw')
+        start = time.time()
+        generate(path, args.size * 1024 * 1024)
+        print("Generated a " + str(args.size) + " MB image in " + "%.2f" % (time.time() - start) + "s")
+    size = os.path.getsize(path)
+    outfile = os.path.join(directory, 'image' + automagic_imaging.compression.extension)
+
+    try:
+        print("")
+        print("    " + "format".ljust(10) + "processes".rjust(10) + "compress".rjust(10) + "MB/s".rjust(9) +
+              "ratio".rjust(8) + "decompress".rjust(12) + "MB/s".rjust(9))
+        for codec, level in formats:
+            for processes in args.processes:
+                stats = automagic_imaging.compression.compress(path, outfile, codec, level,
+                                                               chunk_size, processes)
+                check = automagic_imaging.compression.verify(outfile, processes)
+                print("    " + (codec + "-" + str(level)).ljust(10) + str(processes).rjust(10) +
+                      ("%.2f" % stats.elapsed + "s").rjust(10) +
+                      ("%.1f" % (stats.throughput() / 1024 / 1024)).rjust(9) +
+                      ("%.3f" % stats.ratio()).rjust(8) +
+                      ("%.2f" % check.elapsed + "s").rjust(12) +
+                      ("%.1f" % (check.throughput() / 1024 / 1024)).rjust(9))
+                os.remove(outfile)
+
+        if args.tune:
+            start = time.time()
+            best, trials = automagic_imaging.compression.tune(path, formats, processes=max(args.processes))
+            print("")
+            print("Auto-tuning picked " + best[0] + "-" + str(best[1]) + " in " + "%.2f" % (time.time() - start) +
+                  "s (writing at " + str(automagic_imaging.compression.write_bandwidth / 1024 / 1024) + " MB/s):")
+            for trial in trials:
+                print("    " + (trial.codec + "-" + str(trial.level)).ljust(10) +
+                      ("%.1f" % (trial.throughput() / 1024 / 1024) + " MB/s").rjust(14) +
+                      ("%.3f" % trial.ratio()).rjust(8) +
+                      ("estimated " + "%.1f" % trial.cost(size) + "s").rjust(18))
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+if __name__ == '__main__':
+    main()
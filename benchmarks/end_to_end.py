@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+'''Runs the whole imaging process against the stand-in tools in standin.py,
+so that the overhead and scaling of the imaging script itself can be measured
+on any system, without disk images or a radmind server.
+
+First a single image is produced directly with image_producer(), and the time
+of each of its stages is reported. Then config files with different numbers of
+images are run through with_config() with different numbers of workers, and
+the wall time of each run (and the average time of each stage) is reported.
+
+The stand-ins can be given a synthetic transcript of any size, and latencies
+and a download bandwidth to emulate slower tools and servers. Any fixed waits
+in the script (time.sleep()) are skipped and reported separately, since they
+would otherwise hide everything else; waits for volumes to be ready are polled
+(see automagic_imaging.polling) and are recorded as stages of their own.
+
+With '--backend directory', images are made in-process by the directory
+backend instead of the stand-in disk image tools; only the radmind tools are
+stand-ins.
+
+This needs the same modules as the imaging script itself (including
+management_tools), but must be run as root only if the stand-ins are.
+'''
+
+import argparse
+import imp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+# Prefer the copy of automagic_imaging in this checkout over an installed one.
+sys.path.insert(0, os.path.join(here, '..', 'src'))
+import automagic_imaging
+
+# The tools that are replaced by stand-ins.
+standins = ['hdiutil', 'diskutil', 'mount', 'bless', 'asr', 'ktcheck',
+            'fsdiff', 'lapply']
+
+class Clock:
+    '''Takes the place of the time module in the imaging script, skipping its
+    fixed waits but counting how long they would have been.
+    '''
+
+    def __init__(self):
+        self.skipped = 0
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        self.skipped += seconds
+
+class QuietLogger:
+    '''Keeps the imaging script's log messages instead of printing them, except
+    for errors.
+    '''
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+        if self.verbose:
+            print("    " + message)
+
+    def error(self, message):
+        self.messages.append(message)
+        print("    ERROR: " + message)
+
+class Environment:
+    '''A temporary directory with everything one run needs: the stand-in
+    tools, a directory for volumes, the temporary and output directories, and
+    certificates.
+    '''
+
+    def __init__(self, settings):
+        self.root = tempfile.mkdtemp(prefix='automagic_benchmark_')
+        self.bin = os.path.join(self.root, 'bin')
+        self.volumes = os.path.join(self.root, 'Volumes')
+        self.state = os.path.join(self.root, 'state')
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        self.out_dir = os.path.join(self.root, 'out')
+        self.certs = os.path.join(self.root, 'certs')
+        for directory in [self.bin, self.volumes, self.state, self.tmp_dir,
+                          self.out_dir, self.certs]:
+            os.makedirs(directory)
+
+        # Each stand-in is a small wrapper that runs standin.py with the same
+        # interpreter as this script.
+        for tool in standins:
+            path = os.path.join(self.bin, tool)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\nexec "' + sys.executable + '" "' +
+                        os.path.join(here, 'standin.py') + '" ' + tool + ' "$@"\n')
+            os.chmod(path, 0755)
+
+        self.environment = {
+            'STANDIN_STATE':   self.state,
+            'STANDIN_VOLUMES': self.volumes
+        }
+        self.environment.update(settings)
+
+    def cert(self, name):
+        path = os.path.join(self.certs, name + '.pem')
+        if not os.path.isfile(path):
+            open(path, 'w').close()
+        return path
+
+    def config(self, images, workers):
+        '''Writes a config file with 'images' image sections and returns its
+        path.
+        '''
+
+        path = os.path.join(self.root, 'config.ini')
+        with open(path, 'w') as f:
+            f.write('[Global]\n')
+            f.write('tmp_dir: ' + self.tmp_dir + '\n')
+            f.write('out_dir: ' + self.out_dir + '\n')
+            f.write('rserver: radmind.example.com\n')
+            f.write('workers: ' + str(workers) + '\n')
+            for i in range(images):
+                name = 'Image' + str(i + 1)
+                f.write('\n[' + name + ']\n')
+                f.write('cert: ' + self.cert(name) + '\n')
+                f.write('volume: ' + name + ' $VERSION-$BUILD\n')
+        return path
+
+    def __enter__(self):
+        # Point the imaging modules at the stand-ins.
+        self.saved = (dict(automagic_imaging.images.tools), automagic_imaging.images.volumes,
+                      dict(automagic_imaging.scripts.radmind.defaults), dict(os.environ))
+        for tool in automagic_imaging.images.tools:
+            automagic_imaging.images.tools[tool] = os.path.join(self.bin, tool)
+        automagic_imaging.images.volumes = self.volumes + '/'
+        for tool in ['ktcheck', 'fsdiff', 'lapply']:
+            automagic_imaging.scripts.radmind.defaults[tool] = os.path.join(self.bin, tool)
+        os.environ.update(self.environment)
+        return self
+
+    def __exit__(self, *exception):
+        tools, volumes, defaults, environment = self.saved
+        automagic_imaging.images.tools.update(tools)
+        automagic_imaging.images.volumes = volumes
+        automagic_imaging.scripts.radmind.defaults.update(defaults)
+        os.environ.clear()
+        os.environ.update(environment)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+def load_script(environment, backend=None, verbose=False, format=None,
+                sparsebundle=False, compact=True):
+    '''Loads the imaging script as a module, with a quiet logger and without
+    its fixed waits, using the named image 'backend' (or the stand-in disk
+    image tools) and converting images to 'format'. Images are built in
+    sparse bundles with 'sparsebundle', and compacted unless 'compact' is
+    False.
+    '''
+
+    script = imp.load_source('radmind_auto_image_creator',
+                             os.path.join(here, '..', 'scripts', 'radmind_auto_image_creator.py'))
+    script.set_globals()
+    script.logger = QuietLogger(verbose)
+    script.time = Clock()
+    if backend:
+        script.options['backend'] = automagic_imaging.images.backend(backend, environment.volumes)
+    script.options['format'] = format
+    if format:
+        # As the script does, so that the compressing processes are shared.
+        script.setup_format(format)
+    script.options['sparsebundle'] = sparsebundle
+    script.options['compact'] = compact
+    return script
+
+def stage_averages(metrics):
+    '''Returns the average time of each stage across all of the images in
+    'metrics' (a dictionary from Metrics.to_dict()), in the order they ran.
+    '''
+
+    totals = {}
+    order = []
+    for image in metrics['images'].values():
+        for name, stage in image['stages'].items():
+            if name not in totals:
+                totals[name] = []
+                order.append(name)
+            totals[name].append(stage['elapsed'])
+    return [(name, sum(totals[name]) / len(totals[name])) for name in order]
+
+def single(settings, backend=None, verbose=False, format=None, sparsebundle=False,
+           compact=True):
+    '''Produces one image with image_producer() and returns its metrics.'''
+    with Environment(settings) as environment:
+        script = load_script(environment, backend, verbose, format, sparsebundle, compact)
+        start = time.time()
+        success = script.image_producer(
+            tmp_dir = environment.tmp_dir,
+            out_dir = environment.out_dir,
+            rserver = 'radmind.example.com',
+            cert    = environment.cert('Single'),
+            image   = 'Single',
+            volname = 'Single $VERSION-$BUILD',
+            metrics = script.options['metrics'],
+            backend = script.options['backend'],
+            format  = format,
+            image_type = 'SPARSEBUNDLE' if sparsebundle else 'SPARSE',
+            compact = compact
+        )
+        elapsed = time.time() - start
+        script.options['metrics'].finish('Single', success)
+        return {
+            'success': success,
+            'elapsed': elapsed,
+            'skipped': script.time.skipped,
+            'metrics': script.options['metrics'].to_dict()
+        }
+
+def scaled(settings, images, workers, backend=None, verbose=False, format=None,
+           sparsebundle=False, compact=True):
+    '''Runs a config file of 'images' images through with_config() with
+    'workers' workers, and returns the results.
+    '''
+
+    with Environment(settings) as environment:
+        script = load_script(environment, backend, verbose, format, sparsebundle, compact)
+        script.options['config'] = environment.config(images, workers)
+        start = time.time()
+        script.with_config()
+        elapsed = time.time() - start
+        results = script.options['results']
+        for image in results:
+            script.options['metrics'].finish(image, results[image])
+        return {
+            'images':    images,
+            'workers':   workers,
+            'succeeded': len([x for x in results if results[x]]),
+            'elapsed':   elapsed,
+            'skipped':   script.time.skipped,
+            'metrics':   script.options['metrics'].to_dict()
+        }
+
+def numbers(value):
+    return [int(x) for x in value.split(',') if x.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the imaging process with stand-in tools.")
+    parser.add_argument('-i', '--images', type=numbers, default=[1, 2, 4],
+                        help="comma-separated numbers of images to build (default: 1,2,4)")
+    parser.add_argument('-w', '--workers', type=numbers, default=[1, 2, 4],
+                        help="comma-separated numbers of workers to try (default: 1,2,4)")
+    parser.add_argument('-f', '--files', type=int, default=1000,
+                        help="number of files in the synthetic transcript (default: 1000)")
+    parser.add_argument('-s', '--file-size', type=int, default=4096,
+                        help="size of each synthetic file in bytes (default: 4096)")
+    parser.add_argument('-l', '--latency', type=float, default=0,
+                        help="seconds each stand-in tool waits before running (default: 0)")
+    parser.add_argument('-t', '--tool-latency', action='append', default=[], metavar='TOOL=SECONDS',
+                        help="the latency of one tool, such as 'lapply=2' (may be repeated)")
+    parser.add_argument('-b', '--bandwidth', type=float,
+                        help="bytes per second ktcheck and lapply download at (default: unlimited)")
+    parser.add_argument('--backend', choices=['directory'],
+                        help="make images with this backend instead of the stand-in disk image tools")
+    parser.add_argument('--format',
+                        help="convert images to this format, such as 'zlib-6' or 'auto' (default: 'UDZO-9')")
+    parser.add_argument('--sparsebundle', action='store_true',
+                        help="build images in sparse bundles instead of sparse images")
+    parser.add_argument('--no-compact', action='store_true',
+                        help="don't compact images before converting them")
+    parser.add_argument('-o', '--output',
+                        help="also write all of the results to this JSON file")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="print the imaging script's log messages")
+    args = parser.parse_args()
+
+    settings = {
+        'STANDIN_FILES':     str(args.files),
+        'STANDIN_FILE_SIZE': str(args.file_size),
+        'STANDIN_LATENCY':   str(args.latency)
+    }
+    for value in args.tool_latency:
+        tool, seconds = value.split('=', 1)
+        if tool not in standins:
+            parser.error("Unknown tool: '" + tool + "'")
+        settings['STANDIN_LATENCY_' + tool.upper()] = str(float(seconds))
+    if args.bandwidth:
+        settings['STANDIN_BANDWIDTH'] = str(args.bandwidth)
+
+    print("Synthetic transcript: " + str(args.files) + " files of " + str(args.file_size) + " bytes")
+    if args.backend:
+        print("Image backend: " + args.backend)
+    if args.format:
+        print("Image format: " + args.format)
+    if args.sparsebundle:
+        print("Image type: sparse bundle")
+    if args.no_compact:
+        print("Compaction: off")
+    results = {'settings': settings, 'single': None, 'scaling': []}
+
+    result = single(settings, args.backend, args.verbose, args.format, args.sparsebundle,
+                    not args.no_compact)
+    results['single'] = result
+    print("")
+    print("Single image with image_producer(): " + "%.2f" % result['elapsed'] + "s" +
+          ("" if result['success'] else " (FAILED)") +
+          " (" + "%.0f" % result['skipped'] + "s of fixed waits skipped)")
+    for name, elapsed in stage_averages(result['metrics']):
+        print("    " + name.ljust(18) + "%8.3f" % elapsed + "s")
+
+    print("")
+    print("Config runs with with_config():")
+    print("    " + "images".rjust(6) + "workers".rjust(9) + "wall".rjust(10) + "per image".rjust(11) +
+          "speedup".rjust(9) + "  succeeded")
+    baselines = {}
+    for images in args.images:
+        for workers in args.workers:
+            if workers > images and workers != args.workers[0]:
+                continue
+            result = scaled(settings, images, workers, args.backend, args.verbose, args.format,
+                            args.sparsebundle, not args.no_compact)
+            results['scaling'].append(result)
+            baseline = baselines.setdefault(images, result['elapsed'])
+            print("    " + str(images).rjust(6) + str(workers).rjust(9) +
+                  ("%.2f" % result['elapsed'] + "s").rjust(10) +
+                  ("%.2f" % (result['elapsed'] / images) + "s").rjust(11) +
+                  ("%.2f" % (baseline / max(result['elapsed'], 0.001)) + "x").rjust(9) +
+                  "  " + str(result['succeeded']) + "/" + str(images))
+            if args.verbose:
+                for name, elapsed in stage_averages(result['metrics']):
+                    print("        " + name.ljust(18) + "%8.3f" % elapsed + "s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print("")
+        print("Wrote results to '" + args.output + "'")
+
+if __name__ == '__main__':
+    main()
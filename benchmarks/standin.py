@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+
+'''Stand-ins for the imaging and radmind tools (hdiutil, diskutil, asr, bless,
+mount, ktcheck, fsdiff and lapply), so that the whole imaging
+process can be run on any system without disk images or a radmind server.
+
+The name of the tool to act as is given as the first argument, followed by the
+tool's own arguments:
+
+    standin.py hdiutil attach /tmp/Image.sparseimage
+
+Images are directories: a "sparse image" is a small file describing the
+volume, with its contents kept in a directory next to it. Attaching an image
+moves that directory to the mount point, and detaching it moves it back.
+Shadow files get their own copy of the contents when first attached.
+
+The stand-ins are configured through environment variables:
+
+STANDIN_STATE     - a directory to keep the table of attached images in
+                    (required)
+STANDIN_VOLUMES   - the directory volumes are mounted in (required)
+STANDIN_FILES     - the number of files in the synthetic transcript
+                    (default: 1000)
+STANDIN_FILE_SIZE - the size of each file in bytes (default: 4096)
+STANDIN_LATENCY   - seconds every tool waits before doing anything, to
+                    emulate start-up and round-trip costs (default: 0)
+STANDIN_LATENCY_<TOOL>
+                  - the latency of a single tool, such as
+                    STANDIN_LATENCY_LAPPLY (overrides STANDIN_LATENCY)
+STANDIN_BANDWIDTH - bytes per second that ktcheck and lapply "download" at
+                    (default: unlimited)
+'''
+
+import base64
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import plistlib
+import shutil
+import sys
+import tarfile
+import time
+
+# The system version reported by the synthetic SystemVersion.plist.
+product_version = '10.9.3'
+product_build = '13D65'
+system_version = './System/Library/CoreServices/SystemVersion.plist'
+
+class Failure(Exception):
+    '''Makes the stand-in exit with an error.'''
+    pass
+
+def setting(name, default=None):
+    value = os.environ.get('STANDIN_' + name)
+    if value is None or value == '':
+        return default
+    return value
+
+def wait(tool):
+    latency = float(setting('LATENCY_' + tool.upper(), setting('LATENCY', 0)))
+    if latency > 0:
+        time.sleep(latency)
+
+def transfer(size):
+    '''Waits as long as downloading 'size' bytes would take.'''
+    bandwidth = setting('BANDWIDTH')
+    if bandwidth and float(bandwidth) > 0:
+        time.sleep(size / float(bandwidth))
+
+class Progress:
+    '''Prints progress lines like the radmind tools do with '-%' (such as
+    '%42 ./Library'), whenever the percentage changes.
+    '''
+
+    def __init__(self, args, total):
+        self.enabled = '-%' in args
+        self.total = max(total, 1)
+        self.done = 0
+        self.last = None
+
+    def step(self, path):
+        self.done += 1
+        percent = self.done * 100 // self.total
+        if self.enabled and percent != self.last:
+            self.last = percent
+            sys.stdout.write('%' + '%02d' % percent + ' ' + path + '\n')
+            sys.stdout.flush()
+
+@contextlib.contextmanager
+def mounts():
+    '''Yields the table of attached images (and saves it afterward), holding
+    a lock so that concurrent stand-ins don't interfere.
+    '''
+
+    state = setting('STATE')
+    if not state:
+        raise Failure("STANDIN_STATE is not set.")
+    if not os.path.isdir(state):
+        os.makedirs(state)
+    with open(os.path.join(state, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = os.path.join(state, 'mounts.json')
+        table = {'next': 1, 'disks': {}}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                table = json.load(f)
+        yield table
+        with open(path + '.new', 'w') as f:
+            json.dump(table, f)
+        os.rename(path + '.new', path)
+
+def read_image(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def write_image(path, info):
+    with open(path, 'w') as f:
+        json.dump(info, f)
+
+def contents(path):
+    return path + '.contents'
+
+def find_disk(table, disk=None, mount=None):
+    for identifier, record in table['disks'].items():
+        if identifier == disk or record['mount'] == mount:
+            return identifier, record
+    raise Failure("No such disk: " + str(disk or mount))
+
+def mount_point(name):
+    '''Returns where to mount a volume called 'name', numbering it if another
+    volume of the same name is already mounted (as OS X does).
+    '''
+
+    volumes = setting('VOLUMES')
+    if not volumes:
+        raise Failure("STANDIN_VOLUMES is not set.")
+    mount = os.path.join(volumes, name)
+    number = 1
+    while os.path.exists(mount):
+        mount = os.path.join(volumes, name + ' ' + str(number))
+        number += 1
+    return mount
+
+def option(args, name, default=None):
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+# Disk images
+
+def hdiutil(args):
+    verb = args[0]
+    if verb == 'create':
+        name = args[-1]
+        extension = '.sparsebundle' if option(args, '-type') == 'SPARSEBUNDLE' else '.sparseimage'
+        path = name if name.endswith(extension) else name + extension
+        if os.path.isdir(contents(path)):
+            shutil.rmtree(contents(path))
+        os.makedirs(contents(path))
+        write_image(path, {'volname': option(args, '-volname', 'Untitled')})
+        print('created: ' + os.path.abspath(path))
+    elif verb == 'attach':
+        image = os.path.abspath(args[1])
+        shadow = option(args, '-shadow')
+        source = image
+        if shadow:
+            shadow = os.path.abspath(shadow)
+            if not os.path.isfile(shadow):
+                if os.path.isdir(contents(shadow)):
+                    shutil.rmtree(contents(shadow))
+                shutil.copytree(contents(image), contents(shadow), symlinks=True)
+                write_image(shadow, read_image(image))
+            source = shadow
+        info = read_image(source)
+        with mounts() as table:
+            mount = mount_point(info['volname'])
+            os.rename(contents(source), mount)
+            disk = '/dev/disk' + str(table['next']) + 's1'
+            table['next'] += 1
+            table['disks'][disk] = {'image': source, 'mount': mount}
+        if '-plist' in args:
+            print(plistlib.writePlistToString({'system-entities': [
+                {'dev-entry': disk[:-2], 'content-hint': 'GUID_partition_scheme'},
+                {'dev-entry': disk, 'content-hint': 'Apple_HFS', 'mount-point': mount}
+            ]}))
+        else:
+            print(disk[:-2] + '\tGUID_partition_scheme\t')
+            print(disk + '\tApple_HFS\t' + mount)
+    elif verb == 'detach':
+        with mounts() as table:
+            disk, record = find_disk(table, disk=args[1])
+            os.rename(record['mount'], contents(record['image']))
+            del table['disks'][disk]
+    elif verb == 'convert':
+        image = os.path.abspath(args[1])
+        source = option(args, '-shadow') or image
+        outfile = option(args, '-o')
+        format = option(args, '-format', 'UDRO')
+        level = 1
+        if format.startswith('UDZO-'):
+            level = int(format.split('-')[1])
+        with open(outfile, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=level) as compressed:
+                with tarfile.open(fileobj=compressed, mode='w') as archive:
+                    archive.add(contents(source), arcname='.')
+        print('created: ' + outfile)
+    elif verb == 'compact':
+        image = os.path.abspath(args[1])
+        with mounts() as table:
+            if [x for x in table['disks'].values() if x['image'] == image]:
+                raise Failure("The image is attached: " + image)
+        print('Reclaimed 0 bytes out of 0 bytes possible.')
+    else:
+        raise Failure("Unsupported hdiutil verb: " + verb)
+
+def diskutil(args):
+    verb = args[0]
+    if verb in ['enableOwnership', 'verifyVolume']:
+        with mounts() as table:
+            find_disk(table, disk=args[1], mount=args[1])
+    elif verb == 'eraseVolume':
+        with mounts() as table:
+            disk, record = find_disk(table, disk=args[3])
+        for name in os.listdir(record['mount']):
+            path = os.path.join(record['mount'], name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    elif verb == 'rename':
+        with mounts() as table:
+            disk, record = find_disk(table, mount=args[1].rstrip('/'))
+            mount = mount_point(args[2])
+            os.rename(record['mount'], mount)
+            record['mount'] = mount
+            info = read_image(record['image'])
+            info['volname'] = args[2]
+            write_image(record['image'], info)
+    elif verb == 'info':
+        with mounts() as table:
+            disk, record = find_disk(table, disk=args[-1], mount=args[-1].rstrip('/'))
+        print(plistlib.writePlistToString({
+            'DeviceNode': disk,
+            'MountPoint': record['mount'],
+            'VolumeName': read_image(record['image'])['volname']
+        }))
+    elif verb == 'unmountDisk':
+        with mounts() as table:
+            disk, record = find_disk(table, mount=args[-1].rstrip('/'))
+            os.rename(record['mount'], contents(record['image']))
+            del table['disks'][disk]
+    else:
+        raise Failure("Unsupported diskutil verb: " + verb)
+
+def mount(args):
+    with mounts() as table:
+        for disk in sorted(table['disks']):
+            print(disk + ' on ' + table['disks'][disk]['mount'] + ' (hfs, local, journaled)')
+
+def bless(args):
+    folder = option(args, '--folder')
+    if not folder or not os.path.isdir(folder):
+        raise Failure("No system folder to bless: " + str(folder))
+
+def asr(args):
+    sha1 = hashlib.sha1()
+    with open(option(args, '--source'), 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+
+# Radmind
+
+def content(path, size):
+    '''Returns the synthetic contents of the file at 'path'.'''
+    if path == system_version:
+        return plistlib.writePlistToString({
+            'ProductName': 'Mac OS X',
+            'ProductVersion': product_version,
+            'ProductBuildVersion': product_build
+        })
+    block = hashlib.sha1(path).digest() * 64
+    return (block * (size // len(block) + 1))[:size]
+
+def synthetic_transcript():
+    '''Yields the lines of a transcript with STANDIN_FILES files spread over
+    directories of a hundred files each, plus a SystemVersion.plist.
+    '''
+
+    files = int(setting('FILES', 1000))
+    size = int(setting('FILE_SIZE', 4096))
+    entries = []
+    for directory in ['./System', './System/Library', './System/Library/CoreServices']:
+        entries.append((directory, 'd ' + directory + ' 0755 0 0'))
+    data = content(system_version, 0)
+    entries.append((system_version, file_line(system_version, data)))
+    for i in range(files):
+        directory = './Library/Synthetic/Folder' + str(i // 100)
+        if i % 100 == 0:
+            entries.append((directory, 'd ' + directory + ' 0755 0 0'))
+        path = directory + '/File' + str(i)
+        entries.append((path, file_line(path, content(path, size))))
+    for directory in ['./Library', './Library/Synthetic']:
+        entries.append((directory, 'd ' + directory + ' 0755 0 0'))
+    # Radmind transcripts are sorted by path.
+    for path, line in sorted(entries):
+        yield line
+
+def file_line(path, data):
+    checksum = base64.b64encode(hashlib.sha1(data).digest())
+    return 'f ' + path + ' 0644 0 0 1401234567 ' + str(len(data)) + ' ' + checksum
+
+def ktcheck(args):
+    client = os.path.join(option(args, '-D', './private/var/radmind/'), 'client')
+    if not os.path.isdir(client):
+        os.makedirs(client)
+    command = option(args, '-K', os.path.join(client, 'command.K'))
+    with open(command, 'w') as f:
+        f.write('p synthetic.T\n')
+    transcript = '\n'.join(synthetic_transcript()) + '\n'
+    path = os.path.join(client, 'synthetic.T')
+    if not os.path.isfile(path) or open(path, 'r').read() != transcript:
+        transfer(len(transcript))
+        with open(path, 'w') as f:
+            f.write(transcript)
+
+def fsdiff(args):
+    command = option(args, '-K')
+    outfile = option(args, '-o')
+    client = os.path.dirname(command)
+    with open(outfile, 'w') as output:
+        with open(command, 'r') as f:
+            transcripts = [line.split()[1] for line in f if line.startswith('p ')]
+        lines = []
+        for name in transcripts:
+            with open(os.path.join(client, name), 'r') as f:
+                lines.append((name, f.readlines()))
+        progress = Progress(args, sum(len(x[1]) for x in lines))
+        for name, transcript in lines:
+            output.write(name + ':\n')
+            for line in transcript:
+                fields = line.split()
+                path = fields[1]
+                progress.step(path)
+                if fields[0] == 'd':
+                    if not os.path.isdir(path):
+                        output.write(line)
+                elif fields[0] == 'f':
+                    if (not os.path.isfile(path) or
+                            os.path.getsize(path) != int(fields[6]) or
+                            int(os.path.getmtime(path)) != int(fields[5])):
+                        output.write('+ ' + line)
+
+def lapply(args):
+    with open(args[-1], 'r') as f:
+        lines = f.readlines()
+    progress = Progress(args, len(lines))
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[0].endswith(':'):
+            progress.step('')
+            continue
+        progress.step(fields[2] if fields[0] in ['+', '-'] else fields[1])
+        if fields[0] == 'd':
+            if not os.path.isdir(fields[1]):
+                os.makedirs(fields[1])
+        elif fields[0] == '+' and fields[1] == 'f':
+            path, mode, mtime, size = fields[2], fields[3], fields[6], fields[7]
+            transfer(int(size))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as output:
+                output.write(content(path, int(size)))
+            os.chmod(path, int(mode, 8))
+            os.utime(path, (int(mtime), int(mtime)))
+        elif fields[0] == '-':
+            path = fields[2]
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+tools = {
+    'hdiutil':  hdiutil,
+    'diskutil': diskutil,
+    'mount':    mount,
+    'bless':    bless,
+    'asr':      asr,
+    'ktcheck':  ktcheck,
+    'fsdiff':   fsdiff,
+    'lapply':   lapply
+}
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in tools:
+        sys.stderr.write("usage: standin.py {" + ','.join(sorted(tools)) + "} [arguments]\n")
+        sys.exit(2)
+    tool = sys.argv[1]
+    wait(tool)
+    try:
+        tools[tool](sys.argv[2:])
+    except Failure as e:
+        sys.stderr.write(tool + ": " + str(e) + "\n")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+'''Measures how quickly automagic_imaging.transcript can stream through a large
+radmind transcript, and how much memory it needs to do so.
+
+A synthetic transcript with the requested number of lines is generated first
+(unless an existing transcript is given with --transcript).
+'''
+
+import argparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+# Prefer the copy of automagic_imaging in this checkout over an installed one.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import automagic_imaging
+
+def generate(path, lines, seed=0):
+    '''Writes a synthetic transcript of 'lines' entries to 'path', mostly
+    files with some directories and symlinks, like a real system transcript.
+    '''
+
+    rng = random.Random(seed)
+    written = 0
+    directory = 0
+    with open(path, 'w') as f:
+        while written < lines:
+            f.write('d ./System/Library/Frameworks/Framework' + str(directory) + '.framework 0755 0 0\n')
+            written += 1
+            for i in range(min(rng.randint(5, 50), lines - written)):
+                name = './System/Library/Frameworks/Framework' + str(directory) + '.framework/File\\b' + str(i)
+                if rng.random() < 0.05:
+                    f.write('l ' + name + ' ../Versions/Current/' + str(i) + '\n')
+                else:
+                    f.write('f ' + name + ' 0644 0 0 1401234567 ' + str(rng.randint(0, 1 << 20)) +
+                            ' 2jmj7l5rSw0yVb/vlWAYkK/YBwk=\n')
+                written += 1
+            directory += 1
+
+def peak_memory():
+    '''Returns the peak resident set size of this process in bytes.'''
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes; OS X reports bytes.
+    if sys.platform != 'darwin':
+        usage *= 1024
+    return usage
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the streaming transcript parser.")
+    parser.add_argument('-n', '--lines', type=int, default=3000000,
+                        help="number of lines in the synthetic transcript (default: 3000000)")
+    parser.add_argument('-t', '--transcript',
+                        help="benchmark an existing transcript instead of a synthetic one")
+    args = parser.parse_args()
+
+    path = args.transcript
+    if not path:
+        handle, path = tempfile.mkstemp(suffix='.T')
+        os.close(handle)
+        start = time.time()
+        generate(path, args.lines)
+        print("Generated " + str(args.lines) + " lines (" + str(os.path.getsize(path)) +
+              " bytes) in " + "%.2f" % (time.time() - start) + "s")
+
+    try:
+        baseline = peak_memory()
+
+        start = time.time()
+        summary = automagic_imaging.transcript.summarize(automagic_imaging.transcript.parse(path))
+        elapsed = time.time() - start
+        print("Parsed and summarized " + str(summary.entries) + " entries in " + "%.2f" % elapsed +
+              "s (" + str(int(summary.entries / max(elapsed, 0.001))) + " entries/s)")
+        print("    " + str(summary.types.get('f', 0)) + " files totalling " + str(summary.bytes) + " bytes")
+
+        start = time.time()
+        count = 0
+        for entry in automagic_imaging.transcript.select(automagic_imaging.transcript.parse(path),
+                                                         types=['l']):
+            count += 1
+        elapsed = time.time() - start
+        print("Selected " + str(count) + " symlinks in " + "%.2f" % elapsed + "s")
+
+        print("Peak memory: " + str(peak_memory() / 1024 / 1024) + " MB (" +
+              str((peak_memory() - baseline) / 1024 / 1024) + " MB more than before parsing)")
+    finally:
+        if not args.transcript:
+            os.remove(path)
+
+if __name__ == '__main__':
+    main()
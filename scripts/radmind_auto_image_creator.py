@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 
 import automagic_imaging
+import collections
 import datetime
 import os
 import resource
-import subprocess
+import shutil
+import signal
 import sys
 import time
 
@@ -14,6 +16,14 @@ def main():
     if os.geteuid() != 0:
         print("You must be root to execute this script!")
         sys.exit(1)
+    if options['submit'] is not None:
+        # Only hand images to a running daemon.
+        sys.exit(0 if submit_request({'command': 'submit', 'image': options['submit'] or None,
+                                      'priority': options['priority']}) else 1)
+    if options['status'] is not None:
+        sys.exit(0 if submit_request({'command': 'status', 'id': options['status'] or None}) else 1)
+    if options['cancel'] is not None:
+        sys.exit(0 if submit_request({'command': 'cancel', 'id': options['cancel']}) else 1)
     setup_logger()
 
     args = sys.argv
@@ -31,7 +41,32 @@ def main():
         logger.error("Could not adjust descriptors limit. Continuing anyway, though errors may occur...")
     logger.info("BEGIN IMAGING")
 
-    if options['interactive']:
+    if options['cache_dir'] and not setup_cache(options['cache_dir'], options['cache_size']):
+        sys.exit(1)
+    if options['backend_name'] and not setup_backend(options['backend_name']):
+        sys.exit(1)
+    if options['format'] and not setup_format(options['format']):
+        sys.exit(1)
+    if options['archive_dir'] and not setup_archive(options['archive_dir']):
+        sys.exit(1)
+    if options['ready_timeout'] is not None and not setup_ready_timeout(options['ready_timeout']):
+        sys.exit(1)
+    if not setup_stall(options['stall_timeout'], options['stall_retries']):
+        sys.exit(1)
+    if options['restore']:
+        # Only rebuild an archived image.
+        sys.exit(0 if restore_image(options['restore'], options['out_dir']) else 1)
+    if options['decompress']:
+        # Only turn a chunked image back into one that can be restored.
+        sys.exit(0 if decompress_image(options['decompress'], options['out_dir']) else 1)
+
+    if options['daemon']:
+        # Builds images as they are submitted, until stopped.
+        if not options['config']:
+            logger.error("A config file must be given with '-c' to run as a daemon.")
+            sys.exit(1)
+        sys.exit(0 if run_daemon() else 1)
+    elif options['interactive']:
         # Prompts the user for each item.
         interactive()
     elif options['config']:
@@ -40,14 +75,43 @@ def main():
     elif (options['tmp_dir'] and options['out_dir'] and options['rserver'] and
           options['cert'] and options['image'] and options['volname']):
         # Uses all of the manually-input information from the command line.
-        produce_image()
+        record_result(options['image'], produce_image)
     else:
         # The user probably did something wrong, but don't let all their work
         # go to waste!
         interactive()
 
+    results = options['results']
+    successes = [x for x in results if results[x]]
     logger.info("--------------------------------------------------------------------------------")
-    logger.info("FINISHED IMAGING: (" + str(options['success_count']) + "/" + str(options['total_count']) + ")")
+    for image in results:
+        logger.info("    " + image + ": " + ("succeeded" if results[image] else "FAILED"))
+    logger.info("FINISHED IMAGING: (" + str(len(successes)) + "/" + str(len(results)) + ")")
+    if options['cache']:
+        stats = options['cache'].stats
+        logger.info("Cache supplied " + str(stats.files['hit']) + " file(s) (" + str(stats.bytes['hit']) +
+                    " bytes); " + str(stats.files['miss']) + " file(s) (" + str(stats.bytes['miss']) +
+                    " bytes) were downloaded.")
+        logger.info("Cache supplied " + str(stats.files['client']) + " radmind client file(s) (" +
+                    str(stats.bytes['client']) + " bytes).")
+    if options['metrics_dir']:
+        write_metrics(options['metrics_dir'])
+
+def write_metrics(directory, metrics=None, results=None):
+    '''Writes the stage timings of this run (or of 'metrics', with the
+    'results' it produced) to 'directory' as JSON and for the Prometheus
+    textfile collector.
+    '''
+    metrics = metrics or options['metrics']
+    results = options['results'] if results is None else results
+    for image in results:
+        metrics.finish(image, results[image])
+    try:
+        json_path, prom_path = metrics.write(directory)
+    except:
+        logger.error("Could not write metrics to '" + str(directory) + "': " + str(sys.exc_info()[1]))
+        return
+    logger.info("Wrote metrics to '" + json_path + "' and '" + prom_path + "'.")
 
 def interactive():
     '''An interactive, prompting method of getting values from the user.'''
@@ -94,7 +158,7 @@ def interactive():
     )
 
     # Do the stuff here.
-    produce_image()
+    record_result(options['image'], produce_image)
 
 def get_input(prompt, value=None, file=False, dir=False):
     '''Various ways to get input and test it. Retains original value if no
@@ -161,62 +225,545 @@ def with_config():
     the user may have given at command invocation (perhaps they wanted to
     override something in the file temporarily).
     '''
-    logger.info("Using config file '" + os.path.abspath(options['config']) + "'")
+    config = read_config()
+    if not config or not apply_config(config):
+        return
+
+    if options['image'] and options['image'] in config.images:
+        images = [options['image']]
+        # A layered image needs its base to be built first, unless it
+        # already has been.
+        base = config.images[options['image']].get('base')
+        if base and build_base(base):
+            images.insert(0, base)
+    else:
+        images = config.images.keys()
+    bases = config.bases()
+
     try:
-        config = automagic_imaging.configurator.Configurator(options['config'])
+        scheduler = automagic_imaging.scheduler.Scheduler(options['workers'])
+        if options['pipeline']:
+            options['finisher'] = automagic_imaging.scheduler.Pipeline(options['pipeline_depth'])
     except:
         logger.error(sys.exc_info()[1].message)
         return
+    logger.info("Building " + str(len(images)) + " image(s) with " + str(scheduler.workers) + " worker(s).")
+    for resource in options['limiter'].limits:
+        logger.info("At most " + str(options['limiter'].limits[resource]) + " " + resource + " stage(s) will run at once.")
+    if options['finisher']:
+        logger.info("Converting and scanning in the background with up to " + str(options['finisher'].depth) + " image(s) waiting.")
+    for image in images:
+        overrides = {}
+        if image in bases:
+            # Keep the sparse image around for the images layered on it.
+            overrides['persist'] = True
+            # Its variants attach it as soon as its job succeeds, so it must
+            # be compacted and converted by then rather than in the
+            # background.
+            overrides['pipeline'] = None
+        scheduler.submit(
+            image,
+            produce_image,
+            cert    = config.images[image]['cert'],
+            image   = image,
+            volname = config.images[image]['volume'],
+            base    = config.images[image].get('base'),
+            **overrides
+        )
+    for image in images:
+        if config.images[image].get('base'):
+            logger.info("Image '" + image + "' is layered on '" + config.images[image]['base'] + "'.")
+            if config.images[image]['base'] in images:
+                scheduler.require(image, config.images[image]['base'])
+
+    results = scheduler.run()
+    finished = {}
+    if options['finisher']:
+        # Wait for the background conversions to complete as well.
+        finished = options['finisher'].join()
+    for image in results:
+        result = results[image]
+        if result.success and image in finished:
+            result = finished[image]
+        if result.error:
+            logger.error("Image '" + image + "' failed: " + result.error)
+        options['results'][image] = result.success
 
+def build_base(base):
+    '''Returns whether the base image 'base' must be built before an image
+    layered on it is: if it has never been built (or was removed), or if
+    '--rebuild-base' was given.
+    '''
+    return (options['rebuild_base'] or
+            not os.path.exists(automagic_imaging.images.image_path(options['tmp_dir'], base)))
+
+def read_config():
+    '''Reads the config file given with '-c'. Returns the Configurator, or
+    None if the file is invalid.
+    '''
+    logger.info("Using config file '" + os.path.abspath(options['config']) + "'")
+    try:
+        return automagic_imaging.configurator.Configurator(options['config'])
+    except:
+        logger.error(sys.exc_info()[1].message)
+        return None
+
+def apply_config(config):
+    '''Fills in the options that weren't given on the command line from the
+    'Global' section of 'config', and sets up what they call for (the backend,
+    format, archive, cache, and resource limits). Returns True if everything
+    could be set up.
+    '''
     options['tmp_dir'] = config.globals['tmp_dir'] if not options['tmp_dir'] else options['tmp_dir']
     options['out_dir'] = config.globals['out_dir'] if not options['out_dir'] else options['out_dir']
     options['rserver'] = config.globals['rserver'] if not options['rserver'] else options['rserver']
+    options['workers'] = config.globals.get('workers', 1) if not options['workers'] else options['workers']
+    limits = {}
+    for resource in automagic_imaging.scheduler.resource_classes:
+        limits[resource] = config.globals.get(resource + '_limit')
+    if not options['pipeline']:
+        options['pipeline'] = automagic_imaging.configurator.boolean(config.globals.get('pipeline'))
+    options['pipeline_depth'] = config.globals.get('pipeline_depth', 1) if not options['pipeline_depth'] else options['pipeline_depth']
+    if not options['warm_start']:
+        options['warm_start'] = automagic_imaging.configurator.boolean(config.globals.get('warm_start'))
+    if not options['skip_unchanged']:
+        options['skip_unchanged'] = automagic_imaging.configurator.boolean(config.globals.get('skip_unchanged'))
+    options['metrics_dir'] = config.globals.get('metrics_dir') if not options['metrics_dir'] else options['metrics_dir']
+    if not options['sparsebundle']:
+        options['sparsebundle'] = automagic_imaging.configurator.boolean(config.globals.get('sparsebundle'))
+    if options['compact'] and config.globals.get('compact') is not None:
+        options['compact'] = automagic_imaging.configurator.boolean(config.globals['compact'])
+    if not options['resume']:
+        options['resume'] = automagic_imaging.configurator.boolean(config.globals.get('resume'))
+        if options['resume']:
+            # Keep what fails so that it can be resumed in turn.
+            options['persist-fail'] = True
+    if options['ready_timeout'] is None and config.globals.get('ready_timeout'):
+        if not setup_ready_timeout(config.globals['ready_timeout']):
+            return False
+    if options['stall_timeout'] is None and config.globals.get('stall_timeout') is not None:
+        options['stall_timeout'] = config.globals['stall_timeout']
+    if options['stall_retries'] is None and config.globals.get('stall_retries') is not None:
+        options['stall_retries'] = config.globals['stall_retries']
+    if not setup_stall(options['stall_timeout'], options['stall_retries']):
+        return False
+    if not options['backend'] and config.globals.get('backend'):
+        if not setup_backend(config.globals['backend'], config.globals.get('volumes_dir')):
+            return False
+    if not options['format'] and config.globals.get('format'):
+        if not setup_format(config.globals['format']):
+            return False
+    if not options['archive'] and config.globals.get('archive_dir'):
+        if not setup_archive(config.globals['archive_dir']):
+            return False
+    if not options['cache'] and config.globals.get('cache_dir'):
+        if not setup_cache(config.globals['cache_dir'],
+                           options['cache_size'] or config.globals.get('cache_size')):
+            return False
 
-    if options['image'] and options['image'] in config.images:
-        options['cert']    = config.images[options['image']]['cert']
-        options['volname'] = config.images[options['image']]['volume']
+    try:
+        options['limiter'] = automagic_imaging.scheduler.ResourceLimiter(limits)
+    except:
+        logger.error(sys.exc_info()[1].message)
+        return False
+    return True
+
+def run_daemon():
+    '''Keeps running and builds the images in the config file as they are
+    submitted to it (see submit_request()), until it is stopped.
+
+    Jobs wait in a daemon.JobQueue, highest priority first. Up to 'workers'
+    of them are built at once, and urgent ones (of at least
+    daemon.urgent_priority) also have 'urgent_workers' of their own, so that a
+    one-off rebuild starts right away instead of waiting for a batch to
+    finish. The image sections are read again for each submission and each
+    build, so images can be added or changed without restarting; the 'Global'
+    section is only read at the start. Returns False if the daemon could not
+    start.
+    '''
+    config = read_config()
+    if not config or not apply_config(config):
+        return False
+    if options['urgent_workers'] is None:
+        options['urgent_workers'] = config.globals.get('urgent_workers', 1)
+    path = socket_path(config)
 
+    def sections():
         try:
-            produce_image()
+            return automagic_imaging.configurator.Configurator(options['config'])
         except:
-            return
-    else:
-        for image in config.images:
-            options['cert']    = config.images[image]['cert']
-            options['image']   = image
-            options['volname'] = config.images[image]['volume']
+            raise ValueError(str(sys.exc_info()[1]))
 
-            try:
-                produce_image()
-            except:
-                return
+    def plan(image):
+        config = sections()
+        if not image:
+            # Everything, with the bases first.
+            bases = config.bases()
+            names = bases + [x for x in config.images if x not in bases]
+        elif image in config.images:
+            names = [image]
+            base = config.images[image].get('base')
+            if base and build_base(base):
+                names.insert(0, base)
+        else:
+            raise ValueError("No image named '" + image + "' in the config file.")
+        for name in names:
+            logger.info("Queued '" + name + "'.")
+        return [(x, config.images[x].get('base')) for x in names]
 
-def produce_image():
+    def run(job):
+        config = sections()
+        if job.image not in config.images:
+            raise ValueError("'" + job.image + "' is no longer in the config file.")
+        logger.info("Starting job " + str(job.id) + ": '" + job.image + "' (priority " + str(job.priority) + ").")
+        metrics = automagic_imaging.metrics.Metrics()
+        success = False
+        try:
+            success = produce_image(
+                cert     = config.images[job.image]['cert'],
+                image    = job.image,
+                volname  = config.images[job.image]['volume'],
+                base     = config.images[job.image].get('base'),
+                persist  = options['persist'] or job.image in config.bases(),
+                # Several jobs already run at once, so each one is finished
+                # by the worker that built it.
+                pipeline = None,
+                metrics  = metrics
+            )
+        except:
+            logger.error("Job " + str(job.id) + " (" + job.image + ") failed: " + str(sys.exc_info()[1]))
+        options['results'][job.image] = success
+        logger.info("Job " + str(job.id) + " (" + job.image + ") " + ("succeeded." if success else "FAILED."))
+        if options['metrics_dir']:
+            write_metrics(options['metrics_dir'], metrics, {job.image: success})
+        return success
+
+    try:
+        daemon = automagic_imaging.daemon.Daemon(run, plan, options['workers'], options['urgent_workers'],
+                                                 logger.error)
+    except:
+        logger.error(sys.exc_info()[1].message)
+        return False
+    logger.info("Running as a daemon on '" + path + "' with " + str(daemon.workers) + " worker(s) and " +
+                str(daemon.urgent_workers) + " urgent worker(s).")
+    for resource in options['limiter'].limits:
+        logger.info("At most " + str(options['limiter'].limits[resource]) + " " + resource + " stage(s) will run at once.")
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    daemon.start()
+    try:
+        daemon.serve(path)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except:
+        logger.error("Could not listen on '" + path + "': " + str(sys.exc_info()[1]))
+        daemon.stop(wait=False)
+        return False
+    logger.info("Stopping; waiting for the jobs that are running to finish...")
+    daemon.stop()
+    return True
+
+def socket_path(config=None):
+    '''Returns where the daemon listens: the '--socket' option, or the
+    'socket' setting in the config file, or daemon.default_socket.
+    '''
+    if options['socket']:
+        return options['socket']
+    if not config and options['config']:
+        try:
+            config = automagic_imaging.configurator.Configurator(options['config'])
+        except:
+            config = None
+    if config and config.globals.get('socket'):
+        return config.globals['socket']
+    return automagic_imaging.daemon.default_socket
+
+def submit_request(message):
+    '''Sends 'message' to a running daemon and prints the jobs in its
+    response. Returns True if the daemon carried it out.
+    '''
+    path = socket_path()
+    try:
+        response = automagic_imaging.daemon.request(path, message)
+    except:
+        print("Could not reach the daemon at '" + path + "': " + str(sys.exc_info()[1]))
+        return False
+    if not response.get('ok'):
+        print("Error: " + str(response.get('error')))
+        return False
+    for job in response['jobs']:
+        line = str(job['id']).rjust(6) + "  " + job['image'].ljust(24) + job['state'].ljust(11)
+        line += ("priority " + str(job['priority'])).ljust(13)
+        if job['started']:
+            line += "%.0fs" % ((job['finished'] or time.time()) - job['started'])
+        if job['error']:
+            line += "  " + job['error']
+        print(line)
+    return True
+
+def setup_cache(path, size=None):
+    '''Opens the shared radmind cache at 'path', limited to 'size' (such as
+    '50g'). Returns True if the cache could be used.
+    '''
+    try:
+        options['cache'] = automagic_imaging.cache.Cache(path, automagic_imaging.configurator.size(size))
+    except:
+        logger.error("Could not use the cache at '" + str(path) + "': " + str(sys.exc_info()[1]))
+        return False
+    logger.info("Using cache at '" + options['cache'].path + "' (" + str(options['cache'].size()) + " bytes in use).")
+    return True
+
+def setup_backend(name, volumes=None):
+    '''Chooses how images are made: 'mac' (with the OS X disk image tools) or
+    'directory' (with plain directories, mounted in 'volumes'). Returns True if
+    the backend could be used.
+    '''
+    try:
+        options['backend'] = automagic_imaging.images.backend(name, volumes)
+    except:
+        logger.error(sys.exc_info()[1].message)
+        return False
+    logger.info("Using the '" + options['backend'].name + "' image backend.")
+    return True
+
+def setup_format(format):
+    '''Chooses the format finished images are converted to. Returns True if
+    it can be used.
+    '''
+    try:
+        automagic_imaging.images.check_format(format)
+    except:
+        logger.error(sys.exc_info()[1].message)
+        return False
+    options['format'] = format
+    logger.info("Converting images to '" + format + "'.")
+    if automagic_imaging.compression.parse(format):
+        # Fork the compressing processes now, before any threads are started.
+        automagic_imaging.compression.start()
+    return True
+
+def setup_ready_timeout(seconds):
+    '''Sets how long to wait for a volume to be ready (or to unmount after a
+    failure) before giving up. Returns True if 'seconds' is valid.
+    '''
+    try:
+        seconds = float(seconds)
+        if seconds <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        logger.error("Invalid ready timeout: '" + str(seconds) + "'")
+        return False
+    options['ready_timeout'] = seconds
+    return True
+
+def setup_stall(seconds=None, retries=None):
+    '''Sets how long ktcheck or lapply may go without making progress before
+    it is stopped (0 for never), and how many more times a stalled stage is
+    tried. Either can be None to leave the default (see
+    scripts.radmind.defaults). Returns True if the values are valid.
+    '''
+    try:
+        if seconds is not None:
+            seconds = float(seconds)
+            if seconds < 0:
+                raise ValueError
+            options['stall_timeout'] = seconds
+    except (TypeError, ValueError):
+        logger.error("Invalid stall timeout: '" + str(seconds) + "'")
+        return False
+    try:
+        if retries is not None:
+            retries = int(retries)
+            if retries < 0:
+                raise ValueError
+            options['stall_retries'] = retries
+    except (TypeError, ValueError):
+        logger.error("Invalid number of stall retries: '" + str(retries) + "'")
+        return False
+    return True
+
+def setup_archive(path):
+    '''Opens the image archive at 'path'. Returns True if it can be used.'''
+    try:
+        options['archive'] = automagic_imaging.archive.Archive(path)
+    except:
+        logger.error("Could not use the archive at '" + str(path) + "': " + str(sys.exc_info()[1]))
+        return False
+    for name in options['archive'].broken:
+        logger.error("The archived image '" + name + "' is missing chunks and was left out of the archive.")
+    stats = options['archive'].stats()
+    logger.info("Archiving images at '" + options['archive'].path + "' (" + str(stats.images) + " image(s), " +
+                str(stats.stored) + " bytes stored).")
+    return True
+
+def restore_image(name, out_dir):
+    '''Rebuilds the archived image 'name' in 'out_dir' (or the current
+    directory). Returns True if it was restored.
+    '''
+    if not options['archive']:
+        logger.error("An archive must be given with '--archive-dir' to restore from.")
+        return False
+    outfile = os.path.join(out_dir or os.getcwd(), name)
+    if os.path.exists(outfile):
+        logger.error("Will not restore over '" + outfile + "'.")
+        return False
+    logger.info("Restoring '" + name + "' to '" + outfile + "'...")
+    try:
+        options['archive'].restore(name, outfile)
+    except:
+        logger.error("Could not restore '" + name + "': " + str(sys.exc_info()[1]))
+        return False
+    logger.info("Image restored.")
+    return True
+
+def decompress_image(path, out_dir):
+    '''Decompresses the chunked image at 'path' to an image that can be
+    restored, named without the chunked extension, in 'out_dir' (or beside
+    it). Returns True if it was decompressed.
+    '''
+    extension = automagic_imaging.compression.extension
+    if not path.endswith(extension) or not automagic_imaging.compression.is_chunked(path):
+        logger.error("'" + path + "' is not a chunked image.")
+        return False
+    outfile = os.path.join(out_dir or os.path.dirname(os.path.abspath(path)),
+                           os.path.basename(path)[:-len(extension)])
+    if os.path.exists(outfile):
+        logger.error("Will not decompress over '" + outfile + "'.")
+        return False
+    logger.info("Decompressing '" + path + "' to '" + outfile + "'...")
+    try:
+        stats = automagic_imaging.compression.decompress(path, outfile)
+    except:
+        logger.error("Could not decompress '" + path + "': " + str(sys.exc_info()[1]))
+        return False
+    logger.info("Image decompressed: " + str(stats.bytes) + " bytes in " + str(round(stats.elapsed, 2)) + "s.")
+    return True
+
+def record_result(image, function, *args, **kwargs):
+    '''Runs 'function' and records whether it succeeded for 'image'.'''
+    try:
+        options['results'][image] = bool(function(*args, **kwargs))
+    except:
+        options['results'][image] = False
+
+def produce_image(**overrides):
     '''Makes a call to 'image_producer' using the values in 'options'. This
     saves time and typing, since all of the values are generally stored here
-    anyway.
+    anyway. Any keyword arguments given take precedence over 'options' (this
+    lets concurrent builds avoid sharing the per-image values).
+
+    Returns True if the image was produced successfully.
     '''
 
+    values = {
+        'tmp_dir':      options['tmp_dir'],
+        'out_dir':      options['out_dir'],
+        'rserver':      options['rserver'],
+        'cert':         options['cert'],
+        'image':        options['image'],
+        'volname':      options['volname'],
+        'persist':      options['persist'],
+        'persist_fail': options['persist-fail'],
+        'sparse':       options['sparse'],
+        'limiter':      options['limiter'],
+        'pipeline':     options['finisher'],
+        'cache':        options['cache'],
+        'warm_start':   options['warm_start'],
+        'skip_unchanged': options['skip_unchanged'],
+        'metrics':      options['metrics'],
+        'backend':      options['backend'],
+        'format':       options['format'],
+        'archive':      options['archive'],
+        'image_type':   'SPARSEBUNDLE' if options['sparsebundle'] else 'SPARSE',
+        'compact':      options['compact'],
+        'resume':       options['resume'],
+        'ready_timeout': options['ready_timeout'],
+        'stall_timeout': options['stall_timeout'],
+        'stall_retries': options['stall_retries']
+    }
+    values.update(overrides)
+
     try:
-        image_producer(
-            tmp_dir      = options['tmp_dir'],
-            out_dir      = options['out_dir'],
-            rserver      = options['rserver'],
-            cert         = options['cert'],
-            image        = options['image'],
-            volname      = options['volname'],
-            persist      = options['persist'],
-            persist_fail = options['persist-fail'],
-            sparse       = options['sparse']
-        )
+        return image_producer(**values)
     except:
         logger.error(sys.exc_info()[1].message)
+        automagic_imaging.space.reserved.release(values['image'])
         raise Exception
 
 def image_producer(tmp_dir, out_dir, rserver, cert, image, volname,
-                   persist=False, persist_fail=False, sparse=None):
-    '''Creates an image and fills its filesystem from radmind.'''
-    options['total_count'] += 1
+                   persist=False, persist_fail=False, sparse=None, limiter=None,
+                   pipeline=None, cache=None, warm_start=False,
+                   skip_unchanged=False, base=None, metrics=None, backend=None,
+                   format=None, archive=None, image_type='SPARSE', compact=True,
+                   resume=False, ready_timeout=None, stall_timeout=None,
+                   stall_retries=None):
+    '''Creates an image and fills its filesystem from radmind.
+
+    Returns True if the image was produced successfully and False if any step
+    failed. Invalid arguments raise a ValueError.
+
+    This does not change the working directory, so several images can be
+    produced at the same time from different threads. If a 'limiter' is given,
+    each stage waits for a slot of its resource class (network, disk or cpu)
+    before it runs. If a 'pipeline' is given, the image is handed to it for
+    conversion and scanning once it has been unmounted, and this returns as soon
+    as it has been queued; the pipeline then holds the final result. If a
+    'cache' is given, radmind client files and downloaded files are reused from
+    and added to it. With 'warm_start', the last sparse image that was built
+    successfully for this image (as recorded in 'tmp_dir') is reused as-is, so
+    that radmind only has to apply what has changed since. With
+    'skip_unchanged', nothing is built if radmind has nothing new for this
+    image since its last successful build; the last image is reused instead.
+
+    Before anything is built, the transcripts are downloaded (outside of the
+    image) to estimate its size, and the space it needs is reserved in
+    'tmp_dir' and 'out_dir' (see preflight()). An image that can't fit isn't
+    started, and the sparse image is created with the estimated size plus
+    headroom.
+
+    If a 'base' image name is given, the sparse image that was built for it in
+    'tmp_dir' is opened with a shadow file instead of creating a blank one. The
+    base image is left untouched: only the differences radmind applies for
+    this image are written (to the shadow file), and both are combined when
+    the image is converted. The base must have been built, and kept, first.
+
+    The wall time and bytes processed of each stage are recorded in 'metrics'
+    (a metrics.Metrics), if given. Images are made with 'backend' (an
+    images.Backend), or with the OS X disk image tools if it isn't given, and
+    converted to 'format' (see finish_image()). Finished images are also
+    stored in 'archive' (an archive.Archive), if given.
+
+    New images are of the kind 'image_type' ('SPARSE' or 'SPARSEBUNDLE'; see
+    images.image_types). Unless 'compact' is False, the image is compacted
+    before it is converted.
+
+    Each stage is recorded in a journal in 'tmp_dir' as it completes (see
+    journal.Journal), along with what it produced. With 'resume', a build that
+    failed before (and whose sparse image was kept) carries on after the last
+    stage it completed, once the earlier stages' results have been checked
+    (see resumable() and verify_stages()); otherwise it starts over.
+
+    Rather than pausing for a fixed time, the volume is checked until it is
+    ready to be blessed, and a failed unmount is tried again, with growing
+    pauses in between (see polling), for up to 'ready_timeout' seconds each
+    (default: polling.default_deadline). The time spent waiting is recorded in
+    'metrics' as the stages 'wait-bless' and 'failure-unmount'.
+
+    If ktcheck or lapply goes 'stall_timeout' seconds without printing
+    anything or writing to the volume (such as on a dead connection to
+    'rserver'), it is stopped along with everything it started, and the stage
+    is tried up to 'stall_retries' more times before the image fails (see
+    retry_stalled(); the defaults are in scripts.radmind.defaults). The
+    image's worker is then free for the next image.
+    '''
+    logger = ImageLogger(image)
+    if not limiter:
+        limiter = automagic_imaging.scheduler.ResourceLimiter()
+    if not metrics:
+        metrics = automagic_imaging.metrics.Metrics()
     # All options must be non-empty.
     if not tmp_dir:
         raise ValueError("No temporary directory given.")
@@ -253,276 +800,1026 @@ def image_producer(tmp_dir, out_dir, rserver, cert, image, volname,
     # Start logging for this image.
     logger.info("--------------------------------------------------------------------------------")
     logger.info("Using settings:")
-    logger.info("    tmp_dir      = '" + tmp_dir + "'")
-    logger.info("    out_dir      = '" + out_dir + "'")
-    logger.info("    rserver      = '" + rserver + "'")
-    logger.info("    cert         = '" + cert + "'")
-    logger.info("    image        = '" + image + "'")
-    logger.info("    volname      = '" + volname + "'")
-    logger.info("    persist-all  = '" + str(persist) + "'")
-    logger.info("    persist-fail = '" + str(persist_fail) + "'")
-    logger.info("    sparse       = '" + str(sparse) + "'")
+    logger.info("    tmp_dir        = '" + tmp_dir + "'")
+    logger.info("    out_dir        = '" + out_dir + "'")
+    logger.info("    rserver        = '" + rserver + "'")
+    logger.info("    cert           = '" + cert + "'")
+    logger.info("    image          = '" + image + "'")
+    logger.info("    volname        = '" + volname + "'")
+    logger.info("    persist-all    = '" + str(persist) + "'")
+    logger.info("    persist-fail   = '" + str(persist_fail) + "'")
+    logger.info("    sparse         = '" + str(sparse) + "'")
+    logger.info("    warm-start     = '" + str(warm_start) + "'")
+    logger.info("    skip-unchanged = '" + str(skip_unchanged) + "'")
+    logger.info("    base           = '" + str(base) + "'")
+    logger.info("    resume         = '" + str(resume) + "'")
+    logger.info("    ready-timeout  = '" + str(ready_timeout) + "'")
+    logger.info("    stall-timeout  = '" + str(stall_timeout) + "'")
     logger.info("Processing image '" + image + "'")
-    # Change directory to the temporary location.
+    state = None
+    if warm_start or skip_unchanged:
+        state = automagic_imaging.state.in_directory(tmp_dir)
+    # What to remember about this build once it has been finished.
+    record = {}
+
+    base_path = None
+    shadow_path = None
+    if base:
+        base_path = automagic_imaging.images.image_path(tmp_dir, base, image_type)
+        shadow_path = os.path.join(tmp_dir, image + '.shadow')
+
+    # The stages completed by an earlier build that can be skipped, in order.
+    journal = automagic_imaging.journal.Journal(automagic_imaging.journal.journal_path(tmp_dir, image))
+    skip = []
+    if resume:
+        skip = resumable(journal, base_path, logger)
+    if not skip:
+        journal.start(base=base_path, base_mtime=base_path and os.path.exists(base_path) and
+                      os.path.getmtime(base_path))
+
+    if stall_retries is None:
+        stall_retries = automagic_imaging.scripts.radmind.defaults['stall_retries']
+
+    checked = None
+    if skip_unchanged:
+        checked = os.path.join(tmp_dir, image + '.radmind')
+        extra = []
+        if base_path and os.path.exists(base_path):
+            # A rebuilt base means this image must be rebuilt too.
+            extra = [os.path.getmtime(base_path), automagic_imaging.images.allocated(base_path)]
+        try:
+            fingerprint = check_unchanged(image, volname, out_dir, checked, cert,
+                                          rserver, state, limiter, cache, extra, archive,
+                                          stall_timeout, stall_retries)
+        except:
+            logger.error(sys.exc_info()[1].message)
+            logger.error("Image '" + image + "' did not complete successfully.")
+            return False
+        if not fingerprint:
+            logger.info("Successfully finished '" + image + "' (unchanged).")
+            return True
+        record['fingerprint'] = fingerprint
+        record['checked'] = checked
+
+    # Make sure there is room for the image before starting on it, and size
+    # the sparse image to fit.
+    size = None
+    existing = ((skip and journal.get('sparse')) or sparse or base_path or
+                (state and state.get(image).get('sparse')))
     try:
-        with ChDir(tmp_dir):
-            i = None
-            if sparse:
-                # The sparse image already exists; use that instead
-                logger.info("Attempting to use image '" + sparse + "'...")
-                try:
-                    i = automagic_imaging.images.Image(path=sparse)
-                except:
-                    logger.error(sys.exc_info()[1].message)
-                    logger.error("Creating blank sparse image instead.")
-            if not i:
-                # If no image is being used already, create a blank sparse image
-                logger.info("Creating image named '" + image + "'...")
-                try:
-                    i = automagic_imaging.images.Image(make=True, name=image, volume=volname)
-                except:
-                    logger.error(sys.exc_info()[1].message)
-                    raise WithBreaker()
-                logger.info("Created image '" + i.path + "'")
+        if not checked:
+            checked = os.path.join(tmp_dir, image + '.radmind')
+            logger.info("Downloading the command files and transcripts to estimate the image size...")
+            check_client(image, checked, cert, rserver, limiter, cache, stall_timeout, stall_retries)
+        estimate = preflight(image, tmp_dir, out_dir, os.path.join(checked, 'check', 'private/var/radmind/client'),
+                             existing, format, state and state.get(image).get('image'))
+        size = estimate.sparse_size()
+    except RuntimeError:
+        logger.error(str(sys.exc_info()[1]))
+        logger.error("Image '" + image + "' did not complete successfully.")
+        return False
+    except:
+        # Build it anyway, as if there were no estimate.
+        logger.error("Could not estimate the size of the image: " + str(sys.exc_info()[1]))
+
+    # Keep the sparse image for the next warm start (shadow files aren't warm
+    # started, so they only stay when persisting).
+    keep = persist or (warm_start and not base)
+
+    if 'unmount' in skip:
+        # The volume was finished; only converting it (and what follows) is
+        # left. The sparse image may already be gone if it was converted.
+        i = None
+        if os.path.exists(journal.get('sparse')):
+            try:
+                i = automagic_imaging.images.Image(path=journal.get('sparse'), shadow=journal.get('shadow'),
+                                                   backend=backend)
+            except:
+                logger.error(sys.exc_info()[1].message)
+                logger.error("Image '" + image + "' did not complete successfully.")
+                automagic_imaging.space.reserved.release(image)
+                return False
+        sparse_path = journal.get('shadow') or journal.get('sparse')
+        if warm_start and not base:
+            record['sparse'] = journal.get('sparse')
+        record['version'] = journal.get('version')
+        record['build'] = journal.get('build')
+        convert_name = journal.get('convert_name')
+        if pipeline:
+            logger.info("Queueing image for conversion and scanning...")
+            pipeline.submit(image, finish_image, image, i, sparse_path,
+                            convert_name, keep, limiter, state, record, metrics, format,
+                            archive, compact, journal, backend)
+            logger.info("Image queued.")
+            return True
+        return finish_image(image, i, sparse_path, convert_name, keep, limiter,
+                            state, record, metrics, format, archive, compact, journal, backend)
+
+    try:
+        i = None
+        warm = False
+        if skip:
+            # Carry on with the image the earlier build left behind.
+            logger.info("Resuming with image '" + journal.get('sparse') + "'...")
+            try:
+                i = automagic_imaging.images.Image(path=journal.get('sparse'), shadow=journal.get('shadow'),
+                                                   backend=backend)
+            except:
+                logger.error(sys.exc_info()[1].message)
+                logger.error("Image '" + image + "' did not complete successfully.")
+                automagic_imaging.space.reserved.release(image)
+                return False
+            warm = bool(journal.get('warm'))
+        elif sparse:
+            # The sparse image already exists; use that instead
+            logger.info("Attempting to use image '" + sparse + "'...")
+            try:
+                i = automagic_imaging.images.Image(path=sparse, backend=backend)
+            except:
+                logger.error(sys.exc_info()[1].message)
+                logger.error("Creating blank sparse image instead.")
+        elif base:
+            # Layer this image on top of its base with a shadow file.
+            logger.info("Attempting to use base image '" + base_path + "'...")
+            if os.path.isfile(shadow_path):
+                # Left over from an earlier build; start again from the base.
+                os.remove(shadow_path)
+            try:
+                i = automagic_imaging.images.Image(path=base_path, shadow=shadow_path,
+                                                   backend=backend)
+            except:
+                logger.error(sys.exc_info()[1].message)
+                logger.error("Image '" + image + "' did not complete successfully.")
+                automagic_imaging.space.reserved.release(image)
+                return False
+            logger.info("Writing changes to shadow file '" + shadow_path + "'")
+        elif state:
+            # Reuse the last good sparse image for this image, if it's sound.
+            previous = state.get(image).get('sparse')
+            if previous:
+                logger.info("Attempting to warm start from '" + previous + "'...")
+                i = warm_image(previous, limiter, logger, backend)
+                if i:
+                    warm = True
+                    logger.info("Warm starting from '" + i.path + "'")
+                else:
+                    logger.error("Building from a blank sparse image instead.")
+            else:
+                logger.info("No previous image to warm start from.")
+        if not i:
+            # If no image is being used already, create a blank sparse image
+            # in the temporary location.
+            logger.info("Creating image named '" + image + "'" + (" with a size of " + size if size else "") + "...")
+            try:
+                with limiter.stage('create'), metrics.stage(image, 'create') as stage:
+                    i = automagic_imaging.images.Image(make=True,
+                                                       name=os.path.join(tmp_dir, image),
+                                                       volume=volname,
+                                                       backend=backend,
+                                                       size=size,
+                                                       type=image_type)
+                    stage.bytes = automagic_imaging.images.allocated(i.path)
+            except:
+                logger.error(sys.exc_info()[1].message)
+                raise WithBreaker()
+            logger.info("Created image '" + i.path + "'")
+        sparse_path = i.path
+        if base:
+            # The base must stay; only the shadow file belongs to this image.
+            sparse_path = shadow_path
+        elif warm_start:
+            record['sparse'] = sparse_path
+        automagic_imaging.space.reserved.using(image, sparse_path)
+        if not skip:
+            journal.update(sparse=i.path, shadow=i.shadow, warm=warm)
+            journal.complete('create', image=i.path)
 
-            # Mount sparse image to write to
+        # Mount sparse image to write to
+        if not i.mounted:
             logger.info("Mounting image...")
             try:
-                i.mount()
+                with limiter.stage('mount'), metrics.stage(image, 'mount'):
+                    i.mount()
             except:
                 logger.error(sys.exc_info()[1].message)
                 raise WithBreaker()
             logger.info("Mounted image at '" + i.mount_point + "'")
 
-            # Enable ownership
-            logger.info("Enabling ownership of volume...")
-            try:
+        # Enable ownership
+        logger.info("Enabling ownership of volume...")
+        try:
+            with limiter.stage('enable_ownership'), metrics.stage(image, 'enable_ownership'):
                 i.enable_ownership()
+        except:
+            logger.error(sys.exc_info()[1].message)
+            raise WithBreaker(i)
+        logger.info("Volume ownership enabled.")
+        if skip:
+            # Don't trust what the earlier build left on the volume without
+            # checking it.
+            skip = verify_stages(journal, skip, i.mount_point, logger)
+
+        # Clean volume (unless warm starting or layering on a base, where the
+        # previous contents are kept so that radmind only applies the
+        # differences)
+        if 'clean' in skip:
+            logger.info("Skipping cleaning, which already completed.")
+        elif warm or base:
+            logger.info("Keeping the previous contents of the volume.")
+            journal.complete('clean', method='kept')
+        else:
+            logger.info("Emptying volume of all contents...")
+            try:
+                with limiter.stage('clean'), metrics.stage(image, 'clean'):
+                    reset = i.clean()
             except:
                 logger.error(sys.exc_info()[1].message)
                 raise WithBreaker(i)
-            logger.info("Volume ownership enabled.")
+            logger.info("Volume cleaned (" + reset.method + " " + str(reset.entries) +
+                        " entries in " + str(round(reset.elapsed, 2)) + "s).")
+            journal.complete('clean', method=reset.method)
+
+        # Radmind runs relative to the root of the mounted volume.
+        root = i.mount_point
+        radmind_log = os.path.join(root, 'private/var/log/radmind')
+        radmind_client = os.path.join(root, 'private/var/radmind/client')
+        logger.info("Beginning radmind cycle...")
+
+        if 'ktcheck' in skip:
+            logger.info("Skipping ktcheck, which already completed.")
+        else:
+            if cache:
+                # Start from the command files and transcripts of the last run
+                # so that ktcheck only downloads what has changed.
+                try:
+                    restored = cache.restore_client(image, radmind_client)
+                    logger.info("Restored " + str(restored) + " radmind client file(s) from the cache.")
+                except:
+                    logger.error("Could not restore client files from the cache: " + str(sys.exc_info()[1]))
+            if checked:
+                # The client files were just checked, so ktcheck won't need to
+                # download them again.
+                try:
+                    automagic_imaging.changes.copy(os.path.join(checked, 'check', 'private/var/radmind/client'),
+                                                   radmind_client)
+                except:
+                    logger.error("Could not copy the checked client files: " + str(sys.exc_info()[1]))
+
+            # ktcheck
+            logger.info("Running ktcheck...")
+            ktcheck_output = tool_output('ktcheck', logger)
+
+            def ktcheck():
+                with limiter.stage('ktcheck'), metrics.stage(image, 'ktcheck') as stage:
+                    automagic_imaging.scripts.radmind.run_ktcheck(
+                        cert=cert,
+                        rserver=rserver,
+                        output=ktcheck_output,
+                        root=root,
+                        stall=stall_timeout
+                    )
+                    stage.bytes = automagic_imaging.metrics.directory_size(radmind_client)
 
-            # Clean volume
-            logger.info("Emptying volume of all contents...")
             try:
-                i.clean()
+                retry_stalled(ktcheck, stall_retries, logger)
             except:
                 logger.error(sys.exc_info()[1].message)
+                error_output(ktcheck_output, logger)
                 raise WithBreaker(i)
-            logger.info("Volume cleaned.")
+            logger.info("Completed ktcheck.")
+            if cache:
+                try:
+                    cache.save_client(image, radmind_client)
+                except:
+                    logger.error("Could not save client files to the cache: " + str(sys.exc_info()[1]))
+            journal.complete('ktcheck', client=os.path.relpath(radmind_client, root))
 
+        # fsdiff
+        # fsdiff output goes to:
+        fsdiff_out = os.path.join(radmind_log, 'fsdiff_output.T')
+        if 'fsdiff' in skip:
+            logger.info("Skipping fsdiff, which already completed.")
+        else:
+            logger.info("Running fsdiff with output to '" + fsdiff_out + "'...")
+            fsdiff_output = tool_output('fsdiff', logger)
             try:
-                with ChDir(i.mount_point):
-                    # Radmind
-                    logger.info("Beginning radmind cycle...")
+                with limiter.stage('fsdiff'), metrics.stage(image, 'fsdiff') as stage:
+                    automagic_imaging.scripts.radmind.run_fsdiff(
+                        outfile=fsdiff_out,
+                        output=fsdiff_output,
+                        root=root
+                    )
+                    stage.bytes = os.path.getsize(fsdiff_out)
+            except:
+                logger.error(sys.exc_info()[1].message)
+                error_output(fsdiff_output, logger)
+                raise WithBreaker(i)
+            logger.info("Completed fsdiff.")
+            journal.complete('fsdiff', transcript=os.path.relpath(fsdiff_out, root),
+                             size=os.path.getsize(fsdiff_out))
 
-                    # ktcheck
-                    logger.info("Running ktcheck...")
-                    ktcheck_logfile = './private/var/log/radmind/imaging_ktcheck.log'
-                    try:
-                        automagic_imaging.scripts.radmind.run_ktcheck(
-                            cert=cert,
-                            rserver=rserver,
-                            logfile=ktcheck_logfile
-                        )
-                    except:
-                        logger.error(sys.exc_info()[1].message)
-                        error_log(ktcheck_logfile)
-                        raise WithBreaker(i)
-                    logger.info("Completed ktcheck.")
-
-                    # fsdiff
-                    # fsdiff output goes to:
-                    fsdiff_out = './private/var/log/radmind/fsdiff_output.T'
-                    logger.info("Running fsdiff with output to '" + os.path.abspath(fsdiff_out) + "'...")
-                    fsdiff_logfile = './private/var/log/radmind/imaging_fsdiff.log'
-                    try:
-                        automagic_imaging.scripts.radmind.run_fsdiff(
-                            outfile=fsdiff_out,
-                            logfile=fsdiff_logfile
-                        )
-                    except:
-                        logger.error(sys.exc_info()[1].message)
-                        error_log(fsdiff_logfile)
-                        raise WithBreaker(i)
-                    logger.info("Completed fsdiff.")
+        # Move fsdiff output for lapply (for redundancy)
+        lapply_in = os.path.join(radmind_log, 'lapply_input.T')
+        if 'lapply' in skip:
+            logger.info("Skipping lapply, which already completed.")
+        else:
+            seeded = False
+            if cache:
+                # Place the files that are already cached, and leave only the
+                # rest in lapply's input.
+                logger.info("Placing cached files...")
+                try:
+                    stats = cache.seed(fsdiff_out, lapply_in, root)
+                    seeded = True
+                    logger.info("The cache supplied " + str(stats.files['hit']) + " file(s) (" +
+                                str(stats.bytes['hit']) + " bytes); lapply will download " +
+                                str(stats.files['miss']) + " file(s) (" + str(stats.bytes['miss']) + " bytes).")
+                except:
+                    logger.error("Could not place cached files: " + str(sys.exc_info()[1]))
+            if not seeded:
+                try:
+                    automagic_imaging.processes.call(['cp', fsdiff_out, lapply_in])
+                except:
+                    logger.error("Could not copy '" + fsdiff_out + "' to '" + lapply_in + "'")
+                    raise WithBreaker(i)
 
-                    # Move fsdiff output for lapply (for redundancy)
-                    lapply_in = './private/var/log/radmind/lapply_input.T'
-                    try:
-                        subprocess.call(['cp', fsdiff_out, lapply_in])
-                    except:
-                        logger.error("Could not copy '" + fsdiff_out + "' to '" + lapply_in + "'")
-                        raise WithBreaker(i)
+            # lapply
+            logger.info("Running lapply with input from '" + lapply_in + "'...")
+            lapply_output = tool_output('lapply', logger)
 
-                    # lapply
-                    logger.info("Running lapply with input from '" + os.path.abspath(lapply_in) + "'...")
-                    lapply_logfile = './private/var/log/radmind/imaging_lapply.log'
-                    try:
-                        automagic_imaging.scripts.radmind.run_lapply(
-                            cert=cert,
-                            rserver=rserver,
-                            infile=lapply_in,
-                            logfile=lapply_logfile
-                        )
-                    except:
-                        logger.error(sys.exc_info()[1].message)
-                        error_log(lapply_logfile)
-                        raise WithBreaker(i)
-                    logger.info("Completed lapply.")
-
-                    # Get the system's OS version and build version for file naming.
-                    # (This is the file used by `/usr/bin/sw_vers`)
-                    version_command = [
-                        'defaults',
-                        'read',
-                        os.path.abspath('./System/Library/CoreServices/SystemVersion'),
-                        'ProductVersion'
-                    ]
-                    build_command = [
-                        'defaults',
-                        'read',
-                        os.path.abspath('./System/Library/CoreServices/SystemVersion'),
-                        'ProductBuildVersion'
-                    ]
-                    version = subprocess.check_output(version_command).strip('\n')
-                    logger.info("Using system version: " + version)
-                    build = subprocess.check_output(build_command).strip('\n')
-                    logger.info("Using system build version: " + build)
-
-                    # Declare the disk label here. '$VERSION' is replaced with
-                    # the OS version number and '$BUILD' with the build number.
-                    # This is used in post-maintenance, renaming, and blessing.
-                    disk_label = volname.replace('$VERSION', version).replace('$BUILD', build)
-
-                    # Xhooks post-maintenance
-                    logger.info("Beginning post-maintenance...")
-                    try:
-                        automagic_imaging.scripts.radmind.run_post_maintenance(disk_label)
-                    except:
-                        logger.error(sys.exc_info()[1].message)
-                        raise WithBreaker(i)
-                    logger.info("Completed post-maintenance.")
-            except WithBreaker as e:
-                raise WithBreaker(e.image)
-
-            # Rename the volume if needed
-            if i.name != disk_label:
-                logger.info("Renaming volume to '" + disk_label + "'...")
+            def lapply():
+                with limiter.stage('lapply'), metrics.stage(image, 'lapply') as stage:
+                    automagic_imaging.scripts.radmind.run_lapply(
+                        cert=cert,
+                        rserver=rserver,
+                        infile=lapply_in,
+                        output=lapply_output,
+                        root=root,
+                        stall=stall_timeout
+                    )
+                    stage.bytes = automagic_imaging.metrics.downloaded_bytes(lapply_in)
+
+            try:
+                retry_stalled(lapply, stall_retries, logger)
+            except:
+                logger.error(sys.exc_info()[1].message)
+                error_output(lapply_output, logger)
+                raise WithBreaker(i)
+            logger.info("Completed lapply.")
+            if cache:
+                logger.info("Adding downloaded files to the cache...")
                 try:
-                    i.rename(disk_label)
+                    collected = cache.collect(lapply_in, root)
+                    logger.info("Added " + str(collected) + " file(s) to the cache.")
                 except:
-                    logger.error(sys.exc_info()[1].message)
-                    raise WithBreaker(i)
-                logger.info("Volume renamed.")
+                    logger.error("Could not add files to the cache: " + str(sys.exc_info()[1]))
+            journal.complete('lapply', transcript=os.path.relpath(lapply_in, root))
 
-            # Bless volume to make it mountable
-            logger.info("Blessing volume...")
+        # Get the system's OS version and build version for file naming.
+        try:
+            version, build = automagic_imaging.images.system_version(root)
+            logger.info("Using system version: " + version)
+            logger.info("Using system build version: " + build)
+        except:
+            logger.error("Could not read the system version from the volume.")
+            raise WithBreaker(i)
+
+        # Declare the disk label here. '$VERSION' is replaced with
+        # the OS version number and '$BUILD' with the build number.
+        # This is used in post-maintenance, renaming, and blessing.
+        disk_label = volname.replace('$VERSION', version).replace('$BUILD', build)
+        record['version'] = version
+        record['build'] = build
+        journal.update(version=version, build=build)
+
+        # Xhooks post-maintenance
+        if 'post-maintenance' in skip:
+            logger.info("Skipping post-maintenance, which already completed.")
+        else:
+            logger.info("Beginning post-maintenance...")
             try:
-                time.sleep(10)
-                i.bless(disk_label)
+                with limiter.stage('post-maintenance'), metrics.stage(image, 'post-maintenance'):
+                    automagic_imaging.scripts.radmind.run_post_maintenance(disk_label, root=root)
             except:
                 logger.error(sys.exc_info()[1].message)
                 raise WithBreaker(i)
-            logger.info("Volume blessed.")
+            logger.info("Completed post-maintenance.")
+            journal.complete('post-maintenance')
 
-            # Unmount volume for conversion
-            logger.info("Unmounting volume...")
+        # Rename the volume if needed
+        if i.name != disk_label:
+            logger.info("Renaming volume to '" + disk_label + "'...")
             try:
-                try:
-                    i.unmount()
-                except:
-                    failure_unmount(i)
+                with limiter.stage('rename'), metrics.stage(image, 'rename'):
+                    i.rename(disk_label)
             except:
                 logger.error(sys.exc_info()[1].message)
                 raise WithBreaker(i)
-            logger.info("Volume unmounted.")
+            logger.info("Volume renamed.")
 
-            # Craft new file name in the form:
-            # {out_dir}/YYYY.mm.dd_IMAGENAME_OSVERSION_OSBUILD.dmg
-            date = datetime.datetime.now().strftime('%Y.%m.%d')
-            convert_name = out_dir + '/' + date + '_' + image.upper() + '_' + version + '_' + build + '.dmg'
-            # Convert from .sparseimage to read-only .dmg
-            logger.info("Converting image to read-only at '" + convert_name + "'")
+        # Bless volume to make it mountable
+        if 'bless' in skip:
+            logger.info("Skipping blessing, which already completed.")
+        else:
+            logger.info("Blessing volume...")
             try:
-                i.convert(format='UDZO-9', outfile=convert_name)
+                # Renaming the volume remounts it; wait only as long as that
+                # takes, and recheck right away if it's already there.
+                with metrics.stage(image, 'wait-bless'):
+                    automagic_imaging.polling.until(i.ready, ready_timeout,
+                                                    "the volume '" + disk_label + "' to be mounted")
+                with limiter.stage('bless'), metrics.stage(image, 'bless'):
+                    automagic_imaging.polling.retry(
+                        lambda: i.bless(disk_label), ready_timeout, automagic_imaging.images.Busy,
+                        lambda error: logger.info("Could not bless the volume yet (" + str(error) +
+                                                  "); trying again.")
+                    )
             except:
                 logger.error(sys.exc_info()[1].message)
-                raise WithBreaker()
-            logger.info("Image converted.")
+                raise WithBreaker(i)
+            logger.info("Volume blessed.")
+            journal.complete('bless', label=disk_label)
 
-            # Remove sparse image if not persisting
-            if not persist:
-                logger.info("Removing original sparse image...")
+        # Unmount volume for conversion
+        logger.info("Unmounting volume...")
+        try:
+            with limiter.stage('unmount'), metrics.stage(image, 'unmount'):
                 try:
-                    os.remove('./' + image + '.sparseimage')
+                    i.unmount()
+                except:
+                    failure_unmount(i, ready_timeout)
+        except:
+            logger.error(sys.exc_info()[1].message)
+            raise WithBreaker(i)
+        logger.info("Volume unmounted.")
+
+        # Craft new file name in the form:
+        # {out_dir}/YYYY.mm.dd_IMAGENAME_OSVERSION_OSBUILD.dmg
+        date = datetime.datetime.now().strftime('%Y.%m.%d')
+        convert_name = out_dir + '/' + date + '_' + image.upper() + '_' + version + '_' + build + '.dmg'
+        # A resumed build is converted to the same name, even on another day.
+        journal.update(convert_name=convert_name)
+        journal.complete('unmount')
+
+        if pipeline:
+            # Let the conversion and scan happen in the background so that the
+            # next image can begin its radmind cycle in the meantime.
+            logger.info("Queueing image for conversion and scanning...")
+            pipeline.submit(image, finish_image, image, i, sparse_path,
+                            convert_name, keep, limiter, state, record, metrics, format,
+                            archive, compact, journal, backend)
+            logger.info("Image queued.")
+            return True
+    except WithBreaker as e:
+        # If there was a problem previously, unmount the image and remove it
+        # (unless it should be kept around).
+        logger.error("Image '" + image + "' did not complete successfully.")
+        automagic_imaging.space.reserved.release(image)
+        with metrics.stage(image, 'failure-unmount'):
+            failure_unmount(e.image, ready_timeout)
+        # Only the shadow file belongs to a layered image, never the base.
+        path = e.image and (e.image.shadow or e.image.path)
+        if path and not persist_fail and os.path.exists(path):
+            if e.image.mounted:
+                logger.error("Image file '" + path + "' was not deleted because it is still mounted!")
+            else:
+                automagic_imaging.images.delete(path)
+                logger.error("Image file '" + path + "' deleted.")
+                # Nothing is left to resume.
+                journal.clear()
+        return False
+
+    return finish_image(image, i, sparse_path, convert_name, keep, limiter,
+                        state, record, metrics, format, archive, compact, journal, backend)
+
+def finish_image(image, i, sparse_path, convert_name, persist=False, limiter=None,
+                 state=None, record=None, metrics=None, format=None, archive=None,
+                 compact=True, journal=None, backend=None):
+    '''Converts the unmounted image 'i' to a compressed, read-only image at
+    'convert_name', scans it for asr, and writes its checksums beside it (see
+    checksums.Manifest). These stages only need the processor and the output
+    disk, so they can be run in the background by a Pipeline.
+    If a 'state' is given, the values in 'record' are recorded in it once the
+    image has been finished (see record_success()). The stages are recorded
+    in 'metrics', if given.
+
+    The image is converted to 'format' (default: 'UDZO-9'). With a chunked
+    format such as 'zlib-9' or 'auto', it is compressed in chunks on every
+    core instead, and the name of the result ends in '.chunked'.
+
+    Unless 'compact' is False, the space the volume no longer uses is given
+    back first (not for shadow files), so that the conversion doesn't read it.
+
+    If an 'archive' is given, the finished image is added to it, and the older
+    images of the same name that it already holds are removed from the output
+    directory (see archive_image()).
+
+    Each stage is recorded in 'journal' (a journal.Journal), if given, and the
+    journal is removed once the image is finished. If it shows that the image
+    was already converted (or scanned) by an earlier build, and the result is
+    still there, that isn't done again; then 'i' may be None, since the sparse
+    image may be gone, and the scan is done with 'backend'. If the result has
+    gone missing, the image recorded in the journal is converted again if it
+    is still there; otherwise the journal is cleared so that the next build
+    starts over.
+
+    Returns True if the image was finished successfully.
+    '''
+    logger = ImageLogger(image)
+    if not limiter:
+        limiter = automagic_imaging.scheduler.ResourceLimiter()
+    if not metrics:
+        metrics = automagic_imaging.metrics.Metrics()
+    if i:
+        backend = i.backend
+    elif not backend:
+        backend = automagic_imaging.images.default_backend
+
+    try:
+        # A resumed build may have been converted already.
+        converted = completed_output(journal, 'convert')
+        if converted:
+            convert_name = converted['outfile']
+            logger.info("Skipping conversion; '" + convert_name + "' was already converted.")
+        else:
+            if not i and journal and os.path.exists(journal.get('sparse') or ''):
+                # The earlier build's conversion has gone missing since, but
+                # the image it was converted from is still there.
+                try:
+                    i = automagic_imaging.images.Image(path=journal.get('sparse'), shadow=journal.get('shadow'),
+                                                       backend=backend)
                 except:
                     logger.error(sys.exc_info()[1].message)
                     raise WithBreaker()
-                logger.info("Image removed.")
+            if not i:
+                # Neither is left to convert, so start over next time.
+                logger.error("The converted image and the image it was converted from are both gone.")
+                if journal:
+                    journal.clear()
+                raise WithBreaker()
 
-            # Scan image for ASR use
+            # Give back freed space so that the conversion doesn't have to read
+            # it
+            reclaimed = 0
+            if compact and not i.shadow:
+                logger.info("Compacting image...")
+                try:
+                    with limiter.stage('compact'), metrics.stage(image, 'compact') as stage:
+                        result = i.compact()
+                        stage.bytes = result.before
+                    reclaimed = result.reclaimed()
+                    logger.info("Image compacted: reclaimed " + str(reclaimed) + " of " + str(result.before) +
+                                " bytes in " + str(round(stage.elapsed, 2)) + "s.")
+                except:
+                    # The image can still be converted as it is.
+                    logger.error("Could not compact the image: " + str(sys.exc_info()[1]))
+
+            # Convert from the sparse image to read-only .dmg
+            logger.info("Converting image to read-only at '" + convert_name + "'")
+            for path in [convert_name, convert_name + automagic_imaging.compression.extension]:
+                automagic_imaging.space.reserved.using(image, path)
+            try:
+                with limiter.stage('convert'), metrics.stage(image, 'convert') as stage:
+                    stage.bytes = automagic_imaging.images.allocated(i.path)
+                    if i.shadow:
+                        stage.bytes += automagic_imaging.images.allocated(i.shadow)
+                    i.convert(format=format or 'UDZO-9', outfile=convert_name)
+            except:
+                logger.error(sys.exc_info()[1].message)
+                raise WithBreaker()
+            if reclaimed and stage.throughput():
+                # Conversion reads the whole image, so estimate what reading the
+                # reclaimed space would have cost at the rate it just ran at.
+                logger.info("Converted " + str(stage.bytes) + " bytes in " + str(round(stage.elapsed, 2)) +
+                            "s; compacting saved about " + str(round(reclaimed / stage.throughput(), 2)) + "s.")
+            if automagic_imaging.compression.is_chunked(i.path):
+                convert_name = i.path
+                values = automagic_imaging.compression.info(convert_name)
+                logger.info("Image compressed in chunks with " + values['codec'] + "-" + str(values['level']) +
+                            " at '" + convert_name + "'.")
+            logger.info("Image converted.")
+            if journal:
+                journal.complete('convert', outfile=convert_name, size=os.path.getsize(convert_name))
+
+        # Remove sparse image if not persisting
+        if not persist and os.path.exists(sparse_path):
+            logger.info("Removing original sparse image...")
+            try:
+                automagic_imaging.images.delete(sparse_path)
+            except:
+                logger.error(sys.exc_info()[1].message)
+                raise WithBreaker()
+            logger.info("Image removed.")
+
+        # Scan image for ASR use
+        if completed_output(journal, 'scan'):
+            logger.info("Skipping the asr scan, which already completed.")
+        else:
             logger.info("Scanning image for asr use...")
             try:
-                automagic_imaging.images.scan(convert_name)
+                with limiter.stage('scan'), metrics.stage(image, 'scan') as stage:
+                    backend.scan(convert_name)
+                    stage.bytes = os.path.getsize(convert_name)
             except:
                 logger.error(sys.exc_info()[1].message)
                 raise WithBreaker()
             logger.info("Image scanned.")
+            if journal:
+                # Scanning adds to the image, so the size to check it by
+                # changes.
+                journal.complete('scan', outfile=convert_name, size=os.path.getsize(convert_name))
 
-            # Done
-            logger.info("Successfully finished '" + image + "'.")
-            options['success_count'] += 1
-    except WithBreaker as e:
-        # Outside of the with, need to check if there's still an issue.
-        # If there was a problem previously, unmount the previous image.
-        # This is here because you can't unmount a volume while inside it...
+        # Record checksums so that copies of the image can be checked later
+        # (while the image is still in the cache from scanning it).
+        logger.info("Computing checksums...")
+        try:
+            with limiter.stage('checksum'), metrics.stage(image, 'checksum') as stage:
+                manifest = automagic_imaging.checksums.write(convert_name)
+                stage.bytes = manifest.size
+        except:
+            logger.error("Could not compute checksums: " + str(sys.exc_info()[1]))
+            raise WithBreaker()
+        logger.info("Checksums written to '" + automagic_imaging.checksums.manifest_path(convert_name) + "'.")
+
+        if archive:
+            try:
+                with limiter.stage('archive'), metrics.stage(image, 'archive') as stage:
+                    stage.bytes = archive_image(archive, image, convert_name, logger)
+            except:
+                logger.error("Could not archive the image: " + str(sys.exc_info()[1]))
+                raise WithBreaker()
+    except WithBreaker:
         logger.error("Image '" + image + "' did not complete successfully.")
-        failure_unmount(e.image)
-        if not persist_fail and os.path.isfile(e.image.path):
-            if e.image.mounted:
-                logger.error("Image file '" + e.image.path + "' was not deleted because it is still mounted!")
-            else:
-                os.remove(e.image.path)
-                logger.error("Image file '" + e.image.path + "' deleted.")
+        automagic_imaging.space.reserved.release(image)
+        return False
+    # The image no longer needs the space that was set aside for it.
+    automagic_imaging.space.reserved.release(image)
+
+    if state:
+        try:
+            record_success(state, image, convert_name, record)
+        except:
+            logger.error("Could not record the build for next time: " + str(sys.exc_info()[1]))
+
+    if journal:
+        # Nothing is left to resume.
+        journal.clear()
+
+    # Done
+    logger.info("Successfully finished '" + image + "'.")
+    return True
 
-def failure_unmount(image):
-    '''Attempt to unmount a volume/disk multiple times after a failure.'''
+def record_success(state, image, convert_name, record=None):
+    '''Records a successful build of 'image' (which produced 'convert_name') in
+    'state', along with the values in 'record':
+
+    sparse      - the sparse image, for the next warm start
+    version     - the OS version of the image
+    build       - the OS build of the image
+    fingerprint - the fingerprint of the radmind client files it was built from
+    checked     - where those client files were checked (see check_unchanged());
+                  they are kept to compare the next build against
+    '''
+    values = dict(record or {})
+    checked = values.pop('checked', None)
+    if checked:
+        automagic_imaging.changes.replace(os.path.join(checked, 'check'),
+                                          os.path.join(checked, 'last'))
+    values['image'] = convert_name
+    values['finished'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    state.update(image, **values)
+
+def resumable(journal, base_path, logger):
+    '''Returns the stages that the last build recorded in 'journal' completed,
+    in order, if it can be resumed: the image it was building (and its shadow
+    file) must still be there, unless it has already been converted, and its
+    base image ('base_path') must not have changed since. Otherwise, returns
+    an empty list so that the build starts over.
+    '''
+    stages = journal.completed()
+    if not stages:
+        logger.info("Nothing to resume; starting a new build.")
+        return []
+    base_mtime = base_path and os.path.exists(base_path) and os.path.getmtime(base_path)
+    if journal.get('base') != base_path or journal.get('base_mtime') != base_mtime:
+        logger.info("The base image has changed since the last attempt; starting over.")
+        return []
+    sparse = journal.get('sparse')
+    shadow = journal.get('shadow')
+    present = sparse and os.path.exists(sparse) and (not shadow or os.path.exists(shadow))
+    if not present and not completed_output(journal, 'convert'):
+        logger.info("The image from the last attempt is gone; starting over.")
+        return []
+    logger.info("Resuming the last attempt, which completed: " + ', '.join(stages) + ".")
+    return stages
+
+def verify_stages(journal, stages, root, logger):
+    '''Checks what each of the completed 'stages' (as recorded in 'journal')
+    left on the volume mounted at 'root', in order. Returns the stages up to
+    the first one that can't be trusted; it and every later stage are removed
+    from the journal, to be run again.
+
+    If fsdiff completed but lapply didn't, lapply may have changed the volume
+    part of the way through, so fsdiff's transcript no longer describes it;
+    fsdiff is run again as well.
+    '''
+    for n in range(len(stages)):
+        try:
+            verify_stage(stages[n], journal.artifacts(stages[n]), root)
+        except:
+            logger.info("Running " + stages[n] + " again: " + str(sys.exc_info()[1]))
+            journal.rewind(stages[n])
+            return stages[:n]
+    if 'fsdiff' in stages and 'lapply' not in stages:
+        logger.info("Running fsdiff again, since lapply may have changed the volume before it was interrupted.")
+        journal.rewind('fsdiff')
+        return stages[:stages.index('fsdiff')]
+    return stages
+
+def verify_stage(stage, artifacts, root):
+    '''Raises an exception if what 'stage' produced (its 'artifacts') on the
+    volume mounted at 'root' is missing or has changed. Stages that leave
+    nothing that can be checked are trusted.
+    '''
+    if stage == 'ktcheck':
+        client = os.path.join(root, artifacts['client'])
+        if not os.path.isfile(os.path.join(client, 'command.K')):
+            raise ValueError("The command file is missing.")
+        for path in automagic_imaging.space.command_transcripts(client):
+            if not os.path.isfile(path):
+                raise ValueError("The transcript '" + path + "' is missing.")
+    elif stage == 'fsdiff':
+        path = os.path.join(root, artifacts['transcript'])
+        if not os.path.isfile(path) or os.path.getsize(path) != artifacts['size']:
+            raise ValueError("Its transcript is missing or has changed.")
+    elif stage == 'lapply':
+        if not os.path.isfile(os.path.join(root, artifacts['transcript'])):
+            raise ValueError("Its transcript is missing.")
+        # The system it applied must be complete enough to be named.
+        automagic_imaging.images.system_version(root)
+
+def completed_output(journal, stage):
+    '''Returns what 'stage' recorded in 'journal' (if given) if it completed
+    and the file it produced is still there, the same size; otherwise None.
+    '''
+    artifacts = journal and journal.artifacts(stage)
+    if not artifacts:
+        return None
+    if not os.path.isfile(artifacts['outfile']) or os.path.getsize(artifacts['outfile']) != artifacts['size']:
+        return None
+    return artifacts
+
+def check_client(image, checked, cert, rserver, limiter, cache=None, stall=None, retries=0):
+    '''Runs ktcheck for 'image' in the directory 'checked' (outside of any
+    image), so that the command files and transcripts it downloads can be
+    looked at before anything is built. Returns the radmind client directory
+    they were downloaded to. ktcheck is tried up to 'retries' more times if
+    it stalls for 'stall' seconds (see retry_stalled()).
+    '''
+    logger = ImageLogger(image)
+    root = os.path.join(checked, 'check')
+    client = os.path.join(root, 'private/var/radmind/client')
+    if cache and not os.path.isdir(client):
+        cache.restore_client(image, client)
+
+    output = tool_output('ktcheck', logger)
+
+    def ktcheck():
+        with limiter.stage('ktcheck'):
+            automagic_imaging.scripts.radmind.run_ktcheck(cert=cert, rserver=rserver, output=output,
+                                                          root=root, stall=stall)
+
+    try:
+        retry_stalled(ktcheck, retries, logger)
+    except:
+        error_output(output, logger)
+        raise
+    return client
+
+def retry_stalled(function, retries, logger):
+    '''Calls 'function' (a stage that runs a radmind tool), and calls it again
+    up to 'retries' more times if the tool stalls (see processes.watch()).
+    Returns what it returns.
+    '''
+    attempt = 0
+    while True:
+        try:
+            return function()
+        except automagic_imaging.processes.Stalled:
+            if attempt >= retries:
+                raise
+            attempt += 1
+            logger.error(str(sys.exc_info()[1]) + " Trying again (" + str(attempt) + " of " +
+                         str(retries) + ")...")
+
+def preflight(image, tmp_dir, out_dir, client, existing=None, format=None, last=None):
+    '''Estimates the size of 'image' from the transcripts in the radmind
+    client directory 'client', and reserves the space it will need in
+    'tmp_dir' (for the sparse image, less the size of an 'existing' one that
+    will be built on) and 'out_dir' (for the converted image, which is
+    expected to be the size of the 'last' one built, if it is still there, or
+    the compressed size of the volume otherwise; a chunked format also needs
+    room for the uncompressed image it is made from). Returns the
+    space.Estimate.
+
+    If there isn't enough space, this waits while other builds hold some of it
+    and raises a RuntimeError if it still can't be had (see
+    space.Reservations).
+    '''
+    logger = ImageLogger(image)
+    estimate = automagic_imaging.space.estimate(client)
+    volume = estimate.volume_size()
+    logger.info("Estimated the volume at " + str(volume) + " bytes (" + str(estimate.files) + " files, " +
+                str(estimate.bytes) + " bytes).")
+    needs = {}
+    needs[tmp_dir] = volume
+    if existing and os.path.exists(existing):
+        needs[tmp_dir] = max(0, volume - automagic_imaging.images.allocated(existing))
+    if last and os.path.isfile(last):
+        output = os.path.getsize(last)
+    else:
+        output = estimate.output_size()
+    if format and automagic_imaging.compression.parse(format):
+        output += volume
+    needs[out_dir] = needs.get(out_dir, 0) + output
+    for directory in sorted(needs):
+        logger.info("Needs " + str(needs[directory]) + " bytes in '" + directory + "' (" +
+                    str(automagic_imaging.space.free_space(directory)) + " bytes free).")
+    automagic_imaging.space.reserved.reserve(
+        image, needs,
+        waiting=lambda message: logger.info("Waiting for other images to finish: " + message + ".")
+    )
+    return estimate
+
+def check_unchanged(image, volname, out_dir, checked, cert, rserver, state,
+                    limiter, cache=None, extra=None, archive=None, stall=None,
+                    retries=0):
+    '''Runs ktcheck for 'image' in the directory 'checked' (outside of any
+    image) and compares the command files and transcripts it downloads against
+    those of the last successful build.
+
+    If nothing has changed and the last image is still in 'out_dir', it is
+    reused under today's name and None is returned. Otherwise, a report of the
+    changes is logged and the fingerprint of the new client files is returned.
+    Any 'extra' values (such as details of a base image) are included in the
+    fingerprint. A reused image is recorded in 'archive' (if given) without
+    being read again. ktcheck is watched for stalls as in check_client().
+    '''
+    logger = ImageLogger(image)
+    logger.info("Checking for changes since the last build...")
+    client = check_client(image, checked, cert, rserver, limiter, cache, stall, retries)
+    fingerprint = automagic_imaging.changes.fingerprint(client, volname, *(extra or []))
+
+    previous = state.get(image)
+    if (previous.get('fingerprint') == fingerprint and previous.get('version') and
+            previous.get('build') and previous.get('image') and os.path.isfile(previous['image'])):
+        date = datetime.datetime.now().strftime('%Y.%m.%d')
+        reuse_name = out_dir + '/' + date + '_' + image.upper() + '_' + previous['version'] + '_' + previous['build'] + '.dmg'
+        if previous['image'].endswith(automagic_imaging.compression.extension):
+            reuse_name += automagic_imaging.compression.extension
+        logger.info("Nothing has changed since the build finished " + str(previous.get('finished')) + ".")
+        if reuse_name != previous['image']:
+            logger.info("Reusing '" + previous['image'] + "' as '" + reuse_name + "'...")
+            try:
+                # A hard link costs nothing if both are on the same volume.
+                os.link(previous['image'], reuse_name)
+            except OSError:
+                shutil.copy2(previous['image'], reuse_name)
+            manifest = automagic_imaging.checksums.manifest_path(previous['image'])
+            if os.path.isfile(manifest):
+                automagic_imaging.checksums.rename(manifest, reuse_name)
+            if archive:
+                if archive.contains(os.path.basename(previous['image'])):
+                    archive.link(os.path.basename(previous['image']), os.path.basename(reuse_name), image)
+                else:
+                    archive.add(reuse_name, section=image)
+                prune_archived(archive, image, reuse_name, logger)
+        state.update(image, image=reuse_name,
+                     finished=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        return None
+
+    report = automagic_imaging.changes.compare(os.path.join(checked, 'last', 'private/var/radmind/client'), client)
+    logger.info("Changes since the last successful build:")
+    for line in report.lines():
+        logger.info("    " + line)
+    return fingerprint
+
+def archive_image(archive, image, convert_name, logger):
+    '''Adds the finished image 'convert_name' to 'archive' (under its file
+    name, with the config section 'image'), and then removes the older images
+    of 'image' that are in the archive from the output directory. Returns the
+    size of the image.
+    '''
+    logger.info("Archiving image...")
+    stats = archive.add(convert_name, section=image)
+    logger.info("Image archived: " + str(stats.stored) + " of its " + str(stats.bytes) +
+                " bytes were new to the archive.")
+    total = archive.stats()
+    logger.info("The archive holds " + str(total.images) + " image(s) (" + str(total.bytes) + " bytes) in " +
+                str(total.stored) + " bytes (" + "%.2f" % total.ratio() + "x deduplication).")
+    prune_archived(archive, image, convert_name, logger)
+    return stats.bytes
+
+def prune_archived(archive, image, keep, logger):
+    '''Removes every image of 'image' except 'keep' from the output directory
+    (the one 'keep' is in), along with its manifest, if it is in 'archive'.
+    They can be restored from the archive when they are needed.
+    '''
+    out_dir = os.path.dirname(keep)
+    for name in archive.names(image):
+        path = os.path.join(out_dir, name)
+        if path == keep or not os.path.isfile(path):
+            continue
+        try:
+            os.remove(path)
+            manifest = automagic_imaging.checksums.manifest_path(path)
+            if os.path.isfile(manifest):
+                os.remove(manifest)
+        except:
+            logger.error("Could not remove archived image '" + path + "': " + str(sys.exc_info()[1]))
+            continue
+        logger.info("Removed '" + path + "' (kept in the archive).")
+
+def warm_image(path, limiter, logger, backend=None):
+    '''Opens and mounts the sparse image at 'path' for a warm start, and checks
+    that it is sound: its volume must pass verification and contain a system.
+    Returns the mounted Image, or None if it can't be used.
+    '''
+    try:
+        i = automagic_imaging.images.Image(path=path, backend=backend)
+    except:
+        logger.error(sys.exc_info()[1].message)
+        return None
+    try:
+        with limiter.stage('mount'):
+            i.mount()
+        logger.info("Verifying volume at '" + i.mount_point + "'...")
+        with limiter.stage('verify'):
+            i.verify()
+        if not os.path.isfile(os.path.join(i.mount_point, 'System/Library/CoreServices/SystemVersion.plist')):
+            raise RuntimeError("The volume does not contain a system.")
+    except:
+        logger.error("Image '" + path + "' failed validation: " + str(sys.exc_info()[1]))
+        failure_unmount(i)
+        return None
+    return i
+
+def failure_unmount(image, timeout=None):
+    '''Attempt to unmount a volume/disk after a failure, trying again (with
+    growing pauses in between) while it is busy, until 'timeout' seconds have
+    passed (default: the 'ready_timeout' option, or
+    polling.default_deadline).
+    '''
     if image:
         if image.mounted:
-            attempt = 3
-            while (attempt > 0):
-                time.sleep(2)
+            if timeout is None:
+                timeout = options.get('ready_timeout')
+            disk_id = image.disk_id
+
+            def unmount():
                 try:
                     image.unmount(force=True)
-                    logger.info("Successfully unmounted '" + str(image.name) + "'")
-                    return
                 except:
+                    first = sys.exc_info()
                     try:
-                        time.sleep(2)
-                        automagic_imaging.images.detach(image.mount_point, force=True)
-                        time.sleep(2)
+                        image.backend.detach(image.mount_point, force=True)
                         image.unmount(force=True)
-                        logger.info("Successfully unmounted '" + str(image.name) + "'")
-                        return
                     except:
-                        logger.error("Could not unmount image '" + str(image.name) +
-                                     "' on device " + image.disk_id + " during premature exit. " +
-                                     str(attempt - 1) + " attempts remaining.")
-                attempt -= 1
-            logger.error("Failed to unmount image '" + str(image.name) +
-                         "' during premature exit. Please unmount manually from " + image.disk_id + ".")
-
-def error_log(file, lines=5):
-    '''Log the last `lines` lines of `file`.'''
-    if not os.path.isfile(file):
-        logger.error("File '" + file + "' not found for logging.")
+                        if isinstance(first[1], automagic_imaging.images.Busy):
+                            # Still worth trying again.
+                            raise first[0], first[1], first[2]
+                        raise
+
+            try:
+                automagic_imaging.polling.retry(
+                    unmount, timeout, automagic_imaging.images.Busy,
+                    lambda error: logger.info("Could not unmount image '" + str(image.name) + "' on device " +
+                                              disk_id + " yet (" + str(error) + "); trying again.")
+                )
+                logger.info("Successfully unmounted '" + str(image.name) + "'")
+            except:
+                logger.error("Failed to unmount image '" + str(image.name) + "' during premature exit (" +
+                             str(sys.exc_info()[1]) + "). Please unmount manually from " + disk_id + ".")
+
+def tool_output(name, logger):
+    '''Returns an Output to follow the radmind tool 'name' with, which logs
+    its progress (and how long it expects to take) to 'logger'.
+    '''
+
+    def report(update):
+        message = name + ": " + str(int(update.percent)) + "% done"
+        if update.eta is not None and update.percent < 100:
+            message += ", about " + automagic_imaging.progress.duration(update.eta) + " remaining"
+        logger.info(message + ".")
+    return automagic_imaging.progress.Output(name, callback=report)
+
+def error_output(output, logger, lines=5):
+    '''Log the last `lines` lines printed by the tool `output` followed.'''
+    lines = output.tail(lines)
+    if not lines:
+        logger.error(output.name + " did not print anything.")
         return
-    lines = subprocess.check_output(['tail', '-' + str(lines), file]).split('\n')
-    # Blank lines won't really help us debug much, so remove those.
-    lines = [x for x in lines if x != '']
-    logger.error("Last " + str(len(lines)) + " lines of " + file + ":")
+    logger.error("Last " + str(len(lines)) + " lines from " + output.name + ":")
     for line in lines:
         # Indentation for easier reading.
         logger.error('    ' + line)
@@ -545,8 +1842,42 @@ def set_globals():
     options['sparse']        = None
     options['persist']       = False
     options['persist-fail']  = False
-    options['total_count']   = 0
-    options['success_count'] = 0
+    options['workers']       = None
+    options['limiter']       = None
+    options['pipeline']      = False
+    options['pipeline_depth'] = None
+    options['finisher']      = None
+    options['cache_dir']     = None
+    options['cache_size']    = None
+    options['cache']         = None
+    options['warm_start']    = False
+    options['skip_unchanged'] = False
+    options['metrics_dir']   = None
+    options['backend_name']  = None
+    options['backend']       = None
+    options['format']        = None
+    options['sparsebundle']  = False
+    options['compact']       = True
+    options['rebuild_base']  = False
+    options['resume']        = False
+    options['ready_timeout'] = None
+    options['stall_timeout'] = None
+    options['stall_retries'] = None
+    options['archive_dir']   = None
+    options['archive']       = None
+    options['restore']       = None
+    options['decompress']    = None
+    options['daemon']        = False
+    options['socket']        = None
+    options['urgent_workers'] = None
+    options['submit']        = None
+    options['priority']      = 0
+    options['status']        = None
+    options['cancel']        = None
+    # Collects the timing of every stage of every image in this run.
+    options['metrics']       = automagic_imaging.metrics.Metrics()
+    # Maps image names to whether they were produced successfully.
+    options['results']       = collections.OrderedDict()
 
 
 def setup_logger():
@@ -556,30 +1887,19 @@ def setup_logger():
                                                      options['log_dest'],
                                                      options['name'])
 
-class ChDir:
-    '''Changes directories to the new path and retains the old directory.
-
-    Use this in a 'with' statement for the best effect:
-
-    # If we start in oldPath:
-    os.getcwd()
-    # returns oldPath
-    with ChDir(newPath):
-        os.getcwd()
-        # returns newPath
-    os.getcwd()
-    # returns oldPath
+class ImageLogger:
+    '''Prefixes each message with the name of the image it concerns, so that
+    the output of concurrent builds can be told apart in the log.
     '''
 
-    def __init__(self, newPath):
-        self.savedPath = os.getcwd()
-        os.chdir(newPath)
+    def __init__(self, image):
+        self.prefix = "[" + str(image) + "] "
 
-    def __enter__(self):
-        return self
+    def info(self, message):
+        logger.info(self.prefix + message)
 
-    def __exit__(self, type, value, traceback):
-        os.chdir(self.savedPath)
+    def error(self, message):
+        logger.error(self.prefix + message)
 
 class WithBreaker(Exception):
     '''Used to break out of 'with' statements.'''
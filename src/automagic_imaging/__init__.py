@@ -1,4 +1,4 @@
 import scripts
-import configurator, images
+import archive, cache, changes, checksums, compression, configurator, daemon, images, journal, metrics, polling, processes, progress, scheduler, space, state, transcript
 
 __version__ = '1.4.4'
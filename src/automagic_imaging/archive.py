@@ -0,0 +1,347 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+
+# Chunk boundaries are placed wherever the data contains this pattern (at
+# least min_chunk and at most max_chunk bytes apart), so they depend only on
+# the content around them: data that is shifted or changed elsewhere in an
+# image still splits into the same chunks. In data that looks random (as
+# compressed images do) it turns up about once every megabyte. Searching for it
+# with a regular expression is far faster than a rolling hash in Python.
+anchor = re.compile('\x8f\x3a[\x00-\x0f]')
+min_chunk = 256 * 1024
+max_chunk = 4 * 1024 * 1024
+# How much of an image is read at a time.
+read_size = 8 * 1024 * 1024
+
+class Archive:
+    '''A store of output images, split into content-defined chunks that are
+    kept once no matter how many images (or days' images) contain them.
+
+    Each chunk is kept under its SHA-256 checksum in 'chunks', and each image
+    as a list of its chunks (a recipe) in 'images'. The number of images that
+    use each chunk is counted, so that a chunk is deleted along with the last
+    image that uses it. Any image can be rebuilt in full with restore().
+
+    If the index has to be rebuilt from the recipes (such as after a crash),
+    images whose chunks are missing are left out of it, and their names are
+    listed in 'broken'.
+
+    path - the directory to keep the archive in
+    '''
+
+    def __init__(self, path):
+        self.path = os.path.abspath(str(path))
+        self.chunks = os.path.join(self.path, 'chunks')
+        self.images = os.path.join(self.path, 'images')
+        for directory in [self.chunks, self.images]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.__index_path = os.path.join(self.path, 'index.json')
+        self.__lock = threading.Lock()
+        # Maps each chunk to [size, number of images using it], and each
+        # image to its size and section.
+        self.__chunks = {}
+        self.__images = {}
+        self.broken = []
+        self.__load()
+
+    def __repr__(self):
+        stats = self.stats()
+        result = "Archive: " + self.path
+        result += "\n       Images:  " + str(stats.images)
+        result += "\n       Size:    " + str(stats.bytes)
+        result += "\n       Stored:  " + str(stats.stored) + " in " + str(stats.chunks) + " chunks"
+        result += "\n       Ratio:   " + str(round(stats.ratio(), 2))
+        return result
+
+    def names(self, section=None):
+        '''Returns the names of the archived images (of 'section' only, if
+        given), oldest first.
+        '''
+
+        with self.__lock:
+            names = [x for x in self.__images if section is None or self.__images[x]['section'] == section]
+            return sorted(names, key=lambda x: (self.__images[x]['added'], x))
+
+    def contains(self, name):
+        with self.__lock:
+            return name in self.__images
+
+    def add(self, image, name=None, section=None):
+        '''Adds the image file 'image' to the archive as 'name' (by default,
+        its file name), replacing any image of that name. 'section' is the
+        config section it was built for. Returns the Stats of this image
+        alone: 'stored' is how much of it was new to the archive.
+        '''
+
+        name = name or os.path.basename(str(image))
+        previous = self.__used(name)
+        stats = Stats(images=1)
+        recipe = []
+        used = set()
+        sha256 = hashlib.sha256()
+        try:
+            with open(str(image), 'rb') as f:
+                for data in chunks(f):
+                    key = hashlib.sha256(data).hexdigest()
+                    sha256.update(data)
+                    recipe.append(key)
+                    stats.bytes += len(data)
+                    if key in used:
+                        continue
+                    if self.__reference(key, data):
+                        stats.stored += len(data)
+                        stats.chunks += 1
+                    used.add(key)
+            self.__save_recipe(name, {'name': name, 'size': stats.bytes, 'section': section,
+                                      'sha256': sha256.hexdigest(), 'chunks': recipe})
+        except:
+            # Give back the chunks this image would have used.
+            self.__release(used)
+            raise
+        with self.__lock:
+            self.__images[name] = {'size': stats.bytes, 'section': section, 'added': self.__next()}
+        self.__release(previous)
+        self.__save_index()
+        return stats
+
+    def link(self, name, new_name, section=None):
+        '''Archives 'new_name' as an identical copy of the archived image
+        'name' (such as an unchanged image reused under a new name), without
+        reading anything.
+        '''
+
+        recipe = self.recipe(name)
+        previous = self.__used(new_name)
+        with self.__lock:
+            for key in set(recipe['chunks']):
+                self.__chunks[key][1] += 1
+            self.__images[new_name] = {'size': recipe['size'], 'section': section, 'added': self.__next()}
+        recipe['name'] = new_name
+        recipe['section'] = section
+        self.__save_recipe(new_name, recipe)
+        self.__release(previous)
+        self.__save_index()
+
+    def remove(self, name):
+        '''Removes the image 'name' from the archive, along with any chunks
+        that no other image uses.
+        '''
+
+        recipe = self.recipe(name)
+        with self.__lock:
+            del self.__images[name]
+        os.remove(self.__recipe_path(name))
+        self.__release(set(recipe['chunks']))
+        self.__save_index()
+
+    def recipe(self, name):
+        '''Returns the recipe of the image 'name': its 'size', 'sha256', the
+        config 'section' it was built for, and the list of its 'chunks'.
+        '''
+
+        path = self.__recipe_path(name)
+        if not os.path.isfile(path):
+            raise ValueError("No image named '" + str(name) + "' is archived.")
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def restore(self, name, outfile):
+        '''Rebuilds the archived image 'name' in full at 'outfile', checking
+        every chunk and the whole image as it goes.
+        '''
+
+        recipe = self.recipe(name)
+        sha256 = hashlib.sha256()
+        with open(outfile + '.new', 'wb') as output:
+            try:
+                for key in recipe['chunks']:
+                    with open(self.__chunk_path(key), 'rb') as f:
+                        data = f.read()
+                    if hashlib.sha256(data).hexdigest() != key:
+                        raise ValueError("The chunk '" + key + "' of '" + str(name) + "' is damaged.")
+                    sha256.update(data)
+                    output.write(data)
+                if sha256.hexdigest() != recipe['sha256']:
+                    raise ValueError("The restored image '" + str(name) + "' does not match the original.")
+            except:
+                output.close()
+                os.remove(outfile + '.new')
+                raise
+        os.rename(outfile + '.new', outfile)
+
+    def stats(self):
+        '''Returns the Stats of the whole archive.'''
+        with self.__lock:
+            stats = Stats(images=len(self.__images), chunks=len(self.__chunks))
+            stats.bytes = sum(x['size'] for x in self.__images.values())
+            stats.stored = sum(x[0] for x in self.__chunks.values())
+        return stats
+
+    def __used(self, name):
+        # The chunks an image already in the archive uses (none if it isn't).
+        if not self.contains(name):
+            return set()
+        return set(self.recipe(name)['chunks'])
+
+    def __reference(self, key, data):
+        # Counts one more image using the chunk, storing it first if it's new.
+        # Returns True if it was stored.
+        with self.__lock:
+            if key in self.__chunks:
+                self.__chunks[key][1] += 1
+                return False
+        path = self.__chunk_path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Another image may have just created it.
+                pass
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(data)
+            # Put in place under the lock, so that it can't be deleted by
+            # __release() between being put in place and being counted.
+            with self.__lock:
+                if key in self.__chunks:
+                    # Another image stored it at the same time.
+                    self.__chunks[key][1] += 1
+                    os.remove(temporary)
+                    return False
+                os.rename(temporary, path)
+                self.__chunks[key] = [len(data), 1]
+        except:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return True
+
+    def __release(self, keys):
+        # Counts one fewer image using each chunk, deleting those no longer
+        # used by any. They are deleted under the lock, so that an image being
+        # added can't store one again in the meantime, only to lose it.
+        with self.__lock:
+            for key in keys:
+                if key not in self.__chunks:
+                    continue
+                self.__chunks[key][1] -= 1
+                if self.__chunks[key][1] <= 0:
+                    del self.__chunks[key]
+                    try:
+                        os.remove(self.__chunk_path(key))
+                    except OSError:
+                        pass
+
+    def __next(self):
+        # The order images were added in (the lock must be held).
+        return max([x['added'] for x in self.__images.values()] + [0]) + 1
+
+    def __chunk_path(self, key):
+        return os.path.join(self.chunks, key[:2], key)
+
+    def __recipe_path(self, name):
+        return os.path.join(self.images, str(name) + '.json')
+
+    def __save_recipe(self, name, recipe):
+        path = self.__recipe_path(name)
+        with open(path + '.new', 'w') as f:
+            json.dump(recipe, f)
+        os.rename(path + '.new', path)
+
+    def __save_index(self):
+        # Held throughout so that two images finishing at once can't write
+        # the new index over each other.
+        with self.__lock:
+            with open(self.__index_path + '.new', 'w') as f:
+                json.dump({'chunks': self.__chunks, 'images': self.__images}, f)
+            os.rename(self.__index_path + '.new', self.__index_path)
+
+    def __load(self):
+        if os.path.isfile(self.__index_path):
+            try:
+                with open(self.__index_path, 'r') as f:
+                    index = json.load(f)
+                self.__chunks = index['chunks']
+                self.__images = index['images']
+                return
+            except (IOError, ValueError, KeyError):
+                pass
+        # Rebuild the index from the recipes, such as after a crash.
+        self.__chunks = {}
+        self.__images = {}
+        for filename in sorted(os.listdir(self.images)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.images, filename), 'r') as f:
+                    recipe = json.load(f)
+            except (IOError, ValueError):
+                continue
+            try:
+                sizes = dict((key, os.path.getsize(self.__chunk_path(key)))
+                             for key in set(recipe['chunks']) if key not in self.__chunks)
+            except OSError:
+                # A chunk is missing, so the image can't be restored.
+                self.broken.append(recipe['name'])
+                continue
+            for key in set(recipe['chunks']):
+                if key not in self.__chunks:
+                    self.__chunks[key] = [sizes[key], 0]
+                self.__chunks[key][1] += 1
+            self.__images[recipe['name']] = {'size': recipe['size'], 'section': recipe.get('section'),
+                                             'added': len(self.__images) + 1}
+        self.__save_index()
+
+class Stats:
+    '''The size of archived images and how much space they take.
+
+    images - the number of images
+    bytes  - their total size
+    stored - the bytes of chunks actually kept for them
+    chunks - the number of chunks kept
+    '''
+
+    def __init__(self, images=0, bytes=0, stored=0, chunks=0):
+        self.images = images
+        self.bytes = bytes
+        self.stored = stored
+        self.chunks = chunks
+
+    def __repr__(self):
+        return ("Archive statistics: " + str(self.images) + " images, " + str(self.bytes) +
+                " bytes stored in " + str(self.stored) + " (" + str(round(self.ratio(), 2)) + "x)")
+
+    def ratio(self):
+        '''Returns how many times smaller the archive is than the images in it
+        (the deduplication ratio).
+        '''
+
+        if not self.stored:
+            return 1.0 if not self.bytes else float('inf')
+        return self.bytes / float(self.stored)
+
+def chunks(f):
+    '''Yields the content-defined chunks of the open file 'f'.'''
+    buffer = ''
+    end = False
+    while True:
+        while len(buffer) < max_chunk and not end:
+            data = f.read(read_size)
+            if not data:
+                end = True
+            buffer += data
+        if not buffer:
+            return
+        match = anchor.search(buffer, min_chunk, max_chunk)
+        if match:
+            size = match.end()
+        else:
+            size = min(max_chunk, len(buffer))
+        yield buffer[:size]
+        buffer = buffer[size:]
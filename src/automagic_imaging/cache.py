@@ -0,0 +1,405 @@
+import base64
+import binascii
+import collections
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+import transcript
+
+class Cache:
+    '''A persistent store of files downloaded from radmind, shared by every
+    image build (and every run) that uses the same directory.
+
+    Files are stored under the hex form of the sha1 checksum that radmind
+    already records for them in transcripts (radmind is run with '-c sha1'),
+    so identical content is only ever kept once. When the cache grows past
+    'limit' bytes, the least recently used files are removed.
+
+    path  - the directory to keep the cache in
+    limit - the maximum number of bytes to keep (unlimited if not given)
+    '''
+
+    def __init__(self, path, limit=None):
+        self.path = os.path.abspath(str(path))
+        self.objects = os.path.join(self.path, 'objects')
+        self.clients = os.path.join(self.path, 'clients')
+        for directory in [self.objects, self.clients]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        if limit is not None:
+            limit = int(limit)
+            if limit < 0:
+                raise ValueError("The cache size limit cannot be negative.")
+        self.limit = limit
+        self.stats = Stats()
+        self.__lock = threading.Lock()
+        self.__index = collections.OrderedDict()
+        self.__size = 0
+        self.__load()
+        self.__evict()
+
+    def __repr__(self):
+        result = "Cache: " + self.path
+        result += "\n       Files:   " + str(len(self.__index))
+        result += "\n       Size:    " + str(self.__size)
+        result += "\n       Limit:   " + str(self.limit if self.limit is not None else 'unlimited')
+        return result
+
+    def size(self):
+        return self.__size
+
+    def contains(self, key):
+        with self.__lock:
+            return key in self.__index
+
+    def fetch(self, key, destination):
+        '''Copies the cached file for 'key' to 'destination'. Returns True if
+        the file was in the cache.
+
+        Only a missing or regular file at 'destination' is replaced (never
+        what a link there points to); anything else is left alone.
+        '''
+
+        try:
+            info = destination_info(destination)
+        except ValueError:
+            return False
+        temporary = self.__copy(key, destination)
+        if not temporary:
+            return False
+        try:
+            # The mode of the file it replaces, or what ktcheck would give a
+            # new one.
+            os.chmod(temporary, stat.S_IMODE(info.st_mode) if info else 0644)
+            os.rename(temporary, destination)
+        except OSError:
+            os.remove(temporary)
+            return False
+        return True
+
+    def store(self, key, source):
+        '''Adds a copy of 'source' to the cache under 'key', unless it is
+        already there.
+        '''
+
+        with self.__lock:
+            if key in self.__index:
+                return
+        destination = self.__object(key)
+        if not os.path.isdir(os.path.dirname(destination)):
+            try:
+                os.makedirs(os.path.dirname(destination))
+            except OSError:
+                # Another build may have just created it.
+                pass
+        # Copy to a temporary name first so that a partial file is never
+        # mistaken for a cached one.
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(destination))
+        os.close(handle)
+        try:
+            shutil.copyfile(source, temporary)
+            os.rename(temporary, destination)
+        except:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        size = os.path.getsize(destination)
+        with self.__lock:
+            if key not in self.__index:
+                self.__index[key] = size
+                self.__size += size
+        self.stats.add('stored', size)
+        self.__evict()
+
+    def restore_client(self, name, directory):
+        '''Restores the radmind client files (command files and transcripts)
+        that were saved for 'name' into 'directory', so that ktcheck only has
+        to download the ones that have changed since. Returns the number of
+        files restored.
+        '''
+
+        manifest = os.path.join(self.clients, name + '.json')
+        if not os.path.isfile(manifest):
+            return 0
+        try:
+            with open(manifest, 'r') as f:
+                files = json.load(f)
+        except (IOError, ValueError):
+            return 0
+        restored = 0
+        for relative in files:
+            destination = os.path.join(directory, relative)
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            if self.fetch(files[relative], destination):
+                restored += 1
+                self.stats.add('client', os.path.getsize(destination))
+        return restored
+
+    def save_client(self, name, directory):
+        '''Saves the radmind client files in 'directory' for 'name'. Returns the
+        number of files saved.
+        '''
+
+        files = {}
+        for path, dirs, names in os.walk(directory):
+            for filename in names:
+                source = os.path.join(path, filename)
+                if os.path.islink(source) or not os.path.isfile(source):
+                    continue
+                key = checksum(source)
+                self.store(key, source)
+                files[os.path.relpath(source, directory)] = key
+        manifest = os.path.join(self.clients, name + '.json')
+        with open(manifest + '.new', 'w') as f:
+            json.dump(files, f, indent=1, sort_keys=True)
+        os.rename(manifest + '.new', manifest)
+        return len(files)
+
+    def seed(self, infile, outfile, root='.'):
+        '''Places every file listed for download in the applicable transcript
+        'infile' that is already cached into 'root', and writes the remainder of
+        the transcript to 'outfile' for lapply. Files that cannot be placed are
+        left in the transcript for lapply to download as usual.
+
+        Returns the Stats for this transcript alone: 'hit' counts the files the
+        cache supplied and 'miss' the files lapply will still download.
+        '''
+
+        stats = Stats()
+        with open(infile, 'r') as source:
+            with open(outfile, 'w') as destination:
+                for line in source:
+                    entry = download_entry(line)
+                    if entry:
+                        if self.place(entry, root):
+                            kind = 'hit'
+                        else:
+                            kind = 'miss'
+                        stats.add(kind, entry.size)
+                        self.stats.add(kind, entry.size)
+                        if kind == 'hit':
+                            continue
+                    destination.write(line)
+        return stats
+
+    def place(self, entry, root='.'):
+        '''Places the cached file for a transcript entry at its path under
+        'root', with the permissions, ownership and modification time given
+        in the transcript. Returns True if it was placed.
+
+        The file must match the size and checksum in the transcript; if it
+        doesn't, the cached copy is damaged, and is removed from the cache.
+        Only a missing or regular file at the path is replaced (never what a
+        link there points to); anything else is left for lapply.
+        '''
+
+        key = checksum_key(entry.checksum)
+        if not key or not self.contains(key):
+            return False
+        path = os.path.join(root, entry.name())
+        temporary = None
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            destination_info(path)
+            temporary = self.__copy(key, path)
+            if not temporary:
+                return False
+            if os.path.getsize(temporary) != entry.size or checksum(temporary) != key:
+                self.__discard(key)
+                raise ValueError("Cached file is damaged.")
+            # Everything is set on the temporary file, which nothing else can
+            # have replaced with a link, before it is renamed into place.
+            # Ownership first, since chown clears the setuid/setgid bits.
+            os.chown(temporary, entry.uid, entry.gid)
+            os.chmod(temporary, entry.mode)
+            os.utime(temporary, (entry.mtime, entry.mtime))
+            os.rename(temporary, path)
+        except (IOError, OSError, ValueError):
+            if temporary and os.path.isfile(temporary):
+                os.remove(temporary)
+            return False
+        return True
+
+    def collect(self, infile, root='.'):
+        '''Adds every file that lapply downloaded (the files listed for
+        download in 'infile') under 'root' to the cache. Returns the number of
+        files added.
+        '''
+
+        collected = 0
+        with open(infile, 'r') as source:
+            for line in source:
+                entry = download_entry(line)
+                if not entry:
+                    continue
+                key = checksum_key(entry.checksum)
+                path = os.path.join(root, entry.name())
+                if not key or self.contains(key) or not os.path.isfile(path):
+                    continue
+                self.store(key, path)
+                collected += 1
+        return collected
+
+    def __copy(self, key, destination):
+        # Copies the cached file for 'key' to a new temporary file beside
+        # 'destination', and returns its path (or None if it isn't cached).
+        with self.__lock:
+            if key not in self.__index:
+                return None
+            # Mark it as the most recently used.
+            size = self.__index.pop(key)
+            self.__index[key] = size
+        source = self.__object(key)
+        try:
+            handle, temporary = tempfile.mkstemp(dir=os.path.dirname(destination) or '.',
+                                                 prefix='.imager-')
+        except OSError:
+            return None
+        os.close(handle)
+        try:
+            shutil.copyfile(source, temporary)
+            os.utime(source, None)
+        except (IOError, OSError):
+            os.remove(temporary)
+            if not os.path.isfile(source):
+                # It was evicted (or removed) underneath us; forget about it.
+                self.__forget(key)
+            return None
+        return temporary
+
+    def __object(self, key):
+        return os.path.join(self.objects, key[:2], key)
+
+    def __forget(self, key):
+        with self.__lock:
+            if key in self.__index:
+                self.__size -= self.__index.pop(key)
+
+    def __discard(self, key):
+        # Forgets the file for 'key' and removes it.
+        self.__forget(key)
+        try:
+            os.remove(self.__object(key))
+        except OSError:
+            pass
+
+    def __load(self):
+        entries = []
+        for path, dirs, names in os.walk(self.objects):
+            for name in names:
+                try:
+                    info = os.stat(os.path.join(path, name))
+                except OSError:
+                    continue
+                if name.startswith('tmp'):
+                    # Left over from an interrupted store.
+                    os.remove(os.path.join(path, name))
+                    continue
+                entries.append((info.st_mtime, name, info.st_size))
+        # Oldest first, so that the least recently used are evicted first.
+        for mtime, name, size in sorted(entries):
+            self.__index[name] = size
+            self.__size += size
+
+    def __evict(self):
+        if self.limit is None:
+            return
+        while True:
+            with self.__lock:
+                if self.__size <= self.limit or not self.__index:
+                    return
+                key, size = self.__index.popitem(last=False)
+                self.__size -= size
+            try:
+                os.remove(self.__object(key))
+            except OSError:
+                pass
+            self.stats.add('evicted', size)
+
+class Stats:
+    '''Counts how many files (and bytes) the cache supplied to lapply ('hit'),
+    how many had to be downloaded ('miss'), how many radmind client files it
+    supplied to ktcheck ('client'), and how many were stored or evicted.
+    '''
+
+    kinds = ['hit', 'miss', 'client', 'stored', 'evicted']
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.files = dict((kind, 0) for kind in self.kinds)
+        self.bytes = dict((kind, 0) for kind in self.kinds)
+
+    def __repr__(self):
+        result = "Cache statistics:"
+        for kind in self.kinds:
+            result += "\n       " + kind + ": " + str(self.files[kind]) + " files, " + str(self.bytes[kind]) + " bytes"
+        return result
+
+    def add(self, kind, size):
+        with self.__lock:
+            self.files[kind] += 1
+            self.bytes[kind] += size
+
+    def snapshot(self):
+        '''Returns a copy of the current counts, for comparing against later.'''
+        with self.__lock:
+            return {'files': dict(self.files), 'bytes': dict(self.bytes)}
+
+def destination_info(path):
+    '''Returns the lstat() result for 'path', or None if nothing is there.
+    Raises a ValueError if it is anything but a regular file (such as a link),
+    which must not be replaced.
+    '''
+
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(info.st_mode):
+        raise ValueError("'" + path + "' is not a regular file.")
+    return info
+
+def checksum(path):
+    '''Returns the hex sha1 digest of the file at 'path'.'''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def checksum_key(value):
+    '''Converts a base64 checksum from a radmind transcript to the hex form
+    used as a cache key. Returns None if there is no usable checksum.
+    '''
+
+    if not value or value == '-':
+        return None
+    try:
+        return binascii.hexlify(base64.b64decode(value))
+    except (TypeError, binascii.Error):
+        return None
+
+def download_entry(line):
+    '''Parses a line of an applicable transcript (as written by 'fsdiff -A').
+    Returns its transcript.Entry if the line is a regular file to be
+    downloaded, or None otherwise (including for lines that can't be parsed,
+    which are left for lapply to deal with).
+
+    Such lines look like:
+    + f ./path/to/file 0644 0 0 1401234567 1024 base64checksum
+    '''
+
+    try:
+        entry = transcript.parse_line(line)
+    except ValueError:
+        return None
+    if entry and entry.action == '+' and entry.type == 'f':
+        return entry
+    return None
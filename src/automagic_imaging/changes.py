@@ -0,0 +1,121 @@
+import collections
+import hashlib
+import os
+import shutil
+
+import cache
+import transcript
+
+class Report:
+    '''Describes what changed between two sets of radmind client files (the
+    command files and transcripts downloaded by ktcheck).
+
+    added   - files that are new
+    removed - files that are gone
+    changed - files whose contents differ, mapped to their transcript.Changes
+              (or None for command files and anything that isn't a transcript)
+    '''
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = collections.OrderedDict()
+
+    def __repr__(self):
+        return '\n'.join(["Report:"] + ['       ' + line for line in self.lines()])
+
+    def empty(self):
+        return not self.added and not self.removed and not self.changed
+
+    def lines(self):
+        '''Returns a summary of the report as a list of lines for logging.'''
+        if self.empty():
+            return ["No changes."]
+        result = []
+        for name in self.added:
+            result.append("Added " + name)
+        for name in self.removed:
+            result.append("Removed " + name)
+        for name in self.changed:
+            changes = self.changed[name]
+            if not changes:
+                result.append("Changed " + name)
+                continue
+            result.append("Changed " + name + ": " +
+                          str(changes.count['added']) + " added (" + str(changes.bytes['added']) + " bytes), " +
+                          str(changes.count['removed']) + " removed, " +
+                          str(changes.count['changed']) + " changed (" + str(changes.bytes['changed']) + " bytes)")
+            for kind in changes.kinds:
+                for path in changes.examples[kind]:
+                    result.append("    " + kind + ": " + path)
+        return result
+
+def manifest(directory):
+    '''Returns a dictionary of the path (relative to 'directory') of every file
+    in 'directory' to its sha1 checksum.
+    '''
+
+    result = {}
+    if not os.path.isdir(directory):
+        return result
+    for path, dirs, names in os.walk(directory):
+        for name in names:
+            full = os.path.join(path, name)
+            if os.path.isfile(full) and not os.path.islink(full):
+                result[os.path.relpath(full, directory)] = cache.checksum(full)
+    return result
+
+def fingerprint(directory, *extra):
+    '''Returns a single checksum that changes whenever any file in 'directory'
+    (or any of the 'extra' values, such as the volume name) changes.
+    '''
+
+    sha1 = hashlib.sha1()
+    files = manifest(directory)
+    for name in sorted(files):
+        sha1.update(name + '\0' + files[name] + '\n')
+    for value in extra:
+        sha1.update(str(value) + '\n')
+    return sha1.hexdigest()
+
+def compare(old, new):
+    '''Compares the client files in the directory 'old' to those in 'new' and
+    returns a Report of the differences.
+    '''
+
+    before = manifest(old)
+    after = manifest(new)
+    report = Report()
+    for name in sorted(after):
+        if name not in before:
+            report.added.append(name)
+        elif before[name] != after[name]:
+            changes = None
+            if name.endswith('.T'):
+                try:
+                    changes = transcript.diff(os.path.join(old, name), os.path.join(new, name))
+                except ValueError:
+                    pass
+            report.changed[name] = changes
+    for name in sorted(before):
+        if name not in after:
+            report.removed.append(name)
+    return report
+
+def copy(source, destination):
+    '''Copies the contents of the directory 'source' into 'destination',
+    creating it if needed and replacing any files that are already there.
+    '''
+
+    for path, dirs, names in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(path, source))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in names:
+            shutil.copy2(os.path.join(path, name), os.path.join(target, name))
+
+def replace(source, destination):
+    '''Makes 'destination' an exact copy of the directory 'source'.'''
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    shutil.copytree(source, destination)
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import Queue
+import threading
+
+# The size of each separately checksummed chunk of an image.
+default_chunk_size = 8 * 1024 * 1024
+# Added to the name of an image for its manifest.
+extension = '.sha256.json'
+# How many chunks may be read ahead of the hashing.
+read_ahead = 4
+
+class Manifest:
+    '''The SHA-256 checksums of an image: of the whole file, and of each
+    'chunk_size' chunk of it (the last one may be shorter), so that a copy can
+    be checked (and the damaged parts found) without reading it twice.
+
+    image      - the file name of the image
+    size       - its size in bytes
+    sha256     - the checksum of the whole file
+    chunk_size - the size of each chunk
+    chunks     - the checksum of each chunk, in order
+    '''
+
+    def __init__(self, image, size=0, sha256=None, chunk_size=None, chunks=None):
+        self.image = image
+        self.size = size
+        self.sha256 = sha256
+        self.chunk_size = chunk_size or default_chunk_size
+        self.chunks = chunks or []
+
+    def __repr__(self):
+        return ("Manifest: " + self.image + " (" + str(self.size) + " bytes, " +
+                str(len(self.chunks)) + " chunks, sha256 " + str(self.sha256) + ")")
+
+    def to_dict(self):
+        return {
+            'image':      self.image,
+            'size':       self.size,
+            'sha256':     self.sha256,
+            'chunk_size': self.chunk_size,
+            'chunks':     self.chunks
+        }
+
+    def write(self, path):
+        '''Writes the manifest to 'path' as JSON, all at once.'''
+        with open(path + '.new', 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+            f.write('\n')
+        os.rename(path + '.new', path)
+
+def read(path):
+    '''Returns the Manifest in the JSON file at 'path'.'''
+    with open(path, 'r') as f:
+        values = json.load(f)
+    try:
+        return Manifest(values['image'], values['size'], values['sha256'],
+                        values['chunk_size'], values['chunks'])
+    except (KeyError, TypeError):
+        raise ValueError("Invalid manifest: '" + str(path) + "'")
+
+def manifest_path(image):
+    '''Returns where the manifest of 'image' is kept (beside it).'''
+    return str(image) + extension
+
+def compute(image, chunk_size=None):
+    '''Returns the Manifest of the file 'image', with chunks of 'chunk_size'
+    bytes.
+
+    The file is read only once: this thread reads it while two others hash
+    what has been read, one for the whole file and one for the chunks (hashlib
+    lets other threads run while it works on large blocks).
+    '''
+
+    manifest = Manifest(os.path.basename(str(image)), chunk_size=chunk_size)
+    whole = hashlib.sha256()
+    queues = [Queue.Queue(read_ahead), Queue.Queue(read_ahead)]
+
+    def hash_whole():
+        for data in iter(queues[0].get, None):
+            whole.update(data)
+
+    def hash_chunks():
+        for data in iter(queues[1].get, None):
+            manifest.chunks.append(hashlib.sha256(data).hexdigest())
+
+    threads = [threading.Thread(target=hash_whole), threading.Thread(target=hash_chunks)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        with open(str(image), 'rb') as f:
+            for data in iter(lambda: f.read(manifest.chunk_size), ''):
+                manifest.size += len(data)
+                for queue in queues:
+                    queue.put(data)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+    manifest.sha256 = whole.hexdigest()
+    return manifest
+
+def write(image, chunk_size=None):
+    '''Computes the manifest of 'image' and writes it beside the image.
+    Returns the Manifest.
+    '''
+
+    manifest = compute(image, chunk_size)
+    manifest.write(manifest_path(image))
+    return manifest
+
+def rename(manifest, image):
+    '''Writes a copy of the manifest file 'manifest' for the identical image
+    'image' (such as a reused image with a new name), without reading the
+    image. Returns the path of the new manifest.
+    '''
+
+    values = read(manifest)
+    values.image = os.path.basename(str(image))
+    path = manifest_path(image)
+    values.write(path)
+    return path
+
+def verify(image, manifest=None):
+    '''Checks 'image' against its manifest (by default, the one beside it).
+    Returns the numbers of the chunks that don't match, which is an empty list
+    if the image is intact.
+    '''
+
+    expected = read(manifest or manifest_path(image))
+    actual = compute(image, expected.chunk_size)
+    bad = []
+    for i in range(max(len(expected.chunks), len(actual.chunks))):
+        if i >= len(expected.chunks) or i >= len(actual.chunks) or expected.chunks[i] != actual.chunks[i]:
+            bad.append(i)
+    if not bad and (actual.size != expected.size or actual.sha256 != expected.sha256):
+        # Should be impossible if every chunk matched, but don't trust that.
+        bad.append(len(actual.chunks))
+    return bad
@@ -0,0 +1,442 @@
+import atexit
+import bz2
+import collections
+import json
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+
+# lzma is in the standard library from Python 3.3; on Python 2 it comes from
+# the optional 'backports.lzma' package.
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Chunked images begin with this, followed by the length of a JSON header.
+magic = 'AMIC\x01'
+# Appended to the name of a chunked image.
+extension = '.chunked'
+
+# The size of each independently compressed chunk.
+chunk_size = 4 * 1024 * 1024
+# The number of processes to compress with (None for one per core).
+workers = None
+# The level used when a format doesn't give one.
+default_levels = {'zlib': 6, 'bzip2': 9, 'lzma': 6}
+# What auto-tuning tries, from fastest to smallest.
+candidates = [('zlib', 1), ('zlib', 6), ('zlib', 9), ('bzip2', 1), ('bzip2', 9),
+              ('lzma', 1), ('lzma', 6)]
+# How fast compressed images are written and copied out, in bytes per second;
+# auto-tuning weighs the time saved compressing against the time this costs.
+write_bandwidth = 100 * 1024 * 1024
+
+# How long to wait for a chunk (waiting forever can't be interrupted).
+timeout = 24 * 60 * 60
+
+# The worker processes shared by everything compressed in this process, once
+# start() has been called, and how many there are.
+pool = None
+pool_processes = None
+
+class Stats:
+    '''What compressing (or decompressing) an image took.
+
+    codec      - the codec used
+    level      - the compression level used
+    bytes      - the size of the raw image
+    compressed - the size of the compressed image
+    elapsed    - the wall time taken, in seconds
+    '''
+
+    def __init__(self, codec, level, bytes=0, compressed=0, elapsed=0):
+        self.codec = codec
+        self.level = level
+        self.bytes = bytes
+        self.compressed = compressed
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        result = "Stats: " + self.codec + "-" + str(self.level)
+        result += " (" + str(self.bytes) + " bytes to " + str(self.compressed)
+        if self.elapsed:
+            result += " in " + str(round(self.elapsed, 2)) + "s"
+        return result + ")"
+
+    def ratio(self):
+        '''Returns the compressed size as a fraction of the raw size.'''
+        if not self.bytes:
+            return 1.0
+        return self.compressed / float(self.bytes)
+
+    def throughput(self):
+        '''Returns the raw bytes processed per second, or None.'''
+        if not self.elapsed:
+            return None
+        return self.bytes / self.elapsed
+
+    def cost(self, size, bandwidth=None):
+        '''Estimates how many seconds compressing 'size' bytes this way, and
+        then writing out the result at 'bandwidth', would take.
+        '''
+
+        throughput = self.throughput()
+        if not throughput:
+            return 0
+        return size / throughput + size * self.ratio() / float(bandwidth or write_bandwidth)
+
+def available():
+    '''Returns the names of the codecs that can be used here.'''
+    result = ['zlib', 'bzip2']
+    if lzma:
+        result.append('lzma')
+    return result
+
+def parse(format):
+    '''Returns the codec and level of a chunked format such as 'zlib-9',
+    'lzma' (with the default level), or 'auto' (as ('auto', None)). Returns
+    None for anything else (such as an hdiutil format).
+    '''
+
+    if not format:
+        return None
+    if format == 'auto':
+        return 'auto', None
+    codec, separator, level = str(format).partition('-')
+    if codec not in default_levels:
+        return None
+    if codec not in available():
+        raise ValueError("The '" + codec + "' codec needs the 'backports.lzma' module to be installed.")
+    if not separator:
+        return codec, default_levels[codec]
+    try:
+        level = int(level)
+    except ValueError:
+        raise ValueError("Invalid compression level: '" + str(format) + "'")
+    if level < 1 or level > 9:
+        raise ValueError("The compression level must be from 1 to 9: '" + str(format) + "'")
+    return codec, level
+
+def compress_chunk(job):
+    '''Compresses one chunk (in a worker process). 'job' is (codec, level,
+    data); returns the compressed data and the checksum of the original.
+    '''
+
+    codec, level, data = job
+    if codec == 'zlib':
+        compressed = zlib.compress(data, level)
+    elif codec == 'bzip2':
+        compressed = bz2.compress(data, level)
+    elif codec == 'lzma':
+        compressed = lzma.compress(data, preset=level)
+    else:
+        raise ValueError("Invalid codec: '" + str(codec) + "'")
+    return compressed, zlib.crc32(data) & 0xffffffff
+
+def decompress_chunk(job):
+    '''Decompresses one chunk (in a worker process). 'job' is (codec, data,
+    size, checksum); raises a ValueError if the result doesn't match.
+    '''
+
+    codec, data, size, checksum = job
+    if codec == 'zlib':
+        result = zlib.decompress(data)
+    elif codec == 'bzip2':
+        result = bz2.decompress(data)
+    elif codec == 'lzma':
+        if not lzma:
+            raise ValueError("The 'lzma' codec needs the 'backports.lzma' module to be installed.")
+        result = lzma.decompress(data)
+    else:
+        raise ValueError("Invalid codec: '" + str(codec) + "'")
+    if len(result) != size or zlib.crc32(result) & 0xffffffff != checksum:
+        raise ValueError("A chunk is corrupt.")
+    return result
+
+def compress(source, outfile, codec='zlib', level=None, size=None, processes=None):
+    '''Compresses the raw image 'source' into the chunked image 'outfile',
+    compressing chunks of 'size' bytes independently and in parallel on
+    'processes' processes (default: one per core). Returns the Stats.
+
+    The chunks are written in order as they finish, with only a few in memory
+    at a time, and 'outfile' only appears once it is complete.
+    '''
+
+    if codec not in available():
+        raise ValueError("Invalid or unavailable codec: '" + str(codec) + "'")
+    level = level or default_levels[codec]
+    size = size or chunk_size
+    stats = Stats(codec, level)
+    start = time.time()
+    header = json.dumps({'codec': codec, 'level': level, 'chunk_size': size})
+    try:
+        with Workers(processes) as pool:
+            with open(source, 'rb') as f, open(outfile + '.new', 'wb') as output:
+                output.write(magic + struct.pack('>I', len(header)) + header)
+                for data, (compressed, checksum) in pool.map(compress_chunk, chunks(f, size),
+                                                             lambda data: (codec, level, data)):
+                    output.write(struct.pack('>III', len(data), len(compressed), checksum))
+                    output.write(compressed)
+                    stats.bytes += len(data)
+                # The end is marked by an empty chunk.
+                output.write(struct.pack('>III', 0, 0, 0))
+                stats.compressed = output.tell()
+    except:
+        if os.path.exists(outfile + '.new'):
+            os.remove(outfile + '.new')
+        raise
+    os.rename(outfile + '.new', outfile)
+    stats.elapsed = time.time() - start
+    return stats
+
+def decompress(source, outfile=None, processes=None):
+    '''Decompresses the chunked image 'source' to 'outfile' in parallel,
+    checking every chunk. Without an 'outfile' the image is only checked.
+    Returns the Stats; raises a ValueError if the image is corrupt.
+    '''
+
+    start = time.time()
+    with open(source, 'rb') as f:
+        values = header(f)
+        stats = Stats(values['codec'], values['level'], compressed=os.path.getsize(source))
+        output = None
+        if outfile:
+            output = open(outfile + '.new', 'wb')
+        try:
+            with Workers(processes) as pool:
+                for (size, data, checksum), result in pool.map(decompress_chunk, frames(f),
+                                                               lambda frame: (values['codec'], frame[1],
+                                                                              frame[0], frame[2])):
+                    if output:
+                        output.write(result)
+                    stats.bytes += size
+        except:
+            if output:
+                output.close()
+                os.remove(outfile + '.new')
+            raise
+        if output:
+            output.close()
+    if outfile:
+        os.rename(outfile + '.new', outfile)
+    stats.elapsed = time.time() - start
+    return stats
+
+def verify(source, processes=None):
+    '''Checks every chunk of the chunked image 'source'. Returns the Stats.'''
+    return decompress(source, None, processes)
+
+def is_chunked(path):
+    '''Returns whether the file at 'path' is a chunked image.'''
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(magic)) == magic
+    except IOError:
+        return False
+
+def header(f):
+    '''Reads the header at the start of the open chunked image 'f' and returns
+    it as a dictionary (with the 'codec', 'level', and 'chunk_size').
+    '''
+
+    if f.read(len(magic)) != magic:
+        raise ValueError("Not a chunked image.")
+    length = struct.unpack('>I', read_exactly(f, 4))[0]
+    return json.loads(read_exactly(f, length))
+
+def info(path):
+    '''Returns the header of the chunked image at 'path'.'''
+    with open(path, 'rb') as f:
+        return header(f)
+
+def chunks(f, size):
+    '''Yields the chunks of 'size' bytes in the open file 'f'.'''
+    for data in iter(lambda: f.read(size), ''):
+        yield data
+
+def frames(f):
+    '''Yields (size, compressed data, checksum) for each chunk in the open
+    chunked image 'f', after its header.
+    '''
+
+    while True:
+        size, length, checksum = struct.unpack('>III', read_exactly(f, 12))
+        if not size and not length:
+            return
+        yield size, read_exactly(f, length), checksum
+
+def read_exactly(f, length):
+    data = f.read(length)
+    if len(data) != length:
+        raise ValueError("The chunked image is truncated.")
+    return data
+
+class Reader:
+    '''Reads a chunked image as the raw image it holds, one chunk at a time
+    (such as for tarfile's stream mode).
+    '''
+
+    def __init__(self, path):
+        self.__file = open(path, 'rb')
+        self.codec = header(self.__file)['codec']
+        self.__frames = frames(self.__file)
+        self.__buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.__buffer) < size:
+            frame = next(self.__frames, None)
+            if frame is None:
+                break
+            self.__buffer += decompress_chunk((self.codec, frame[1], frame[0], frame[2]))
+        if size < 0:
+            size = len(self.__buffer)
+        result = self.__buffer[:size]
+        self.__buffer = self.__buffer[size:]
+        return result
+
+    def close(self):
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+def start(processes=None):
+    '''Starts the worker processes (default: one per core) that every later
+    compression in this process shares (see Workers), unless they have been
+    started already.
+
+    Call this before starting any threads: a process forked while another
+    thread holds a lock (such as the logging module's) starts with that lock
+    held forever, and can hang on it.
+    '''
+
+    global pool, pool_processes
+    if pool:
+        return
+    processes = processes or workers or multiprocessing.cpu_count()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        pool_processes = processes
+
+def stop():
+    '''Stops the shared worker processes, if they were started.'''
+    global pool, pool_processes
+    if pool:
+        pool.terminate()
+        pool.join()
+        pool = None
+        pool_processes = None
+
+atexit.register(stop)
+
+class Workers:
+    '''A pool of worker processes that works through a sequence of jobs in
+    order, keeping only a few more jobs in memory than there are processes.
+    With a single process, the jobs are run in this one. The shared worker
+    processes are used if they were started with as many processes (see
+    start()); otherwise, processes are started for this pool alone.
+
+    Use it in a 'with' statement so that the processes are always stopped.
+    '''
+
+    def __init__(self, processes=None):
+        self.processes = processes or pool_processes or workers or multiprocessing.cpu_count()
+        self.__pool = None
+        self.__shared = False
+
+    def __enter__(self):
+        if self.processes > 1:
+            if pool and self.processes == pool_processes:
+                self.__pool = pool
+                self.__shared = True
+            else:
+                self.__pool = multiprocessing.Pool(self.processes)
+        return self
+
+    def __exit__(self, *exception):
+        if self.__pool and not self.__shared:
+            if exception[0]:
+                self.__pool.terminate()
+            else:
+                self.__pool.close()
+            self.__pool.join()
+
+    def map(self, function, items, job=None):
+        '''Yields each item along with the result of 'function(job(item))',
+        in the order of 'items'.
+        '''
+
+        job = job or (lambda item: item)
+        if not self.__pool:
+            for item in items:
+                yield item, function(job(item))
+            return
+        pending = collections.deque()
+        for item in items:
+            pending.append((item, self.__pool.apply_async(function, (job(item),))))
+            if len(pending) >= self.processes * 2:
+                item, result = pending.popleft()
+                yield item, result.get(timeout)
+        while pending:
+            item, result = pending.popleft()
+            yield item, result.get(timeout)
+
+def sample(source, count, size=None):
+    '''Returns 'count' chunks of 'size' bytes spread evenly through the file
+    'source' (or all of its chunks, if it has fewer).
+    '''
+
+    size = size or chunk_size
+    total = os.path.getsize(source)
+    number = max(1, (total + size - 1) // size)
+    if number <= count:
+        offsets = range(number)
+    else:
+        offsets = [i * number // count for i in range(count)]
+    result = []
+    with open(source, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset * size)
+            data = f.read(size)
+            if data:
+                result.append(data)
+    return result
+
+def tune(source, options=None, samples=None, processes=None, bandwidth=None):
+    '''Finds the best codec and level for compressing the raw image 'source',
+    by compressing a sample of its chunks with each of 'options' (a list of
+    (codec, level), default: the candidates that are available) in parallel.
+
+    The best is the one that would take the least time to compress the whole
+    image and then write it out at 'bandwidth' bytes per second: a smaller
+    image is only worth it if it is not too much slower to make.
+
+    Returns ((codec, level), trials), where 'trials' is the Stats measured for
+    each option (the bytes and elapsed time of the sample alone).
+    '''
+
+    if not options:
+        options = [x for x in candidates if x[0] in available()]
+    size = os.path.getsize(source)
+    trials = []
+    with Workers(processes) as pool:
+        data = sample(source, samples or max(8, pool.processes * 2))
+        for codec, level in options:
+            stats = Stats(codec, level)
+            start = time.time()
+            for chunk, (compressed, checksum) in pool.map(compress_chunk, data,
+                                                          lambda chunk: (codec, level, chunk)):
+                stats.bytes += len(chunk)
+                stats.compressed += len(compressed)
+            stats.elapsed = time.time() - start
+            trials.append(stats)
+    best = min(trials, key=lambda x: x.cost(size, bandwidth))
+    return (best.codec, best.level), trials
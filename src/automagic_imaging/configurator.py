@@ -2,6 +2,38 @@ import collections
 import ConfigParser
 import datetime
 
+def boolean(value):
+    '''Interprets a config file value as true or false. Anything other than
+    the usual affirmative answers (or no value at all) is false.
+    '''
+
+    if not value:
+        return False
+    return str(value).strip().lower() in ['1', 'yes', 'true', 'on']
+
+def size(value):
+    '''Interprets a size such as '200g' or '512m' (or a plain number of bytes)
+    as a number of bytes. The suffixes k, m, g, and t are powers of 1024.
+    Returns None if no value is given.
+    '''
+
+    if value is None or str(value).strip() == '':
+        return None
+    original = value
+    value = str(value).strip().lower()
+    multipliers = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+    multiplier = 1
+    if value[-1] in multipliers:
+        multiplier = multipliers[value[-1]]
+        value = value[:-1]
+    try:
+        result = int(float(value) * multiplier)
+    except ValueError:
+        raise ValueError("Invalid size: '" + str(original) + "'")
+    if result < 0:
+        raise ValueError("Invalid size: '" + str(original) + "'")
+    return result
+
 class Configurator:
     '''Parses the config file for imaging information.
     '''
@@ -37,6 +69,29 @@ class Configurator:
                 image_options[option] = parser.get(images, option)
             self.images[images] = image_options
 
+        # An image can be layered on top of another image section (its base),
+        # but bases can't themselves be layered.
+        for image in self.images:
+            base = self.images[image].get('base')
+            if not base:
+                continue
+            if base not in self.images:
+                raise ValueError("Invalid config file: '" + image + "' uses the base '" + base + "', which is not an image section.")
+            if base == image or self.images[base].get('base'):
+                raise ValueError("Invalid config file: '" + base + "' cannot be a base because it has a base of its own.")
+
+    def bases(self):
+        '''Returns the names of the image sections that other images use as
+        their base.
+        '''
+
+        result = []
+        for image in self.images:
+            base = self.images[image].get('base')
+            if base and base not in result:
+                result.append(base)
+        return result
+
     def __repr__(self):
         result = ''
         result += self.print_globals()
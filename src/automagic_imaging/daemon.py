@@ -0,0 +1,405 @@
+import itertools
+import json
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+# Jobs with at least this priority are urgent: besides jumping ahead of the
+# queue, they have workers of their own, so they start right away even while
+# every other worker is busy with a batch.
+urgent_priority = 1
+# How many finished jobs are remembered for status queries.
+history = 100
+# Where the daemon listens by default.
+default_socket = '/var/run/radmind_auto_image_creator.sock'
+
+class Job:
+    '''A build of one image, queued in a daemon.
+
+    id       - a number that identifies the job
+    image    - the name of the image (its config section)
+    priority - jobs with higher priorities run first (see urgent_priority)
+    after    - the jobs that must succeed before this one can run (such as a
+               build of its base image)
+    base     - the image this one is layered on, if any; that image isn't
+               built again while this job is running
+    state    - 'queued', 'running', 'succeeded', 'failed', or 'cancelled'
+    error    - why the job failed, if it did
+    '''
+
+    def __init__(self, id, image, priority=0, after=None, base=None):
+        self.id = id
+        self.image = image
+        self.priority = priority
+        self.after = after or []
+        self.base = base
+        self.state = 'queued'
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        result = "Job " + str(self.id) + ": " + self.image + " (" + self.state + ", priority " + str(self.priority) + ")"
+        if self.error:
+            result += "\n        Error: " + self.error
+        return result
+
+    def done(self):
+        return self.state in ['succeeded', 'failed', 'cancelled']
+
+    def to_dict(self):
+        return {
+            'id':        self.id,
+            'image':     self.image,
+            'priority':  self.priority,
+            'after':     [x.id for x in self.after],
+            'base':      self.base,
+            'state':     self.state,
+            'error':     self.error,
+            'submitted': self.submitted,
+            'started':   self.started,
+            'finished':  self.finished
+        }
+
+class JobQueue:
+    '''Hands out queued Jobs by priority (and then in the order they were
+    submitted), holding back any job until the jobs it comes after have
+    finished, while another build of the same image is running, and while a
+    build of an image layered on it is running (which reads it as it goes).
+    '''
+
+    def __init__(self):
+        self.jobs = []
+        self.closed = False
+        self.__ids = itertools.count(1)
+        self.__condition = threading.Condition()
+
+    def __repr__(self):
+        with self.__condition:
+            return "JobQueue: " + str(len([x for x in self.jobs if not x.done()])) + " job(s) waiting or running"
+
+    def add(self, image, priority=0, after=None, base=None):
+        '''Queues a build of 'image', which is layered on the image 'base' (if
+        given). If one is already queued (and not yet running), that job is
+        returned instead, with the higher of the two priorities.
+        '''
+
+        with self.__condition:
+            for job in self.jobs:
+                if job.image == image and job.state == 'queued':
+                    job.priority = max(job.priority, priority)
+                    for other in after or []:
+                        if other not in job.after:
+                            job.after.append(other)
+                    job.base = base or job.base
+                    self.__condition.notify_all()
+                    return job
+            job = Job(next(self.__ids), image, priority, after, base)
+            self.jobs.append(job)
+            self.__condition.notify_all()
+            return job
+
+    def get(self, id):
+        '''Returns the job with the number 'id', or None.'''
+        with self.__condition:
+            for job in self.jobs:
+                if job.id == id:
+                    return job
+        return None
+
+    def latest(self, image):
+        '''Returns the most recent job for 'image' that hasn't finished, or
+        None.
+        '''
+
+        with self.__condition:
+            for job in reversed(self.jobs):
+                if job.image == image and not job.done():
+                    return job
+        return None
+
+    def cancel(self, id):
+        '''Cancels the queued job 'id'. Raises a ValueError if there is no such
+        job or it has already started.
+        '''
+
+        with self.__condition:
+            job = self.get(id)
+            if not job:
+                raise ValueError("No job " + str(id) + ".")
+            if job.state != 'queued':
+                raise ValueError("Job " + str(id) + " is " + job.state + " and can't be cancelled.")
+            job.state = 'cancelled'
+            job.finished = time.time()
+            self.__forget()
+            self.__condition.notify_all()
+
+    def next(self, urgent=False):
+        '''Returns the next job that is ready to run and marks it as running,
+        waiting if necessary. Only urgent jobs are returned if 'urgent' is
+        True. Returns None once the queue has been closed.
+        '''
+
+        with self.__condition:
+            while not self.closed:
+                job = self.__ready(urgent)
+                if job:
+                    job.state = 'running'
+                    job.started = time.time()
+                    return job
+                self.__condition.wait(1)
+            return None
+
+    def finish(self, job, success, error=None):
+        '''Records that the running 'job' has finished.'''
+        with self.__condition:
+            job.state = 'succeeded' if success else 'failed'
+            job.error = error
+            job.finished = time.time()
+            self.__forget()
+            self.__condition.notify_all()
+
+    def close(self):
+        '''Stops handing out jobs.'''
+        with self.__condition:
+            self.closed = True
+            self.__condition.notify_all()
+
+    def __ready(self, urgent):
+        # The condition must be held.
+        running = set(x.image for x in self.jobs if x.state == 'running')
+        # The bases of running builds can't be rebuilt under them.
+        running.update(x.base for x in self.jobs if x.state == 'running' and x.base)
+        queued = [x for x in self.jobs if x.state == 'queued']
+        for job in sorted(queued, key=lambda x: (-x.priority, x.id)):
+            if urgent and job.priority < urgent_priority:
+                continue
+            if job.image in running:
+                continue
+            waiting = False
+            failed = None
+            for other in job.after:
+                if not other.done():
+                    waiting = True
+                elif other.state != 'succeeded':
+                    failed = other
+            if failed:
+                # It can never run, so it fails right away.
+                job.state = 'failed'
+                job.error = "'" + failed.image + "' (job " + str(failed.id) + ") did not complete successfully."
+                job.finished = time.time()
+                self.__condition.notify_all()
+                continue
+            if not waiting:
+                return job
+        return None
+
+    def __forget(self):
+        # Keep only the last 'history' finished jobs (the condition must be
+        # held).
+        finished = [x for x in self.jobs if x.done()]
+        for job in finished[:max(0, len(finished) - history)]:
+            self.jobs.remove(job)
+
+class Daemon:
+    '''Builds images from a JobQueue in the background, and takes requests to
+    add, list, and cancel jobs (see handle(), and serve() for the Unix socket
+    they arrive on).
+
+    run            - called with each Job to build it; it succeeds if this
+                     returns a true value
+    plan           - called with the name of an image (or None for every
+                     image) when it is submitted; returns the images to build,
+                     in order, as (image, base) pairs, where 'base' is the
+                     image it is layered on (or None). Raises a ValueError for
+                     an unknown image.
+    workers        - how many jobs may run at once
+    urgent_workers - how many more may run at once for urgent jobs only
+    log            - called with a message when 'run' raises an exception
+                     (the message is also kept as the job's error)
+    '''
+
+    def __init__(self, run, plan, workers=1, urgent_workers=1, log=None):
+        for value, minimum, name in [(workers, 1, 'workers'), (urgent_workers, 0, 'urgent workers')]:
+            try:
+                if int(value) < minimum:
+                    raise ValueError
+            except (TypeError, ValueError):
+                raise ValueError("Invalid number of " + name + ": '" + str(value) + "'")
+        self.run = run
+        self.plan = plan
+        self.workers = int(workers)
+        self.urgent_workers = int(urgent_workers)
+        self.log = log
+        self.queue = JobQueue()
+        self.server = None
+        self.__threads = []
+
+    def __repr__(self):
+        return ("Daemon: " + str(self.workers) + " worker(s) and " + str(self.urgent_workers) +
+                " urgent worker(s)\n       " + repr(self.queue))
+
+    def start(self):
+        '''Starts the worker threads.'''
+        for urgent in [False] * self.workers + [True] * self.urgent_workers:
+            thread = threading.Thread(target=self.__work, args=(urgent,))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def submit(self, image=None, priority=0):
+        '''Queues builds of 'image' (or of every image) at 'priority'. An image
+        is built after any build of its base that is waiting or running.
+        Returns the Jobs.
+        '''
+
+        jobs = []
+        for name, base in self.plan(image):
+            after = []
+            if base:
+                previous = self.queue.latest(base)
+                if previous:
+                    after.append(previous)
+            jobs.append(self.queue.add(name, priority, after, base))
+        return jobs
+
+    def handle(self, request):
+        '''Carries out a request (a dictionary decoded from JSON) and returns
+        the response:
+
+        {'command': 'submit', 'image': NAME, 'priority': N}
+            - queues builds of the image (or every image, without 'image');
+              returns the 'jobs'
+        {'command': 'status', 'id': N}
+            - returns every job that is waiting, running, or recently
+              finished (or only job 'id') as 'jobs'
+        {'command': 'cancel', 'id': N}
+            - cancels a job that hasn't started yet
+
+        Every response has 'ok', and 'error' if it's False.
+        '''
+
+        try:
+            command = request.get('command')
+            if command == 'submit':
+                priority = int(request.get('priority') or 0)
+                jobs = self.submit(request.get('image'), priority)
+            elif command == 'status':
+                if request.get('id') is not None:
+                    job = self.queue.get(int(request['id']))
+                    if not job:
+                        raise ValueError("No job " + str(request['id']) + ".")
+                    jobs = [job]
+                else:
+                    jobs = list(self.queue.jobs)
+            elif command == 'cancel':
+                self.queue.cancel(int(request.get('id')))
+                jobs = [self.queue.get(int(request['id']))]
+            else:
+                raise ValueError("Unknown command: '" + str(command) + "'")
+        except (TypeError, ValueError, AttributeError):
+            return {'ok': False, 'error': str(sys.exc_info()[1])}
+        return {'ok': True, 'jobs': [x.to_dict() for x in jobs]}
+
+    def serve(self, path=None):
+        '''Takes requests on the Unix socket at 'path' (default:
+        default_socket) until stop() is called. Each request and response is
+        a line of JSON. The socket can only be used by the user running the
+        daemon.
+        '''
+
+        path = path or default_socket
+        if os.path.exists(path):
+            # Only replace a socket that nothing is listening on any more.
+            try:
+                request(path, {'command': 'status'}, timeout=5)
+            except (IOError, OSError, ValueError):
+                os.remove(path)
+            else:
+                raise RuntimeError("Another daemon is already listening on '" + path + "'.")
+        daemon = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                for line in iter(self.rfile.readline, ''):
+                    try:
+                        message = json.loads(line)
+                        if not isinstance(message, dict):
+                            raise ValueError("Requests must be JSON objects.")
+                    except ValueError:
+                        response = {'ok': False, 'error': str(sys.exc_info()[1])}
+                    else:
+                        response = daemon.handle(message)
+                    self.wfile.write(json.dumps(response) + '\n')
+                    self.wfile.flush()
+
+        # Nobody else may connect to the socket, even before it is chmod'ed.
+        umask = os.umask(077)
+        try:
+            self.server = Server(path, Handler)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0600)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stop(self, wait=True):
+        '''Stops taking requests and starting jobs. Jobs that are running are
+        allowed to finish (and waited for, if 'wait'); queued jobs are
+        dropped.
+        '''
+
+        self.queue.close()
+        if self.server:
+            self.server.shutdown()
+        if wait:
+            for thread in self.__threads:
+                while thread.is_alive():
+                    thread.join(1)
+
+    def __work(self, urgent):
+        while True:
+            job = self.queue.next(urgent)
+            if job is None:
+                return
+            error = None
+            try:
+                success = bool(self.run(job))
+            except:
+                success = False
+                error = str(sys.exc_info()[1])
+                if self.log:
+                    self.log("Job " + str(job.id) + " (" + job.image + ") failed: " + error)
+            self.queue.finish(job, success, error)
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''Handles each connection to the daemon's socket on its own thread.'''
+    daemon_threads = True
+
+def request(path, message, timeout=30):
+    '''Sends 'message' (a dictionary) to the daemon listening on the Unix
+    socket at 'path' and returns its response.
+    '''
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(path)
+        connection.sendall(json.dumps(message) + '\n')
+        data = ''
+        while not data.endswith('\n'):
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        connection.close()
+    return json.loads(data)
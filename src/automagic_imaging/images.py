@@ -1,27 +1,106 @@
+import errno
+import gzip
+import json
 import os
+import plistlib
+import Queue
 import re
-import subprocess
+import shutil
+import sys
+import tarfile
+import threading
+import time
+
+import compression
+import processes
+
+# The commands used to work with images and volumes. These can be changed to
+# use other copies of the tools (such as the stand-ins in 'benchmarks').
+tools = {
+    'hdiutil':  'hdiutil',
+    'diskutil': 'diskutil',
+    'asr':      'asr',
+    'bless':    '/usr/sbin/bless',
+    'mount':    'mount'
+}
+# Where volumes are mounted.
+volumes = '/Volumes/'
+
+# The mount point of each disk attached by this module, so that the mount
+# table doesn't have to be searched for it.
+devices = {}
+devices_lock = threading.Lock()
+
+# The formats images can be converted to with hdiutil. (Chunked formats, such
+# as 'zlib-9', are handled by the compression module.)
+formats = ['UDRW', 'UDRO', 'UDCO', 'UDZO', 'UDBZ', 'UFBI', 'UDTO', 'UDxx',
+           'UDSP', 'UDSB', 'Rdxx', 'DC42',
+           'UDZO-1', 'UDZO-2', 'UDZO-3', 'UDZO-4', 'UDZO-5', 'UDZO-6',
+           'UDZO-7', 'UDZO-8', 'UDZO-9']
+
+# The kinds of image that can be built in, and the extension of each. A
+# sparse bundle keeps its contents in a directory of small band files, so it
+# can give back freed space (see compact()) without rewriting the whole image.
+image_types = {
+    'SPARSE':       '.sparseimage',
+    'SPARSEBUNDLE': '.sparsebundle'
+}
+
+# What the disk tools print when a volume is busy (such as 'Resource busy'
+# from hdiutil, or a dissenting process from diskutil).
+busy_output = re.compile('busy|dissent', re.IGNORECASE)
+
+# The number of threads used to empty a volume.
+clean_workers = 8
+# Volumes with more entries than this are erased rather than emptied file by
+# file, since erasing takes about the same time no matter what is on them.
+erase_threshold = 50000
+
+class Busy(RuntimeError):
+    '''Raised when a volume can't be blessed or unmounted because it is busy
+    or isn't mounted yet; trying again a little later may work.
+    '''
 
 class Image:
     '''Helps to deal with images more easily. Can mount, unmount, and get all
     relevant information.
+
+    If a 'shadow' file is given, the image itself is never written to: all
+    changes go to the shadow file instead, and are included when the image is
+    converted. Several shadowed Images can share one underlying image.
+
+    A new image ('make') is created with the maximum size 'size' (such as
+    '50g'), or 200 GB if it isn't given, and of the kind 'type' (see
+    image_types; by default, a sparse image).
+
+    Everything is done through a Backend: by default the OS X disk image tools
+    (MacBackend), but also plain directories (DirectoryBackend).
     '''
 
-    def __init__(self, path='', make=False, name=None, volume=None):
+    def __init__(self, path='', make=False, name=None, volume=None, shadow=None,
+                 backend=None, size=None, type=None):
+        self.backend = backend or default_backend
         if make:
             if not name or not volume:
                 raise ValueError("Must specify 'name' and 'volume' to create image.")
-            path = create(image=name, vol=volume)
-        if not os.path.isfile(path):
+            path = self.backend.create(image=name, vol=volume, size=size or '200g',
+                                       type=type or 'SPARSE')
+        # Sparse bundles are directories.
+        if not os.path.exists(path):
             raise ValueError("Invalid path specified: '" + path + "'")
         self.path = os.path.abspath(str(path))
         self.name = os.path.splitext(os.path.basename(self.path))[0]
         if not os.access(self.path, os.R_OK):
             raise ValueError("Image " + self.name + " is not readable.")
+        self.shadow = None
+        if shadow:
+            self.shadow = os.path.abspath(str(shadow))
         self.__revert()
 
     def __repr__(self):
         result = "Image: " + self.name
+        if self.shadow:
+            result += "\n       Shadow file: " + self.shadow
         if self.mounted:
             result += "\n       Full path:   " + self.path
             result += "\n       Disk:        " + self.disk_id
@@ -35,8 +114,8 @@ class Image:
 
     def attach(self):
         if not self.mounted:
-            self.disk_id = attach(self.path)
-            self.mount_point = find_mount(self.disk_id)
+            self.disk_id = self.backend.attach(self.path, self.shadow)
+            self.mount_point = self.backend.find_mount(self.disk_id)
             self.mounted = True
 
     def unmount(self, force=False):
@@ -44,110 +123,618 @@ class Image:
 
     def detach(self, force=False):
         if self.mounted:
-            detach(self.disk_id, force)
+            self.backend.detach(self.disk_id, force)
             self.__revert()
 
     def enable_ownership(self):
         if self.mounted:
-            enable_ownership(self.disk_id)
+            self.backend.enable_ownership(self.disk_id)
 
     def clean(self):
         if self.mounted:
-            clean(self.mount_point)
+            result = self.backend.clean(self.mount_point, self.disk_id)
+            if result.method == 'erased':
+                # The volume is remounted when it is erased.
+                self.mount_point = self.backend.find_mount(self.disk_id)
+            return result
+
+    def verify(self):
+        if self.mounted:
+            self.backend.verify(self.disk_id)
 
     def convert(self, format='', outfile=''):
         if not self.mounted:
-            self.path = convert(self.path, format=format, outfile=outfile)
+            self.path = self.backend.convert(self.path, format=format, outfile=outfile,
+                                             shadow=self.shadow)
+            # The converted image includes everything from the shadow file.
+            self.shadow = None
 
     def scan(self):
         if not self.mounted:
-            scan(self.path)
+            self.backend.scan(self.path)
+
+    def compact(self):
+        # Only the image itself can be compacted, never a shadow file.
+        if not self.mounted and not self.shadow:
+            return self.backend.compact(self.path)
 
     def bless(self, label=None):
         if self.mounted:
-            bless(self.mount_point, label)
+            self.backend.bless(self.mount_point, label)
 
     def rename(self, new_name):
         if self.mounted:
-            rename(self.mount_point, new_name)
-            self.mount_point = find_mount(self.disk_id)
+            self.backend.rename(self.mount_point, new_name)
+            self.mount_point = self.backend.find_mount(self.disk_id)
             self.name = new_name
 
+    def ready(self):
+        '''Returns True once the mounted volume can be used (such as after it
+        has been renamed, which remounts it), updating its mount point.
+        '''
+
+        if self.mounted and self.backend.ready(self.disk_id):
+            self.mount_point = self.backend.find_mount(self.disk_id)
+            return True
+        return False
+
     def __revert(self):
         self.mount_point = ''
         self.disk_id = ''
         self.mounted = False
 
-def create(image, vol='Mac OS X', size='200g'):
+class Backend:
+    '''The operations an Image needs, so that images can be kept in different
+    ways. Subclasses implement each of these:
+
+    create(image, vol, size, type)         - creates a blank image named
+                                             'image'; returns its path
+    attach(image, shadow)                  - attaches an image (writing to
+                                             'shadow', if given); returns its
+                                             disk identifier
+    detach(disk, force)                    - detaches a disk (or volume)
+    find_mount(disk)                       - returns the mount point of a disk
+    ready(disk)                            - returns True if a disk's volume
+                                             is mounted and can be used
+    enable_ownership(disk)                 - enables ownership on a disk
+    verify(disk)                           - checks the filesystem on a disk
+    clean(volume, disk)                    - empties a volume; returns a Reset
+    convert(image, format, outfile, shadow) - writes a read-only copy of an
+                                             image; returns its path
+    scan(image)                            - prepares a converted image for
+                                             restoring
+    compact(image)                         - gives back the space that is no
+                                             longer used in an image; returns
+                                             a Compaction
+    rename(volume, new_name)               - renames a mounted volume
+    bless(volume, label)                   - makes a volume bootable
+    '''
+
+    name = None
+
+    def __repr__(self):
+        return "Backend: " + str(self.name)
+
+    def create(self, image, vol='Mac OS X', size='200g', type='SPARSE'):
+        raise NotImplementedError
+
+    def attach(self, image, shadow=None):
+        raise NotImplementedError
+
+    def detach(self, disk, force=False):
+        raise NotImplementedError
+
+    def find_mount(self, disk):
+        raise NotImplementedError
+
+    def ready(self, disk):
+        raise NotImplementedError
+
+    def enable_ownership(self, disk):
+        raise NotImplementedError
+
+    def verify(self, disk):
+        raise NotImplementedError
+
+    def clean(self, volume, disk=None):
+        raise NotImplementedError
+
+    def convert(self, image, format='', outfile='', shadow=None):
+        raise NotImplementedError
+
+    def scan(self, image):
+        raise NotImplementedError
+
+    def compact(self, image):
+        raise NotImplementedError
+
+    def rename(self, volume, new_name):
+        raise NotImplementedError
+
+    def bless(self, volume, label=None):
+        raise NotImplementedError
+
+class MacBackend(Backend):
+    '''Uses the OS X disk image tools (hdiutil, diskutil, bless and asr)
+    through the functions in this module.
+    '''
+
+    name = 'mac'
+
+    def create(self, image, vol='Mac OS X', size='200g', type='SPARSE'):
+        return create(image, vol, size, type)
+
+    def attach(self, image, shadow=None):
+        return attach(image, shadow)
+
+    def detach(self, disk, force=False):
+        detach(disk, force)
+
+    def find_mount(self, disk):
+        return find_mount(disk)
+
+    def ready(self, disk):
+        return ready(disk)
+
+    def enable_ownership(self, disk):
+        enable_ownership(disk)
+
+    def verify(self, disk):
+        verify(disk)
+
+    def clean(self, volume, disk=None):
+        return clean(volume, disk)
+
+    def convert(self, image, format='', outfile='', shadow=None):
+        return convert(image, format, outfile, shadow)
+
+    def scan(self, image):
+        scan(image)
+
+    def compact(self, image):
+        return compact(image)
+
+    def rename(self, volume, new_name):
+        rename(volume, new_name)
+
+    def bless(self, volume, label=None):
+        bless(volume, label)
+
+class DirectoryBackend(Backend):
+    '''Keeps images as plain directories, so that everything other than the
+    disk image tools themselves can be run on any system (such as Linux), and
+    at full speed.
+
+    An image is a small file describing its volume, with the contents of the
+    volume in a directory beside it (the image's path plus '.contents').
+    Attaching an image moves that directory into 'volumes', and detaching it
+    moves it back. A shadow file gets its own copy of the contents the first
+    time it is attached. Converted images are (gzipped) tar archives.
+
+    volumes - the directory to mount volumes in (default: a 'Volumes'
+              directory beside each image, so that attaching never has to copy
+              between filesystems)
+    '''
+
+    name = 'directory'
+
+    def __init__(self, volumes=None):
+        self.volumes = None
+        if volumes:
+            self.volumes = os.path.abspath(str(volumes))
+        self.__lock = threading.Lock()
+        # Maps each disk identifier to [image, mount point].
+        self.__disks = {}
+        self.__next = 1
+
+    def __repr__(self):
+        return "Backend: " + self.name + " (volumes in '" + str(self.volumes or 'Volumes') + "')"
+
+    def create(self, image, vol='Mac OS X', size='200g', type='SPARSE'):
+        if type not in image_types:
+            raise ValueError("Invalid image type: '" + str(type) + "'")
+        path = os.path.abspath(str(image))
+        if not path.endswith(image_types[type]):
+            path += image_types[type]
+        if os.path.isdir(path + '.contents'):
+            shutil.rmtree(path + '.contents')
+        os.makedirs(path + '.contents')
+        self.__write(path, {'volname': str(vol), 'size': str(size)})
+        return path
+
+    def attach(self, image, shadow=None):
+        source = os.path.abspath(str(image))
+        if not os.path.isfile(source):
+            raise ValueError("Invalid image file specified: '" + str(image) + "'")
+        if shadow:
+            shadow = os.path.abspath(str(shadow))
+            if not os.path.isfile(shadow):
+                # Start the shadow from a copy of the image.
+                if os.path.isdir(shadow + '.contents'):
+                    shutil.rmtree(shadow + '.contents')
+                shutil.copytree(source + '.contents', shadow + '.contents', symlinks=True)
+                self.__write(shadow, self.__read(source))
+            source = shadow
+        info = self.__read(source)
+        with self.__lock:
+            for disk in self.__disks:
+                if self.__disks[disk][0] == source:
+                    raise RuntimeError("The disk '" + str(image) + "' is already attached.")
+            mount = self.__mount_point(self.volumes or os.path.join(os.path.dirname(source), 'Volumes'),
+                                       info['volname'])
+            os.rename(source + '.contents', mount)
+            disk = 'directory' + str(self.__next)
+            self.__next += 1
+            self.__disks[disk] = [source, mount]
+        return disk
+
+    def detach(self, disk, force=False):
+        with self.__lock:
+            disk = self.__find(disk)
+            image, mount = self.__disks[disk]
+            os.rename(mount, image + '.contents')
+            del self.__disks[disk]
+
+    def find_mount(self, disk):
+        with self.__lock:
+            return self.__disks[self.__find(disk)][1]
+
+    def ready(self, disk):
+        with self.__lock:
+            try:
+                mount = self.__disks[self.__find(disk)][1]
+            except ValueError:
+                return False
+        return os.path.isdir(mount)
+
+    def enable_ownership(self, disk):
+        with self.__lock:
+            self.__find(disk)
+
+    def verify(self, disk):
+        with self.__lock:
+            mount = self.__disks[self.__find(disk)][1]
+        if not os.path.isdir(mount):
+            raise RuntimeError("The volume on '" + str(disk) + "' did not pass verification.")
+
+    def clean(self, volume, disk=None):
+        with self.__lock:
+            # Only ever empty a volume that is attached here.
+            self.__find(str(volume).rstrip('/'))
+        start = time.time()
+        removed = empty(volume, clean_workers)
+        return Reset('removed', removed, time.time() - start)
+
+    def convert(self, image, format='', outfile='', shadow=None):
+        source = os.path.abspath(str(shadow or image))
+        if not outfile:
+            outfile = os.path.splitext(os.path.abspath(str(image)))[0]
+        if not outfile.endswith('.dmg'):
+            outfile += '.dmg'
+        if compression.parse(format):
+            # Write the archive uncompressed, then compress it in chunks.
+            raw = outfile + '.raw'
+            try:
+                with tarfile.open(raw, 'w') as archive:
+                    archive.add(source + '.contents', arcname='.')
+                return compress(raw, outfile, format)
+            except (IOError, OSError, tarfile.TarError):
+                raise RuntimeError("The image '" + str(image) + "' was not successfully converted.")
+            finally:
+                if os.path.exists(raw):
+                    os.remove(raw)
+        # Compress as much as the format asks for.
+        level = 0
+        if format == 'UDZO':
+            level = 6
+        elif format.startswith('UDZO-'):
+            level = int(format.split('-')[1])
+        try:
+            with open(outfile, 'wb') as f:
+                if level:
+                    with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=level) as compressed:
+                        with tarfile.open(fileobj=compressed, mode='w') as archive:
+                            archive.add(source + '.contents', arcname='.')
+                else:
+                    with tarfile.open(fileobj=f, mode='w') as archive:
+                        archive.add(source + '.contents', arcname='.')
+        except (IOError, OSError, tarfile.TarError):
+            raise RuntimeError("The image '" + str(image) + "' was not successfully converted.")
+        return outfile
+
+    def scan(self, image):
+        if not os.path.isfile(image):
+            raise ValueError("Invalid image file specified: '" + str(image) + "'")
+        try:
+            if compression.is_chunked(image):
+                with compression.Reader(image) as reader:
+                    with tarfile.open(fileobj=reader, mode='r|') as archive:
+                        for member in archive:
+                            pass
+            else:
+                with tarfile.open(image, 'r') as archive:
+                    for member in archive:
+                        pass
+        except (IOError, ValueError, tarfile.TarError):
+            raise RuntimeError("Image could not be scanned properly.")
+
+    def compact(self, image):
+        # Removed files are gone from the directory already.
+        size = allocated(image) + allocated(image + '.contents')
+        return Compaction(size, size, 0)
+
+    def rename(self, volume, new_name):
+        with self.__lock:
+            disk = self.__find(str(volume).rstrip('/'))
+            image, mount = self.__disks[disk]
+            new_mount = self.__mount_point(os.path.dirname(mount), str(new_name))
+            os.rename(mount, new_mount)
+            self.__disks[disk][1] = new_mount
+            info = self.__read(image)
+            info['volname'] = str(new_name)
+            self.__write(image, info)
+
+    def bless(self, volume, label=None):
+        if not os.path.isdir(str(volume)):
+            raise Busy("Volume '" + str(volume) + "' is not mounted yet.")
+        if not os.path.isdir(os.path.join(str(volume), 'System/Library/CoreServices')):
+            raise RuntimeError("Volume '" + str(volume) + "' could not be blessed.")
+
+    def __find(self, disk):
+        # Disks can be given by identifier or by mount point.
+        for identifier in self.__disks:
+            if identifier == disk or self.__disks[identifier][1] == disk:
+                return identifier
+        raise ValueError("Invalid disk specified: '" + str(disk) + "'")
+
+    def __mount_point(self, volumes, name):
+        # Number the mount point if the name is taken, as OS X does.
+        if not os.path.isdir(volumes):
+            os.makedirs(volumes)
+        mount = os.path.join(volumes, name)
+        number = 1
+        while os.path.exists(mount):
+            mount = os.path.join(volumes, name + ' ' + str(number))
+            number += 1
+        return mount
+
+    def __read(self, path):
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def __write(self, path, info):
+        with open(path, 'w') as f:
+            json.dump(info, f)
+
+def backend(name, volumes=None):
+    '''Returns a new Backend by its name: 'mac' or 'directory' (which keeps
+    its volumes in 'volumes').
+    '''
+
+    if not name or name == MacBackend.name:
+        return MacBackend()
+    if name == DirectoryBackend.name:
+        return DirectoryBackend(volumes)
+    raise ValueError("Invalid image backend: '" + str(name) + "'")
+
+default_backend = MacBackend()
+
+def create(image, vol='Mac OS X', size='200g', type='SPARSE'):
     '''Creates a blank sparse image.
 
     image - the name of the image
     vol   - the name of the volume once mounted
     size  - the maximum size of the sparse image
+    type  - 'SPARSE' for a sparse image (one file) or 'SPARSEBUNDLE' for a
+            sparse bundle (a directory of bands)
     '''
 
-    result = subprocess.check_output(['hdiutil', 'create', '-size', str(size),
-                                      '-type', 'SPARSE', '-ov', '-fs', 'HFS+J',
-                                      '-volname', str(vol), str(image)])
+    if type not in image_types:
+        raise ValueError("Invalid image type: '" + str(type) + "'")
+    result = processes.check_output([tools['hdiutil'], 'create', '-size', str(size),
+                                     '-type', type, '-ov', '-fs', 'HFS+J',
+                                     '-volname', str(vol), str(image)])
 
     if not result.startswith('created: '):
         raise RuntimeError("The image '" + str(image) + "' was not created properly.")
 
     return result.strip('\n').split(': ')[1]
 
-def convert(image, format='', outfile=''):
+def compact(image):
+    '''Gives back the space in the sparse image (or sparse bundle) 'image'
+    that its volume no longer uses, so that converting it doesn't have to read
+    it. The image must not be attached. Returns a Compaction.
+    '''
+
+    before = allocated(image)
+    start = time.time()
+    result = processes.call([tools['hdiutil'], 'compact', str(image), '-batteryallowed'])
+    if result != 0:
+        raise RuntimeError("The image '" + str(image) + "' could not be compacted.")
+    return Compaction(before, allocated(image), time.time() - start)
+
+def allocated(path):
+    '''Returns the space the image at 'path' takes up on disk: the size of the
+    file, or the total of the files in it for a sparse bundle.
+    '''
+
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    total = 0
+    for directory, dirs, names in os.walk(path):
+        for name in names:
+            full = os.path.join(directory, name)
+            if os.path.isfile(full) and not os.path.islink(full):
+                total += os.path.getsize(full)
+    return total
+
+def image_path(directory, name, type='SPARSE'):
+    '''Returns the path of the image 'name' in 'directory': whichever kind of
+    image (see image_types) exists there, 'type' first, or the path an image
+    of 'type' would have.
+    '''
+
+    path = os.path.join(directory, name + image_types[type])
+    for extension in [image_types[type]] + sorted(image_types.values()):
+        if os.path.exists(os.path.join(directory, name + extension)):
+            return os.path.join(directory, name + extension)
+    return path
+
+def delete(path):
+    '''Deletes the image at 'path', whether it's a file or a sparse bundle.'''
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+def convert(image, format='', outfile='', shadow=None):
     '''Converts an image to another format. Default is read-only.
 
     image   - path of the image to be converted
-    format  - the desired format
+    format  - the desired format; a chunked format (see compress()) makes an
+              uncompressed image first and then compresses it in chunks
     outfile - the name of the output file (defaults to the input file basename)
+    shadow  - a shadow file holding changes to the image (optional)
     '''
 
     if not outfile:
         outfile = os.path.splitext(os.path.abspath(image))[0]
     if not format:
         format = 'UDRO'
+    check_format(format)
 
-    formats = ['UDRW', 'UDRO', 'UDCO', 'UDZO', 'UDBZ', 'UFBI', 'UDTO', 'UDxx',
-               'UDSP', 'UDSB', 'Rdxx', 'DC42',
-               'UDZO-1', 'UDZO-2', 'UDZO-3', 'UDZO-4', 'UDZO-5', 'UDZO-6',
-               'UDZO-7', 'UDZO-8', 'UDZO-9']
-    if format not in formats:
-        raise ValueError("Invalid format specified: '" + format + "'")
+    if compression.parse(format):
+        raw = os.path.splitext(outfile)[0] + '.raw.dmg'
+        try:
+            convert(image, 'UDRO', raw, shadow)
+            # Scan the uncompressed image, so that it can be restored with asr
+            # once it has been decompressed.
+            scan(raw)
+            return compress(raw, outfile, format)
+        finally:
+            if os.path.exists(raw):
+                os.remove(raw)
 
-    result = subprocess.call(['hdiutil', 'convert', str(image), '-format',
-                              str(format), '-o', str(outfile)],
-                             stderr=subprocess.STDOUT,
-                             stdout=open(os.devnull, 'w'))
+    command = [tools['hdiutil'], 'convert', str(image), '-format', str(format),
+               '-o', str(outfile)]
+    if shadow:
+        command.extend(['-shadow', str(shadow)])
+    result = processes.call(command)
 
     if result != 0:
         raise RuntimeError("The image '" + str(image) + "' was not successfully converted.")
 
     return outfile
 
-def attach(image):
+def check_format(format):
+    '''Raises a ValueError if images can't be converted to 'format' (an
+    hdiutil format, or a chunked format such as 'zlib-9' or 'auto').
+    '''
+
+    if format not in formats and not compression.parse(format):
+        raise ValueError("Invalid format specified: '" + str(format) + "'")
+
+def compress(raw, outfile, format):
+    '''Compresses the uncompressed image 'raw' into a chunked image (see the
+    compression module) at 'outfile' plus compression.extension, using every
+    core. Returns the path of the chunked image.
+
+    raw     - the path of the uncompressed image
+    outfile - the name of the output file
+    format  - the codec and level, such as 'zlib-9', 'bzip2', or 'lzma-6'; or
+              'auto' to try each on a sample of the image and pick the one
+              that takes the least time overall
+    '''
+
+    codec, level = compression.parse(format)
+    if codec == 'auto':
+        (codec, level), trials = compression.tune(raw)
+    path = outfile + compression.extension
+    try:
+        compression.compress(raw, path, codec, level)
+    except (IOError, OSError, ValueError):
+        raise RuntimeError("The image '" + str(raw) + "' was not successfully compressed.")
+    return path
+
+def attach(image, shadow=None):
     '''Mounts an image and returns the disk identifier in /dev/diskNsX format.
+    The mount point is remembered for find_mount().
 
-    image - the path of the image to be mounted
+    image  - the path of the image to be mounted
+    shadow - a shadow file to write changes to instead of the image (optional;
+             it is created if it doesn't exist)
     '''
 
-    if os.path.isfile(image):
+    if os.path.exists(image):
         # Mount the image, and retain the outputted information.
-        hdiutil = subprocess.check_output(['hdiutil', 'attach', str(image)])
+        command = [tools['hdiutil'], 'attach', str(image), '-plist']
+        if shadow:
+            command.extend(['-shadow', str(shadow)])
+        hdiutil = read_plist(processes.check_output(command))
 
-        # Get the disk identifier from the output:
+        # Get the disk identifier of the mounted volume from the output:
         disk = ''
-        for line in hdiutil.split('\n'):
-            columns = line.split('\t')
-            if len(columns) == 3 and columns[2]:
-                disk = columns[0].rstrip()
+        mount = ''
+        for entity in hdiutil.get('system-entities', []):
+            if entity.get('mount-point') and entity.get('dev-entry'):
+                disk = entity['dev-entry']
+                mount = entity['mount-point']
         if not disk:
             raise RuntimeError("The disk '" + str(image) + "' did not mount properly.")
         else:
+            with devices_lock:
+                devices[disk] = mount
             return disk
     else:
         raise ValueError("Invalid image file specified: + '" + str(image) + "'")
 
+def read_plist(output):
+    '''Parses the XML property list printed by a tool such as 'hdiutil ...
+    -plist' (ignoring anything printed before it).
+    '''
+
+    start = output.find('<?xml')
+    if start < 0:
+        raise RuntimeError("No property list was returned.")
+    return plistlib.readPlistFromString(output[start:])
+
+def info(disk):
+    '''Returns the information 'diskutil info' has about a disk (or volume) as
+    a dictionary, and updates the remembered mount point of the disk.
+
+    disk - the disk identifier in /dev/diskN format (or a mount point)
+    '''
+
+    result = read_plist(processes.check_output([tools['diskutil'], 'info', '-plist', str(disk)]))
+    if result.get('DeviceNode'):
+        with devices_lock:
+            if result.get('MountPoint'):
+                devices[result['DeviceNode']] = result['MountPoint']
+            elif result['DeviceNode'] in devices:
+                del devices[result['DeviceNode']]
+    return result
+
+def system_version(volume):
+    '''Returns the OS version and build (such as ('10.9.3', '13D65')) of the
+    system on a volume, from its SystemVersion.plist (the file used by
+    `/usr/bin/sw_vers`).
+
+    volume - the root of the volume
+    '''
+
+    path = os.path.join(str(volume), 'System/Library/CoreServices/SystemVersion.plist')
+    try:
+        values = plistlib.readPlist(path)
+    except IOError:
+        raise RuntimeError("The volume '" + str(volume) + "' has no SystemVersion.plist.")
+    except:
+        # plistlib only reads XML; have plutil convert anything else.
+        values = plistlib.readPlistFromString(
+            processes.check_output(['plutil', '-convert', 'xml1', '-o', '-', path]))
+    if not values.get('ProductVersion') or not values.get('ProductBuildVersion'):
+        raise RuntimeError("The system version on '" + str(volume) + "' is incomplete.")
+    return values['ProductVersion'], values['ProductBuildVersion']
+
 def detach(disk, force=False):
     '''Unmounts the image.
 
@@ -156,51 +743,94 @@ def detach(disk, force=False):
 
     if re.match('/dev/', str(disk)):
         detach = [
-            'hdiutil',
+            tools['hdiutil'],
             'detach',
             str(disk)
         ]
         if force:
             detach.append('-force')
-        result = subprocess.call(detach,
-                                 stderr=subprocess.STDOUT,
-                                 stdout=open(os.devnull, 'w'))
-        if result != 0:
-            raise RuntimeError("Disk did not unmount successfully.")
-    elif re.match('/Volumes/', str(disk)):
+        check_disk_tool(detach, "Disk did not unmount successfully.")
+        forget(disk)
+    elif str(disk).startswith(volumes):
         unmountDisk = [
-            'diskutil',
+            tools['diskutil'],
             'unmountDisk'
         ]
         if force:
             unmountDisk.append('force')
         unmountDisk.append(str(disk))
-        result = subprocess.call(unmountDisk,
-                                 stderr=subprocess.STDOUT,
-                                 stdout=open(os.devnull, 'w'))
-        if result != 0:
-            raise RuntimeError("Disk did not unmount successfully.")
+        check_disk_tool(unmountDisk, "Disk did not unmount successfully.")
+        forget(disk)
     else:
         raise ValueError("Invalid disk specified: '" + str(disk) + "'")
 
+def check_disk_tool(command, message):
+    '''Runs the disk tool 'command'. If it fails, raises Busy with 'message'
+    if it says the volume is busy (so that it can be tried again), or a
+    RuntimeError otherwise.
+    '''
+
+    process = processes.runner.run(command, capture=True)
+    if process.returncode != 0:
+        if busy_output.search(process.stdout() + process.stderr()):
+            raise Busy(message + " The volume is busy.")
+        raise RuntimeError(message)
+
+def forget(disk):
+    '''Forgets the remembered mount point of a disk (given by identifier or
+    mount point) once it has been detached.
+    '''
+
+    with devices_lock:
+        for device in devices.keys():
+            if device == disk or devices[device] == disk:
+                del devices[device]
+
+def disk_for(volume):
+    '''Returns the disk identifier remembered for a mount point, or None.'''
+    volume = str(volume).rstrip('/')
+    with devices_lock:
+        for device in devices:
+            if devices[device] == volume:
+                return device
+    return None
+
 def find_mount(disk):
     '''Takes in a disk identifier in /dev/diskN format and finds its mountpoint.
+    Disks attached with attach() are remembered; the mount table is only
+    searched for any others.
 
     disk - the disk identifier
     '''
 
     if not re.match('/dev/', str(disk)):
         raise ValueError("Invalid disk given; must be in /dev/diskN format.")
+    with devices_lock:
+        if disk in devices:
+            return devices[disk]
+    mount = processes.check_output([tools['mount']]).split('\n')
+    result = ''
+    for line in mount:
+        if re.match(disk, line):
+            result = re.search('on ([^(]*)', line).group()[3:-1]
+    if not result:
+        raise RuntimeError("The mount point could not be found for " + str(disk))
     else:
-        mount = subprocess.check_output(['mount']).split('\n')
-        result = ''
-        for line in mount:
-            if re.match(disk, line):
-                result = re.search('on ([^(]*)', line).group()[3:-1]
-        if not result:
-            raise RuntimeError("The mount point could not be found for " + str(disk))
-        else:
-            return result
+        return result
+
+def ready(disk):
+    '''Returns True if the volume on a disk is mounted (as Disk Arbitration
+    sees it) and its mount point is there, such as once it has been remounted
+    after being renamed. Updates the remembered mount point of the disk.
+
+    disk - the disk identifier in /dev/diskN format
+    '''
+
+    try:
+        mount = info(disk).get('MountPoint')
+    except:
+        return False
+    return bool(mount) and os.path.isdir(mount)
 
 def enable_ownership(disk):
     '''Enables ownership on the specified disk.
@@ -208,37 +838,199 @@ def enable_ownership(disk):
     disk - the disk identifier in /dev/diskN format
     '''
 
-    if re.match('/dev/', str(disk)) or re.match('/Volumes/', str(disk)):
-        result = subprocess.call(['diskutil', 'enableOwnership', str(disk)],
-                                 stderr=subprocess.STDOUT,
-                                 stdout=open(os.devnull, 'w'))
+    if re.match('/dev/', str(disk)) or str(disk).startswith(volumes):
+        result = processes.call([tools['diskutil'], 'enableOwnership', str(disk)])
         if result != 0:
             raise RuntimeError("Ownership could not be enabled properly.")
     else:
         raise ValueError("Invalid disk given: '" + str(disk) + "'; must be in /dev/diskN format.")
 
-def clean(volume):
-    '''Removes all contents on the specified volume. Does not check for
-    permissions.
+def verify(disk):
+    '''Verifies the filesystem on the specified disk.
 
-    volume - the volume to be cleaned
+    disk - the disk identifier in /dev/diskN format
     '''
 
-    if not re.match('/Volumes/', str(volume)):
-        raise ValueError("Invalid volume specified: '" + str(volume) + "'; must be mounted in /Volumes/")
-    else:
-        if not volume.endswith('/'):
-            volume += '/'
-        result = subprocess.call(['rm', '-rf', str(volume) + '*'],
-                                 stderr=subprocess.STDOUT,
-                                 stdout=open(os.devnull, 'w'))
-        if result != 0:
-            raise RuntimeError("Contents of the volume '" + str(volume) + "' could not be removed.")
-        result = subprocess.call(['rm', '-rf', str(volume) + '.*'],
-                                 stderr=subprocess.STDOUT,
-                                 stdout=open(os.devnull, 'w'))
+    if re.match('/dev/', str(disk)) or str(disk).startswith(volumes):
+        result = processes.call([tools['diskutil'], 'verifyVolume', str(disk)])
         if result != 0:
-            raise RuntimeError("Contents of the volume '" + str(volume) + "' could not be removed.")
+            raise RuntimeError("The volume on '" + str(disk) + "' did not pass verification.")
+    else:
+        raise ValueError("Invalid disk given: '" + str(disk) + "'; must be in /dev/diskN format.")
+
+class Reset:
+    '''Describes how a volume was cleaned.
+
+    method  - 'removed' (emptied file by file) or 'erased' (reinitialized)
+    entries - the number of entries that were removed (or that the volume held
+              before it was erased)
+    elapsed - the number of seconds it took
+    '''
+
+    def __init__(self, method, entries, elapsed):
+        self.method = method
+        self.entries = entries
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return ("Reset: " + self.method + " " + str(self.entries) + " entries in " +
+                str(round(self.elapsed, 2)) + "s")
+
+class Compaction:
+    '''Describes how an image was compacted.
+
+    before  - the space the image took up on disk before
+    after   - the space it takes up now
+    elapsed - the number of seconds it took
+    '''
+
+    def __init__(self, before, after, elapsed):
+        self.before = before
+        self.after = after
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return ("Compaction: " + str(self.reclaimed()) + " of " + str(self.before) + " bytes reclaimed in " +
+                str(round(self.elapsed, 2)) + "s")
+
+    def reclaimed(self):
+        return max(0, self.before - self.after)
+
+def clean(volume, disk=None, workers=None, threshold=None):
+    '''Removes all contents on the specified volume. Does not check for
+    permissions. Returns a Reset describing what was done.
+
+    volume    - the volume to be cleaned
+    disk      - the disk identifier of the volume in /dev/diskN format
+                (optional; without it, the volume is never erased)
+    workers   - the number of threads removing entries (default: clean_workers)
+    threshold - erase the volume instead if it has more entries than this
+                (default: erase_threshold)
+    '''
+
+    if not str(volume).startswith(volumes):
+        raise ValueError("Invalid volume specified: '" + str(volume) + "'; must be mounted in " + volumes)
+    if workers is None:
+        workers = clean_workers
+    if threshold is None:
+        threshold = erase_threshold
+
+    start = time.time()
+    entries = count_entries(volume)
+    if disk and entries is not None and entries > threshold:
+        erase(volume, disk)
+        return Reset('erased', entries, time.time() - start)
+    removed = empty(volume, workers)
+    return Reset('removed', removed, time.time() - start)
+
+def count_entries(volume):
+    '''Returns the number of files and folders in use on the volume, as
+    reported by the filesystem (without walking it), or None if it can't tell.
+    '''
+
+    try:
+        info = os.statvfs(str(volume))
+    except OSError:
+        return None
+    if not info.f_files or info.f_ffree > info.f_files:
+        return None
+    return info.f_files - info.f_ffree
+
+def erase(volume, disk):
+    '''Reinitializes the volume with an empty filesystem, keeping its name.
+
+    volume - the volume to be erased in /Volumes/
+    disk   - the disk identifier of the volume in /dev/diskN format
+    '''
+
+    if not re.match('/dev/', str(disk)):
+        raise ValueError("Invalid disk given: '" + str(disk) + "'; must be in /dev/diskN format.")
+    name = os.path.basename(str(volume).rstrip('/'))
+    result = processes.call([tools['diskutil'], 'eraseVolume', 'JHFS+', name, str(disk)])
+    if result != 0:
+        raise RuntimeError("The volume '" + str(volume) + "' could not be erased.")
+    # The volume is remounted, perhaps somewhere else.
+    info(disk)
+    # Erasing turns ownership back off.
+    enable_ownership(disk)
+
+def empty(directory, workers=1):
+    '''Removes everything inside 'directory' (but not the directory itself),
+    using 'workers' threads. Returns the number of entries removed.
+
+    Each thread lists a directory and removes everything in it except its
+    subdirectories, which are queued for the threads in turn. Once every
+    directory has been emptied, they are removed deepest first.
+    '''
+
+    directories = Queue.Queue()
+    directories.put(str(directory))
+    emptied = []
+    removed = [0]
+    errors = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            path = directories.get()
+            if path is None:
+                directories.task_done()
+                return
+            try:
+                count = 0
+                for name in os.listdir(path):
+                    full = os.path.join(path, name)
+                    if os.path.isdir(full) and not os.path.islink(full):
+                        directories.put(full)
+                    else:
+                        remove(full, os.remove)
+                        count += 1
+                with lock:
+                    emptied.append(path)
+                    removed[0] += count
+            except:
+                with lock:
+                    errors.append(path + ": " + str(sys.exc_info()[1]))
+            finally:
+                directories.task_done()
+
+    threads = []
+    for i in range(max(1, int(workers))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    directories.join()
+    # Everything has been emptied; let the threads finish.
+    for thread in threads:
+        directories.put(None)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise RuntimeError("Contents of '" + str(directory) + "' could not be removed: " + errors[0])
+
+    # The directory itself is the first one emptied and must stay.
+    emptied.remove(str(directory))
+    emptied.sort(key=lambda path: path.count(os.sep), reverse=True)
+    for path in emptied:
+        remove(path, os.rmdir)
+    return removed[0] + len(emptied)
+
+def remove(path, function):
+    '''Removes 'path' with 'function' (os.remove or os.rmdir), clearing any
+    flags (such as 'uchg') that prevent it. Entries that have already gone are
+    ignored.
+    '''
+
+    try:
+        function(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        if not hasattr(os, 'lchflags'):
+            raise
+        os.lchflags(path, 0)
+        function(path)
 
 def bless(volume, label=None):
     '''Blesses a volume for bootability.
@@ -249,9 +1041,11 @@ def bless(volume, label=None):
 
     if not volume.endswith('/'):
         volume += '/'
+    if not os.path.isdir(volume):
+        raise Busy("Volume '" + str(volume) + "' is not mounted yet.")
 
     bless = [
-        '/usr/sbin/bless',
+        tools['bless'],
         '--folder', str(volume) + 'System/Library/CoreServices',
         '--file', str(volume) + 'System/Library/CoreServices/boot.efi'
     ]
@@ -259,11 +1053,7 @@ def bless(volume, label=None):
         bless.append('--label')
         bless.append(str(label))
 
-    result = subprocess.call(bless,
-                             stderr=subprocess.STDOUT,
-                             stdout=open(os.devnull, 'w'))
-    if result != 0:
-        raise RuntimeError("Volume '" + str(volume) + "' could not be blessed.")
+    check_disk_tool(bless, "Volume '" + str(volume) + "' could not be blessed.")
 
 def scan(image):
     '''Performs an imagescan on the image.
@@ -271,10 +1061,15 @@ def scan(image):
     image - image to be scanned
     '''
 
-    if os.path.isfile(image):
-        result = subprocess.call(['asr', 'imagescan', '--source', str(image)],
-                                 stderr=subprocess.STDOUT,
-                                 stdout=open(os.devnull, 'w'))
+    if os.path.isfile(image) and compression.is_chunked(image):
+        # Chunked images were scanned before they were compressed; make sure
+        # they decompress correctly.
+        try:
+            compression.verify(image)
+        except (IOError, ValueError):
+            raise RuntimeError("Image could not be scanned properly.")
+    elif os.path.isfile(image):
+        result = processes.call([tools['asr'], 'imagescan', '--source', str(image)])
         if result != 0:
             raise RuntimeError("Image could not be scanned properly.")
     else:
@@ -288,13 +1083,15 @@ def rename(volume, new_name):
     new_name - the new name for the mounted volume
     '''
 
-    if not re.match('/Volumes/', str(volume)):
-        raise ValueError("Invalid volume specified: '" + str(volume) + "'; must be mounted in /Volumes/")
+    if not str(volume).startswith(volumes):
+        raise ValueError("Invalid volume specified: '" + str(volume) + "'; must be mounted in " + volumes)
     else:
         if not volume.endswith('/'):
             volume += '/'
-        result = subprocess.call(['diskutil', 'rename', str(volume), str(new_name)],
-                                 stderr=subprocess.STDOUT,
-                                 stdout=open(os.devnull, 'w'))
+        disk = disk_for(volume)
+        result = processes.call([tools['diskutil'], 'rename', str(volume), str(new_name)])
         if result != 0:
             raise RuntimeError("The volume '" + str(volume) + "' could not be renamed.")
+        if disk:
+            # The mount point follows the new name; ask where it is now.
+            info(disk)
@@ -0,0 +1,114 @@
+import json
+import os
+import threading
+import time
+
+# Added to the name of an image (in the temporary directory) for its journal.
+extension = '.journal.json'
+
+def journal_path(directory, image):
+    '''Returns where the journal of 'image' is kept in 'directory'.'''
+    return os.path.join(directory, image + extension)
+
+class Journal:
+    '''Records the stages of one build of an image as they complete, along with
+    what each one produced (its artifacts), so that a build that fails can be
+    resumed after the last stage that completed instead of starting over.
+
+    Besides the stages, the journal holds values that apply to the whole build
+    (such as the path of the sparse image). It is kept in a JSON file that is
+    rewritten in full after every change, so it is never left half-written.
+    '''
+
+    def __init__(self, path):
+        self.path = os.path.abspath(str(path))
+        self.__lock = threading.Lock()
+        self.__values = {}
+        # Pairs of [stage, artifacts], in the order they completed.
+        self.__stages = []
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    saved = json.load(f)
+                self.__values = saved['values']
+                self.__stages = saved['stages']
+            except (IOError, ValueError, KeyError, TypeError):
+                # A damaged journal just means starting over.
+                self.__values = {}
+                self.__stages = []
+
+    def __repr__(self):
+        result = "Journal: " + self.path
+        with self.__lock:
+            for key in sorted(self.__values):
+                result += "\n       " + key + ": " + str(self.__values[key])
+            for stage, artifacts in self.__stages:
+                result += "\n       Completed " + stage
+        return result
+
+    def start(self, **values):
+        '''Begins a new build, forgetting any earlier one, with 'values'.'''
+        with self.__lock:
+            self.__values = dict(values)
+            self.__values['started'] = time.time()
+            self.__stages = []
+            self.__save()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            return self.__values.get(key, default)
+
+    def update(self, **values):
+        '''Records 'values' for the whole build.'''
+        with self.__lock:
+            self.__values.update(values)
+            self.__save()
+
+    def complete(self, stage, **artifacts):
+        '''Records that 'stage' has completed, producing 'artifacts' (which
+        must be JSON-serializable).
+        '''
+
+        artifacts['finished'] = time.time()
+        with self.__lock:
+            self.__stages = [x for x in self.__stages if x[0] != stage]
+            self.__stages.append([stage, artifacts])
+            self.__save()
+
+    def completed(self):
+        '''Returns the names of the completed stages, in order.'''
+        with self.__lock:
+            return [x[0] for x in self.__stages]
+
+    def artifacts(self, stage):
+        '''Returns what 'stage' produced, or None if it hasn't completed.'''
+        with self.__lock:
+            for name, artifacts in self.__stages:
+                if name == stage:
+                    return dict(artifacts)
+        return None
+
+    def rewind(self, stage):
+        '''Forgets 'stage' and every stage that completed after it, so that
+        they are run again.
+        '''
+
+        with self.__lock:
+            names = [x[0] for x in self.__stages]
+            if stage in names:
+                self.__stages = self.__stages[:names.index(stage)]
+                self.__save()
+
+    def clear(self):
+        '''Forgets the build and removes the journal file.'''
+        with self.__lock:
+            self.__values = {}
+            self.__stages = []
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+
+    def __save(self):
+        # The lock must be held.
+        with open(self.path + '.new', 'w') as f:
+            json.dump({'values': self.__values, 'stages': self.__stages}, f, indent=4, sort_keys=True)
+        os.rename(self.path + '.new', self.path)
@@ -0,0 +1,232 @@
+import collections
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+import transcript
+
+# The prefix of every Prometheus metric name.
+prefix = 'automagic_imaging'
+
+class Stage:
+    '''The measurements of a single stage of an image build.
+
+    name    - the name of the stage (see scheduler.stage_resources)
+    start   - when the stage began
+    elapsed - the wall time it took, in seconds
+    bytes   - the number of bytes it processed, or None if that doesn't apply
+    success - whether it completed without an error
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.elapsed = 0
+        self.bytes = None
+        self.success = False
+
+    def __repr__(self):
+        result = "Stage: " + self.name + " (" + str(round(self.elapsed, 2)) + "s"
+        if self.bytes is not None:
+            result += ", " + str(self.bytes) + " bytes"
+        if not self.success:
+            result += ", failed"
+        return result + ")"
+
+    def throughput(self):
+        '''Returns the bytes processed per second, or None.'''
+        if self.bytes is None or not self.elapsed:
+            return None
+        return self.bytes / self.elapsed
+
+    def to_dict(self):
+        return {
+            'elapsed':    self.elapsed,
+            'bytes':      self.bytes,
+            'throughput': self.throughput(),
+            'success':    self.success
+        }
+
+class Metrics:
+    '''Collects the timing and throughput of every stage of every image built
+    during a run, and writes them out as JSON and for the Prometheus
+    textfile collector.
+
+    Use stage() in a 'with' statement around each stage:
+
+    metrics = Metrics()
+    with metrics.stage('My Image', 'fsdiff') as stage:
+        # Run fsdiff...
+        stage.bytes = os.path.getsize(fsdiff_output)
+
+    Stages from several images may be recorded at the same time.
+    '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.end = None
+        self.images = collections.OrderedDict()
+        self.results = {}
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        result = "Metrics:"
+        with self.__lock:
+            for image in self.images:
+                result += "\n       " + image + ":"
+                for stage in self.images[image].values():
+                    result += "\n           " + repr(stage)
+        return result
+
+    @contextlib.contextmanager
+    def stage(self, image, name):
+        '''Times the 'with' block as the stage 'name' of 'image', and yields
+        the Stage so that the bytes it processed can be filled in. A stage that
+        raises is recorded as failed.
+        '''
+
+        stage = Stage(name)
+        with self.__lock:
+            self.images.setdefault(image, collections.OrderedDict())[name] = stage
+        stage.start = time.time()
+        try:
+            yield stage
+            stage.success = True
+        finally:
+            stage.elapsed = time.time() - stage.start
+
+    def finish(self, image, success):
+        '''Records whether 'image' was produced successfully.'''
+        with self.__lock:
+            self.results[image] = bool(success)
+
+    def to_dict(self):
+        '''Returns all of the measurements as a dictionary (suitable for
+        JSON).
+        '''
+
+        end = self.end or time.time()
+        result = {
+            'start':   datetime.datetime.fromtimestamp(self.start).strftime('%Y-%m-%d %H:%M:%S'),
+            'elapsed': end - self.start,
+            'images':  collections.OrderedDict()
+        }
+        with self.__lock:
+            for image in self.images:
+                stages = self.images[image]
+                elapsed = 0
+                if stages:
+                    first = min(stage.start for stage in stages.values())
+                    last = max(stage.start + stage.elapsed for stage in stages.values())
+                    elapsed = last - first
+                result['images'][image] = {
+                    'elapsed': elapsed,
+                    'success': self.results.get(image),
+                    'stages':  collections.OrderedDict(
+                        (name, stages[name].to_dict()) for name in stages
+                    )
+                }
+        return result
+
+    def write(self, directory):
+        '''Writes the measurements for this run to 'directory': a JSON file
+        named for the time the run began, and 'automagic_imaging.prom' for the
+        Prometheus textfile collector (which replaces the previous run's).
+        Returns the paths of both files.
+        '''
+
+        self.end = time.time()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        date = datetime.datetime.fromtimestamp(self.start).strftime('%Y.%m.%d_%H%M%S')
+        json_path = os.path.join(directory, 'metrics_' + date + '.json')
+        prom_path = os.path.join(directory, prefix + '.prom')
+        self.write_json(json_path)
+        self.write_prometheus(prom_path)
+        return json_path, prom_path
+
+    def write_json(self, path):
+        replace(path, json.dumps(self.to_dict(), indent=4) + '\n')
+
+    def write_prometheus(self, path):
+        replace(path, self.prometheus())
+
+    def prometheus(self):
+        '''Returns the measurements in the Prometheus text format.'''
+        data = self.to_dict()
+        lines = []
+
+        def metric(name, help, samples):
+            if not samples:
+                return
+            lines.append('# HELP ' + prefix + '_' + name + ' ' + help)
+            lines.append('# TYPE ' + prefix + '_' + name + ' gauge')
+            for label, value in samples:
+                lines.append(prefix + '_' + name + label + ' ' + repr(float(value)))
+
+        stages = []
+        for image in data['images']:
+            for name in data['images'][image]['stages']:
+                stages.append((labels(image=image, stage=name), data['images'][image]['stages'][name]))
+        metric('stage_seconds', "Wall time of each stage of the last run.",
+               [(label, stage['elapsed']) for label, stage in stages])
+        metric('stage_bytes', "Bytes processed by each stage of the last run.",
+               [(label, stage['bytes']) for label, stage in stages if stage['bytes'] is not None])
+        metric('stage_bytes_per_second', "Throughput of each stage of the last run.",
+               [(label, stage['throughput']) for label, stage in stages if stage['throughput'] is not None])
+        metric('stage_success', "Whether each stage of the last run succeeded.",
+               [(label, int(stage['success'])) for label, stage in stages])
+        metric('image_seconds', "Wall time of each image in the last run.",
+               [(labels(image=image), data['images'][image]['elapsed']) for image in data['images']])
+        metric('image_success', "Whether each image in the last run was produced.",
+               [(labels(image=image), int(bool(data['images'][image]['success']))) for image in data['images']
+                if data['images'][image]['success'] is not None])
+        metric('run_seconds', "Wall time of the last run.", [('', data['elapsed'])])
+        metric('run_timestamp_seconds', "When the last run finished.", [('', self.end or time.time())])
+        return '\n'.join(lines) + '\n'
+
+def labels(**values):
+    '''Formats Prometheus labels, such as '{image="My Image",stage="fsdiff"}'.'''
+    result = []
+    for name in sorted(values):
+        value = str(values[name]).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        result.append(name + '="' + value + '"')
+    return '{' + ','.join(result) + '}'
+
+def replace(path, contents):
+    '''Writes 'contents' to 'path' without ever leaving it half-written (the
+    textfile collector may read it at any time).
+    '''
+
+    with open(path + '.new', 'w') as f:
+        f.write(contents)
+    os.rename(path + '.new', path)
+
+def directory_size(directory):
+    '''Returns the total size in bytes of the files in 'directory'.'''
+    total = 0
+    for path, dirs, names in os.walk(directory):
+        for name in names:
+            full = os.path.join(path, name)
+            if os.path.isfile(full) and not os.path.islink(full):
+                total += os.path.getsize(full)
+    return total
+
+def downloaded_bytes(path):
+    '''Returns the total size of the entries to be downloaded ('+') in the
+    applicable transcript at 'path'. Lines that can't be parsed are skipped.
+    '''
+
+    total = 0
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = transcript.parse_line(line)
+            except ValueError:
+                continue
+            if entry and entry.action == '+':
+                total += entry.size
+    return total
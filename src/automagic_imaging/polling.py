@@ -0,0 +1,83 @@
+import random
+import sys
+import time
+
+# The first pause between checks, and the longest, in seconds. Each pause is
+# 'backoff' times as long as the one before, less up to 'jitter' of it (as a
+# fraction) at random, so that builds waiting on the same thing don't all
+# check at once.
+initial_delay = 0.05
+maximum_delay = 2.0
+backoff = 2.0
+jitter = 0.5
+# How long to wait in all by default, in seconds.
+default_deadline = 30
+
+def delays(deadline=None):
+    '''Yields how long to pause before each check after the first, until
+    'deadline' seconds (default: default_deadline) have passed since the
+    first call.
+    '''
+
+    if deadline is None:
+        deadline = default_deadline
+    end = time.time() + float(deadline)
+    delay = initial_delay
+    while True:
+        remaining = end - time.time()
+        if remaining <= 0:
+            return
+        yield min(remaining, delay * (1 - random.random() * jitter))
+        delay = min(maximum_delay, delay * backoff)
+
+def until(check, deadline=None, description=None):
+    '''Calls 'check' until it returns a true value, which is returned, pausing
+    a little longer after each call. Returns right away if it is true the
+    first time.
+
+    check       - a function that takes no arguments
+    deadline    - how long to keep checking, in seconds (default:
+                  default_deadline)
+    description - what is being waited for, for the error
+
+    Raises a RuntimeError if the deadline passes first.
+    '''
+
+    result = check()
+    if result:
+        return result
+    for delay in delays(deadline):
+        time.sleep(delay)
+        result = check()
+        if result:
+            return result
+    raise RuntimeError("Timed out after " + str(deadline if deadline is not None else default_deadline) +
+                       " seconds waiting for " + (description or "a condition") + ".")
+
+def retry(function, deadline=None, errors=Exception, retrying=None):
+    '''Calls 'function' until it returns without raising an exception, and
+    returns what it returned, pausing a little longer after each failure.
+
+    function - a function that takes no arguments
+    deadline - how long to keep trying, in seconds (default:
+               default_deadline); then the last exception is raised
+    errors   - the exception class (or tuple of classes) that is worth trying
+               again after; any other exception is raised right away
+    retrying - called with the first exception, once, if it is tried again
+    '''
+
+    pauses = delays(deadline)
+    first = True
+    while True:
+        try:
+            return function()
+        except errors:
+            error = sys.exc_info()
+            try:
+                delay = next(pauses)
+            except StopIteration:
+                raise error[0], error[1], error[2]
+            if first and retrying:
+                retrying(error[1])
+            first = False
+            time.sleep(delay)
@@ -0,0 +1,453 @@
+import atexit
+import errno
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# How long a cancelled process is given to exit after SIGTERM before it is
+# killed, in seconds.
+kill_grace = 5
+# How long the output of a process that has exited is still read, in seconds.
+# Anything it started in the background (such as diskimages-helper, started by
+# hdiutil) may hold on to its output for much longer than that.
+drain_grace = 1
+# How often running processes are checked on, in seconds, and how often once
+# their output has ended (when they should be exiting any moment).
+poll_interval = 0.05
+exit_interval = 0.001
+# How much output is read at a time.
+read_size = 65536
+# How often a command that is being watched for stalls is checked on, at
+# most, in seconds.
+stall_check = 10
+# Starts a command in a process group of its own. This is done in a separate
+# interpreter rather than with preexec_fn, which runs Python in the forked
+# child and can deadlock on a lock another thread held at the fork.
+group_wrapper = '''import os, sys
+os.setpgrp()
+try:
+    os.execvp(sys.argv[1], sys.argv[1:])
+except OSError:
+    sys.stderr.write(sys.argv[1] + ': ' + str(sys.exc_info()[1]) + '\\n')
+    sys.exit(127)
+'''
+
+class Stalled(RuntimeError):
+    '''Raised when a command is cancelled because it made no progress for too
+    long (see watch()).
+    '''
+
+class Process:
+    '''A command started by a Runner. Any number of threads can wait for it
+    or cancel it.
+
+    command    - the command, as a list
+    pid        - its process ID
+    output     - what its output is fed to, if anything (such as a
+                 progress.Output)
+    returncode - its exit status, once it has finished
+    cancelled  - True if it was cancelled
+    exited     - when it exited (its output may still be being read)
+    active     - when it last printed anything
+    group      - True if it leads a process group of its own, so that
+                 cancelling it stops everything it started as well
+    '''
+
+    def __init__(self, command, popen, output=None, capture=False, group=False):
+        self.command = command
+        self.pid = popen.pid
+        self.output = output
+        self.capture = capture
+        self.group = group
+        self.active = time.time()
+        self.returncode = None
+        self.cancelled = False
+        self.exited = None
+        self.__popen = popen
+        self.__stdout = []
+        self.__stderr = []
+        self.__error = None
+        self.__done = threading.Event()
+
+    def __repr__(self):
+        result = "Process " + str(self.pid) + ": " + ' '.join(str(x) for x in self.command)
+        if self.cancelled:
+            result += " (cancelled)"
+        elif self.returncode is not None:
+            result += " (exited with " + str(self.returncode) + ")"
+        return result
+
+    def done(self):
+        return self.__done.is_set()
+
+    def wait(self, timeout=None):
+        '''Waits for the process to finish (for at most 'timeout' seconds, if
+        given) and returns its exit status, or None if it is still running.
+        Raises whatever 'output' raised, if anything.
+        '''
+
+        # A timed wait in Python 2 sleeps in ever longer steps, which would
+        # add up to as long again to short commands. (^C from a terminal goes
+        # to the command as well, so it still ends the wait.)
+        if not self.__done.wait(timeout):
+            return None
+        if self.__error:
+            raise self.__error[0], self.__error[1], self.__error[2]
+        return self.returncode
+
+    def cancel(self):
+        '''Stops the process: asks it to exit, and kills it if it hasn't after
+        'kill_grace' seconds. Returns once it has finished.
+        '''
+
+        if self.__done.is_set():
+            return
+        self.cancelled = True
+        self.signal('terminate')
+        if self.wait(kill_grace) is None:
+            self.signal('kill')
+            self.wait()
+        elif self.group:
+            # Leave nothing it started behind.
+            self.signal('kill')
+
+    def signal(self, how):
+        '''Sends the process (and its process group, if it has one) SIGTERM
+        ('terminate') or SIGKILL ('kill'), unless it has already exited.
+        '''
+
+        number = signal.SIGTERM if how == 'terminate' else signal.SIGKILL
+        try:
+            if self.group:
+                # Whatever it started may still be running after it exits.
+                os.killpg(self.pid, number)
+            elif self.__popen.returncode is None:
+                os.kill(self.pid, number)
+        except OSError:
+            # It has exited already.
+            pass
+
+    def stdout(self):
+        '''Returns what the process printed to stdout (or stdout and stderr,
+        without 'capture').
+        '''
+
+        return ''.join(self.__stdout)
+
+    def stderr(self):
+        '''Returns what the process printed to stderr (with 'capture').'''
+        return ''.join(self.__stderr)
+
+    def received(self, kind, data):
+        '''Takes the next chunk of output ('stdout' or 'stderr'). Only called
+        by the Runner.
+        '''
+
+        self.active = time.time()
+        if self.__error:
+            return
+        if self.capture:
+            (self.__stdout if kind == 'stdout' else self.__stderr).append(data)
+        if self.output:
+            try:
+                self.output.feed(data)
+            except:
+                self.__error = sys.exc_info()
+
+    def poll(self):
+        '''Returns the exit status if the process has exited (without waiting
+        for its output to end), or None. Only called by the Runner.
+        '''
+
+        if self.exited is None and self.__popen.poll() is not None:
+            self.exited = time.time()
+        return self.__popen.returncode
+
+    def finished(self, error=None):
+        '''Records that the process has exited and its output has ended, or
+        that it can no longer be followed because of 'error' (from
+        sys.exc_info()), which is raised to anyone waiting for it. Only called
+        by the Runner.
+        '''
+
+        if error and not self.__error:
+            self.__error = error
+        self.returncode = self.__popen.returncode
+        for pipe in [self.__popen.stdout, self.__popen.stderr]:
+            if pipe:
+                pipe.close()
+        if self.output and not self.__error:
+            try:
+                self.output.close()
+            except:
+                self.__error = sys.exc_info()
+        self.__done.set()
+
+class Runner:
+    '''Runs external commands and follows the output of every one of them from
+    a single thread (with poll() or select()), so that any number can run at
+    once and be waited for from any number of threads (such as one per image
+    build), without a thread or a blocking read for each.
+
+    Output always goes through a pipe, so nothing is opened for the commands
+    that isn't closed again, and commands are started without any of this
+    process's other files open (so one image's tool can't hold another's pipe
+    open).
+    '''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # Maps each pipe being read to [Process, 'stdout' or 'stderr', file].
+        self.__pipes = {}
+        self.__processes = []
+        self.__thread = None
+        self.__stopping = False
+        # Written to whenever a process starts, so that the thread looks at it
+        # right away.
+        self.__wake = None
+
+    def __repr__(self):
+        with self.__lock:
+            return "Runner: " + str(len(self.__processes)) + " process(es) running"
+
+    def start(self, command, output=None, cwd=None, capture=False, group=False):
+        '''Starts 'command' and returns its Process without waiting for it.
+
+        command - the command to run, as a list
+        output  - an object with feed(data) and close() (such as a
+                  progress.Output) to pass its output to as it is printed
+        cwd     - the directory to run it in
+        capture - keep stdout and stderr apart and in memory (see
+                  Process.stdout()); otherwise they are combined, and only
+                  kept if there is no 'output'
+        group   - start it in a process group of its own (see Process)
+        '''
+
+        popen = subprocess.Popen([sys.executable or 'python', '-c', group_wrapper] + list(command) if group else command,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE if capture else subprocess.STDOUT,
+                                 cwd=cwd,
+                                 close_fds=True)
+        process = Process(command, popen, output, capture or not output, group)
+        with self.__lock:
+            if not self.__thread:
+                read, write = os.pipe()
+                self.__wake = write
+                self.__pipes[read] = [None, 'wake', None]
+                self.__thread = threading.Thread(target=self.__follow)
+                self.__thread.daemon = True
+                self.__thread.start()
+            for pipe, kind in [(popen.stdout, 'stdout'), (popen.stderr, 'stderr')]:
+                if pipe:
+                    self.__pipes[pipe.fileno()] = [process, kind, pipe]
+            self.__processes.append(process)
+            os.write(self.__wake, 'x')
+        return process
+
+    def run(self, command, output=None, cwd=None, capture=False, stall=None, probe=None):
+        '''Runs 'command' (see start()) and returns its Process once it has
+        finished. If waiting is interrupted, the command is cancelled.
+
+        With 'stall' (in seconds), the command is watched for stalls (see
+        watch()), in a process group of its own.
+        '''
+
+        process = self.start(command, output, cwd, capture, group=bool(stall))
+        try:
+            if stall:
+                watch(process, stall, probe)
+            else:
+                process.wait()
+        except:
+            process.cancel()
+            raise
+        return process
+
+    def stop(self):
+        '''Stops following output (such as when this process is exiting).'''
+        with self.__lock:
+            if not self.__thread:
+                return
+            self.__stopping = True
+        os.write(self.__wake, 'x')
+        self.__thread.join(1)
+
+    def cancel_all(self):
+        '''Cancels every process that is running.'''
+        with self.__lock:
+            processes = list(self.__processes)
+        for process in processes:
+            process.cancel()
+
+    def __follow(self):
+        try:
+            timeout = None
+            while True:
+                with self.__lock:
+                    if self.__stopping:
+                        return
+                    pipes = list(self.__pipes)
+                for fd in readable(pipes, timeout):
+                    with self.__lock:
+                        entry = self.__pipes.get(fd)
+                    if not entry:
+                        # Its process was finished in the meantime.
+                        continue
+                    process, kind, pipe = entry
+                    try:
+                        data = read(fd)
+                    except OSError:
+                        if kind == 'wake':
+                            raise
+                        # Treat a pipe that can't be read as ended.
+                        data = ''
+                    if kind == 'wake':
+                        continue
+                    if data:
+                        process.received(kind, data)
+                    else:
+                        with self.__lock:
+                            self.__pipes.pop(fd, None)
+                timeout = self.__reap()
+        except:
+            self.__abandon(sys.exc_info())
+
+    def __abandon(self, error):
+        # Gives up on every process after the thread following them failed
+        # with 'error', so that nothing waits for them forever. The next
+        # command starts a new thread.
+        with self.__lock:
+            processes = list(self.__processes)
+            wakes = [x for x in self.__pipes if self.__pipes[x][1] == 'wake'] + [self.__wake]
+            self.__processes = []
+            self.__pipes = {}
+            self.__thread = None
+            self.__wake = None
+        for fd in wakes:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        for process in processes:
+            process.signal('kill')
+            process.poll()
+            process.finished(error)
+
+    def __reap(self):
+        # Finishes the processes that have exited and whose output has ended
+        # (or that exited long enough ago). Returns how long to wait before
+        # checking again.
+        waits = []
+        with self.__lock:
+            processes = list(self.__processes)
+            reading = {}
+            for fd in self.__pipes:
+                if self.__pipes[fd][0]:
+                    reading.setdefault(self.__pipes[fd][0], []).append(fd)
+        for process in processes:
+            if process.poll() is None:
+                waits.append(poll_interval if process in reading else exit_interval)
+                continue
+            if process in reading:
+                if time.time() - process.exited < drain_grace:
+                    waits.append(poll_interval)
+                    continue
+                with self.__lock:
+                    for fd in reading[process]:
+                        self.__pipes.pop(fd, None)
+            with self.__lock:
+                self.__processes.remove(process)
+            process.finished()
+        return min(waits) if waits else None
+
+def watch(process, stall, probe=None):
+    '''Waits for 'process' to finish. If it goes 'stall' seconds without
+    printing anything, and without 'probe' (a function that returns something
+    that changes as the command makes progress, such as the space used on the
+    volume it writes to) returning anything new, it is cancelled along with
+    everything it started, and Stalled is raised.
+    '''
+
+    last = probe() if probe else None
+    progressed = time.time()
+    while process.wait(min(stall, stall_check)) is None:
+        now = time.time()
+        if probe:
+            value = probe()
+            if value != last:
+                last = value
+                progressed = now
+        if now - max(progressed, process.active) >= stall:
+            process.cancel()
+            raise Stalled(os.path.basename(str(process.command[0])) + " made no progress for " +
+                          str(stall) + " seconds and was stopped.")
+    return process.returncode
+
+def readable(fds, timeout=None):
+    '''Waits until any of the file descriptors 'fds' can be read from (or for
+    'timeout' seconds) and returns those that can. poll() is used where there
+    is one, since select() can't watch descriptors above FD_SETSIZE.
+    '''
+
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            for fd in fds:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+            return [fd for fd, event in poller.poll(None if timeout is None else timeout * 1000)]
+        return select.select(fds, [], [], timeout)[0]
+    except (select.error, OSError):
+        if sys.exc_info()[1].args[0] == errno.EINTR:
+            return []
+        raise
+
+def read(fd):
+    '''Reads whatever is available from the file descriptor 'fd' ('' at the
+    end).
+    '''
+
+    while True:
+        try:
+            # os.read returns as soon as anything is available, unlike the
+            # file object's buffered reads.
+            return os.read(fd, read_size)
+        except OSError:
+            if sys.exc_info()[1].errno != errno.EINTR:
+                raise
+
+# Runs every command started through call() and check_output().
+runner = Runner()
+atexit.register(runner.stop)
+
+def call(command, output=None, cwd=None, stall=None, probe=None):
+    '''Runs 'command' (a list) and returns its exit status. Its output (both
+    stdout and stderr) is passed to 'output' (see Runner.start()) as it is
+    printed, or discarded. With 'stall', it is stopped (raising Stalled) if it
+    makes no progress for that many seconds (see watch()).
+    '''
+
+    return runner.run(command, output or Discard(), cwd, stall=stall, probe=probe).returncode
+
+def check_output(command, cwd=None):
+    '''Runs 'command' (a list) and returns what it printed to stdout. Raises a
+    subprocess.CalledProcessError (with what it printed) if it fails.
+    '''
+
+    process = runner.run(command, cwd=cwd, capture=True)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command,
+                                            process.stdout() + process.stderr())
+    return process.stdout()
+
+class Discard:
+    '''Throws away the output of a command.'''
+
+    def feed(self, data):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,151 @@
+import collections
+import re
+import time
+
+import processes
+
+# The progress lines printed by the radmind tools with '-%', such as
+# '%42 ./Library/Preferences'.
+progress_line = re.compile(r'^%\s*(\d+(?:\.\d+)?)%?(?:\s+(.*))?$')
+
+# How many lines of output are kept for failure reports.
+output_lines = 20
+
+class Update:
+    '''A progress report from a running tool.
+
+    name    - the tool (or stage) being reported on
+    percent - how much of the work is done (0 to 100)
+    elapsed - seconds since the tool started
+    eta     - estimated seconds remaining, or None if it can't be estimated yet
+    path    - the path the tool last reported working on
+    '''
+
+    def __init__(self, name, percent, elapsed, eta=None, path=None):
+        self.name = name
+        self.percent = percent
+        self.elapsed = elapsed
+        self.eta = eta
+        self.path = path
+
+    def __repr__(self):
+        result = "Update: " + self.name + " " + str(int(self.percent)) + "%"
+        if self.eta is not None:
+            result += " (" + duration(self.eta) + " remaining)"
+        return result
+
+class Output:
+    '''Follows the output of a running tool. The last 'lines' lines of output
+    are kept in memory for failure reports, and progress lines (from '-%') are
+    turned into Updates and passed to 'callback' each time the percentage
+    passes a multiple of 'step'.
+
+    Feed it the output as it arrives:
+
+    output = Output('fsdiff', callback=log_update)
+    run(fsdiff_command, output)
+    for line in output.tail():
+        ...
+
+    Progress lines are not kept with the rest of the output, so that they
+    don't push out the lines that explain a failure.
+    '''
+
+    def __init__(self, name, callback=None, lines=None, step=10):
+        self.name = name
+        self.callback = callback
+        self.step = step
+        self.lines = collections.deque(maxlen=lines or output_lines)
+        self.count = 0
+        self.percent = None
+        self.path = None
+        self.start = time.time()
+        self.__partial = ''
+        self.__reported = None
+
+    def __repr__(self):
+        result = "Output: " + self.name + " (" + str(self.count) + " lines"
+        if self.percent is not None:
+            result += ", " + str(int(self.percent)) + "%"
+        return result + ")"
+
+    def feed(self, data):
+        '''Takes the next chunk of output, which may end partway through a
+        line. Lines may end with either a newline or a carriage return.
+        '''
+
+        pieces = re.split('[\r\n]', self.__partial + data)
+        self.__partial = pieces.pop()
+        for piece in pieces:
+            self.line(piece)
+
+    def close(self):
+        '''Handles whatever is left after the tool has exited.'''
+        if self.__partial:
+            self.line(self.__partial)
+            self.__partial = ''
+
+    def line(self, line):
+        '''Takes a single line of output.'''
+        line = line.rstrip()
+        if not line:
+            return
+        self.count += 1
+        match = progress_line.match(line)
+        if not match:
+            self.lines.append(line)
+            return
+        self.percent = min(float(match.group(1)), 100.0)
+        self.path = match.group(2)
+        if self.callback:
+            mark = int(self.percent // self.step)
+            if mark != self.__reported:
+                self.__reported = mark
+                self.callback(self.update())
+
+    def update(self):
+        '''Returns an Update with the latest progress (which is 0% if there
+        hasn't been any).
+        '''
+
+        percent = self.percent or 0
+        elapsed = time.time() - self.start
+        eta = None
+        if percent > 0:
+            eta = elapsed * (100 - percent) / percent
+        return Update(self.name, percent, elapsed, eta, self.path)
+
+    def tail(self, count=None):
+        '''Returns the last 'count' lines of output (or all that were kept).'''
+        lines = list(self.lines)
+        if count is not None:
+            lines = lines[-count:]
+        return lines
+
+def run(command, output=None, cwd=None, stall=None, probe=None):
+    '''Runs 'command' and passes its output (both stdout and stderr) to
+    'output' as it is printed. Returns the exit status.
+
+    command - the command to run, as a list
+    output  - an Output to follow it (optional; otherwise it is discarded)
+    cwd     - the directory to run it in
+    stall   - stop it (raising processes.Stalled) if it goes this many
+              seconds without printing anything or 'probe' changing (see
+              processes.watch())
+    '''
+
+    return processes.call(command, output, cwd, stall, probe)
+
+def duration(seconds):
+    '''Formats a number of seconds as something like '1h 02m', '4m 05s', or
+    '12s'.
+    '''
+
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return str(hours) + "h " + "%02d" % minutes + "m"
+    if minutes:
+        return str(minutes) + "m " + "%02d" % seconds + "s"
+    return str(seconds) + "s"
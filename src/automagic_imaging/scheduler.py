@@ -0,0 +1,312 @@
+import collections
+import contextlib
+import sys
+import threading
+import time
+
+# The resource each stage of an image build mostly depends on. ktcheck and
+# lapply talk to the radmind server, the conversion and scan are bound by the
+# processor, and everything else is bound by the local disks.
+stage_resources = {
+    'create':           'disk',
+    'mount':            'disk',
+    'enable_ownership': 'disk',
+    'clean':            'disk',
+    'verify':           'disk',
+    'ktcheck':          'network',
+    'fsdiff':           'disk',
+    'lapply':           'network',
+    'post-maintenance': 'disk',
+    'rename':           'disk',
+    'bless':            'disk',
+    'unmount':          'disk',
+    'compact':          'disk',
+    'convert':          'cpu',
+    'scan':             'cpu',
+    'checksum':         'cpu',
+    'archive':          'disk'
+}
+resource_classes = ['network', 'disk', 'cpu']
+
+class Result:
+    '''Records the outcome of a single scheduled job.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.success = False
+        self.error = None
+        self.start = None
+        self.end = None
+
+    def __repr__(self):
+        result = "Result: " + self.name
+        if self.success:
+            result += " (succeeded"
+        else:
+            result += " (failed"
+        if self.start and self.end:
+            result += " in " + str(int(self.elapsed())) + "s"
+        result += ")"
+        if self.error:
+            result += "\n        Error: " + self.error
+        return result
+
+    def elapsed(self):
+        if self.start and self.end:
+            return self.end - self.start
+        return 0
+
+    def run(self, function, *args, **kwargs):
+        '''Runs 'function(*args, **kwargs)' and records its outcome here.'''
+        self.start = time.time()
+        try:
+            self.success = bool(function(*args, **kwargs))
+        except:
+            self.success = False
+            self.error = str(sys.exc_info()[1])
+        self.end = time.time()
+
+class Scheduler:
+    '''Runs independent jobs concurrently on a fixed number of worker threads.
+
+    Each job is a callable; it is considered successful if it returns a true
+    value. A job that raises or returns a false value is recorded as a failure
+    and does not prevent any of the other jobs from running, except for jobs
+    that were made to depend on it with require().
+    '''
+
+    def __init__(self, workers=1):
+        try:
+            workers = int(workers)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid number of workers: '" + str(workers) + "'")
+        if workers < 1:
+            raise ValueError("Must have at least one worker.")
+        self.workers = workers
+        self.jobs = collections.OrderedDict()
+        self.dependencies = {}
+
+    def submit(self, name, function, *args, **kwargs):
+        '''Queues 'function(*args, **kwargs)' to be run under 'name'.
+
+        name     - a unique name for the job (usually the image name)
+        function - the callable to run
+        '''
+
+        if name in self.jobs:
+            raise ValueError("A job named '" + str(name) + "' was already submitted.")
+        self.jobs[name] = (function, args, kwargs)
+
+    def require(self, name, dependency):
+        '''Makes the job 'name' wait until the job 'dependency' has succeeded.
+        If the dependency fails, the job fails without being run.
+        '''
+
+        for job in [name, dependency]:
+            if job not in self.jobs:
+                raise ValueError("No job named '" + str(job) + "' was submitted.")
+        self.dependencies.setdefault(name, []).append(dependency)
+        # Make sure this didn't create a cycle, which would never finish.
+        seen = set()
+        waiting = [dependency]
+        while waiting:
+            job = waiting.pop()
+            if job == name:
+                self.dependencies[name].remove(dependency)
+                raise ValueError("'" + str(name) + "' and '" + str(dependency) + "' would depend on each other.")
+            if job not in seen:
+                seen.add(job)
+                waiting.extend(self.dependencies.get(job, []))
+
+    def run(self):
+        '''Runs all submitted jobs and waits for them to finish. Returns an
+        ordered dictionary of job names to their Results, in submission order.
+        '''
+
+        results = collections.OrderedDict()
+        for name in self.jobs:
+            results[name] = Result(name)
+        queue = Queue(self.jobs.keys(), self.dependencies, results)
+
+        threads = []
+        for i in range(min(self.workers, len(self.jobs))):
+            thread = threading.Thread(target=self.__work, args=(queue, results))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # Join with a timeout so that KeyboardInterrupt still gets through.
+            while thread.is_alive():
+                thread.join(1)
+
+        return results
+
+    def __work(self, queue, results):
+        while True:
+            name = queue.get()
+            if name is None:
+                return
+            function, args, kwargs = self.jobs[name]
+            results[name].run(function, *args, **kwargs)
+            queue.done(name)
+
+class Queue:
+    '''Hands out the jobs of a Scheduler in order, holding back any job until
+    the jobs it depends on have finished.
+    '''
+
+    def __init__(self, names, dependencies, results):
+        self.pending = list(names)
+        self.running = set()
+        self.dependencies = dependencies
+        self.results = results
+        self.__condition = threading.Condition()
+
+    def get(self):
+        '''Returns the name of the next job that is ready to run, waiting if
+        necessary. Returns None once there is nothing left to run.
+        '''
+
+        with self.__condition:
+            while self.pending:
+                for name in self.pending:
+                    waiting = False
+                    failed = None
+                    for dependency in self.dependencies.get(name, []):
+                        if dependency in self.pending or dependency in self.running:
+                            waiting = True
+                        elif not self.results[dependency].success:
+                            failed = dependency
+                    if failed:
+                        # It can never run, so it fails right away.
+                        self.pending.remove(name)
+                        self.results[name].error = "'" + str(failed) + "' did not complete successfully."
+                        self.__condition.notify_all()
+                        break
+                    if not waiting:
+                        self.pending.remove(name)
+                        self.running.add(name)
+                        return name
+                else:
+                    # Everything left is waiting on a running job.
+                    self.__condition.wait(1)
+            return None
+
+    def done(self, name):
+        with self.__condition:
+            self.running.discard(name)
+            self.__condition.notify_all()
+
+class Pipeline:
+    '''Runs jobs in the background as they are submitted, such as the
+    conversion and scan that finish off an image while the next image is
+    being built.
+
+    At most 'depth' jobs may be waiting or running at once; submit() blocks
+    until there is room for another one.
+    '''
+
+    def __init__(self, depth=1):
+        try:
+            depth = int(depth)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid pipeline depth: '" + str(depth) + "'")
+        if depth < 1:
+            raise ValueError("The pipeline depth must be at least 1.")
+        self.depth = depth
+        self.results = collections.OrderedDict()
+        self.__room = threading.BoundedSemaphore(depth)
+        self.__lock = threading.Lock()
+        self.__threads = []
+
+    def submit(self, name, function, *args, **kwargs):
+        '''Starts 'function(*args, **kwargs)' in the background under 'name',
+        waiting first if the pipeline is full.
+        '''
+
+        result = Result(name)
+        with self.__lock:
+            if name in self.results:
+                raise ValueError("A job named '" + str(name) + "' was already submitted.")
+            self.results[name] = result
+        self.__room.acquire()
+        thread = threading.Thread(target=self.__work, args=(result, function, args, kwargs))
+        thread.daemon = True
+        with self.__lock:
+            self.__threads.append(thread)
+        thread.start()
+
+    def join(self):
+        '''Waits for every submitted job to finish. Returns an ordered
+        dictionary of job names to their Results, in submission order.
+        '''
+
+        with self.__lock:
+            threads = list(self.__threads)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        return self.results
+
+    def __work(self, result, function, args, kwargs):
+        try:
+            result.run(function, *args, **kwargs)
+        finally:
+            self.__room.release()
+
+class ResourceLimiter:
+    '''Limits how many stages of each resource class may run at the same time
+    across all of the images being built.
+
+    Use this in a 'with' statement around each stage:
+
+    limiter = ResourceLimiter({'network': 4, 'cpu': 1})
+    with limiter.stage('convert'):
+        # At most one conversion runs at a time.
+        ...
+
+    Resource classes without a limit (or with a limit of None) are unlimited.
+    '''
+
+    def __init__(self, limits=None):
+        self.limits = {}
+        self.__semaphores = {}
+        if not limits:
+            limits = {}
+        for resource in limits:
+            if resource not in resource_classes:
+                raise ValueError("Invalid resource class: '" + str(resource) + "'")
+            if limits[resource] is None:
+                continue
+            try:
+                limit = int(limits[resource])
+            except (TypeError, ValueError):
+                raise ValueError("Invalid limit for '" + resource + "': '" + str(limits[resource]) + "'")
+            if limit < 1:
+                raise ValueError("The limit for '" + resource + "' must be at least 1.")
+            self.limits[resource] = limit
+            self.__semaphores[resource] = threading.BoundedSemaphore(limit)
+
+    def __repr__(self):
+        result = "ResourceLimiter:"
+        for resource in resource_classes:
+            result += "\n       " + resource + ": " + str(self.limits.get(resource, 'unlimited'))
+        return result
+
+    @contextlib.contextmanager
+    def slot(self, resource):
+        '''Holds one slot of 'resource' for the duration of the 'with' block.'''
+        semaphore = self.__semaphores.get(resource)
+        if semaphore is None:
+            yield
+            return
+        semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def stage(self, name):
+        '''Holds a slot of whichever resource class the stage 'name' uses.'''
+        return self.slot(stage_resources[name])
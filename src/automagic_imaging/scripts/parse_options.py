@@ -19,8 +19,17 @@ def usage(options):
 
     print '''\
 usage: {} [-hvni] [-l log] [-c config] [-t tmp_dir] [-o out_dir]
-          [-r rserver] [-C cert] [-I image] [-V volume]
-          [--persist-on-fail]
+          [-r rserver] [-C cert] [-I image] [-V volume] [-w workers]
+          [--persist-on-fail] [--pipeline] [--pipeline-depth depth]
+          [--cache-dir cache] [--cache-size size] [--warm-start]
+          [--skip-unchanged] [--metrics-dir metrics] [--backend backend]
+          [--format format] [--archive-dir archive] [--restore image]
+          [--decompress image] [--sparsebundle] [--no-compact] [--rebuild-base]
+          [--daemon] [--socket socket]
+          [--urgent-workers workers] [--submit [image]] [--priority priority]
+          [--status [job]] [--cancel job] [--resume]
+          [--ready-timeout seconds] [--stall-timeout seconds]
+          [--stall-retries retries]
 
 Create bootable disk images from Radmind.
 
@@ -35,6 +44,65 @@ Create bootable disk images from Radmind.
                         (this implies '--persist-on-fail')
     --persist-on-fail : prevent the program from deleting failed image files;
                         (this is not recommended unless you are sure of space)
+    --pipeline        : convert and scan finished images in the background
+                        while the next image is built (Config mode)
+    --pipeline-depth  : allow at most 'depth' images to wait for conversion
+                        and scanning at once (default: 1)
+    --cache-dir       : keep files downloaded from radmind in 'cache' and reuse
+                        them for later images and runs
+    --cache-size      : limit the cache to 'size' (e.g. '50g'); the least
+                        recently used files are removed first
+    --warm-start      : start each image from its last successful sparse image
+                        instead of an empty one, so that radmind only applies
+                        the differences
+    --skip-unchanged  : don't rebuild an image if radmind has nothing new for it
+                        since its last successful build; the last image is
+                        reused under today's name instead
+    --metrics-dir     : write the time taken and bytes processed by each stage
+                        of each image to 'metrics' as JSON and for the
+                        Prometheus textfile collector
+    --backend         : make images with 'backend': 'mac' (the default) uses
+                        the OS X disk image tools, and 'directory' uses plain
+                        directories (for testing on other systems)
+    --format          : convert finished images to 'format': an hdiutil format
+                        (default: 'UDZO-9'), or 'zlib', 'bzip2', or 'lzma' with
+                        an optional level (such as 'zlib-6') to compress them
+                        in chunks on every core, or 'auto' to choose one of
+                        those for each image
+    --archive-dir     : also store finished images in the deduplicated archive
+                        'archive', and keep only the newest image of each
+                        kind in out_dir
+    --restore         : rebuild the archived image 'image' in out_dir (with
+                        '--archive-dir') and quit
+    --decompress      : decompress the chunked image 'image' (a .dmg.chunked
+                        file) to a .dmg in out_dir (or beside it) and quit
+    --sparsebundle    : build images in sparse bundles instead of sparse images
+    --no-compact      : don't compact images to give back freed space before
+                        converting them
+    --rebuild-base    : build the base of a layered image given with '-I' (or
+                        submitted) again even if it has been built before
+    --daemon          : keep running and build images from the config file as
+                        they are submitted (Config mode)
+    --socket          : listen on (or, to submit, connect to) the Unix socket
+                        'socket' (default:
+                        /var/run/{}.sock)
+    --urgent-workers  : let up to 'workers' urgent jobs run at once besides the
+                        others (default: 1)
+    --submit          : ask the daemon to build 'image', or every image
+    --priority        : give submitted jobs 'priority' (default: 0); higher
+                        priorities run first, and jobs of 1 or more are urgent
+    --status          : list the daemon's jobs, or only 'job'
+    --cancel          : cancel the queued job 'job'
+    --resume          : carry on with each image's last failed build from the
+                        last stage it completed, instead of starting over (this
+                        implies '--persist-on-fail')
+    --ready-timeout   : wait up to 'seconds' for a volume to be ready to bless,
+                        or to unmount after a failure (default: 30)
+    --stall-timeout   : stop ktcheck or lapply if it goes 'seconds' without
+                        printing anything or writing to the volume (default:
+                        1800; 0 to never stop it)
+    --stall-retries   : try a stalled ktcheck or lapply up to 'retries' more
+                        times before the image fails (default: 2)
 
     l log     : use 'log' as the logging output location
     c config  : use 'config' as the configuration file
@@ -49,8 +117,10 @@ Create bootable disk images from Radmind.
                 (for Manual or Interactive modes)
     s sparse  : use 'sparse' as the initial sparse image to start from; this
                 prevents the program from creating a new sparse image and
-                starting from scratch\
-'''.format(options['name'])
+                starting from scratch
+    w workers : build up to 'workers' images at the same time (Config mode);
+                this overrides the 'workers' setting in the config file\
+'''.format(options['name'], options['name'])
     sys.exit(0)
 
 def parse(options):
@@ -64,6 +134,32 @@ def parse(options):
     parser.add_argument('-i', '--interactive', action='store_true')
     parser.add_argument('--persist-all', action='store_true')
     parser.add_argument('--persist-on-fail', action='store_true')
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--pipeline-depth', type=int)
+    parser.add_argument('--cache-dir')
+    parser.add_argument('--cache-size')
+    parser.add_argument('--warm-start', action='store_true')
+    parser.add_argument('--skip-unchanged', action='store_true')
+    parser.add_argument('--metrics-dir')
+    parser.add_argument('--backend')
+    parser.add_argument('--format')
+    parser.add_argument('--archive-dir')
+    parser.add_argument('--restore')
+    parser.add_argument('--decompress')
+    parser.add_argument('--sparsebundle', action='store_true')
+    parser.add_argument('--no-compact', action='store_true')
+    parser.add_argument('--rebuild-base', action='store_true')
+    parser.add_argument('--daemon', action='store_true')
+    parser.add_argument('--socket')
+    parser.add_argument('--urgent-workers', type=int)
+    parser.add_argument('--submit', nargs='?', const='')
+    parser.add_argument('--priority', type=int, default=0)
+    parser.add_argument('--status', nargs='?', type=int, const=0)
+    parser.add_argument('--cancel', type=int)
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--ready-timeout', type=float)
+    parser.add_argument('--stall-timeout', type=float)
+    parser.add_argument('--stall-retries', type=int)
     parser.add_argument('-l', '--log')
     parser.add_argument('-c', '--config')
     parser.add_argument('-t', '--tmp_dir')
@@ -73,6 +169,7 @@ def parse(options):
     parser.add_argument('-I', '--image-name')
     parser.add_argument('-V', '--volume-name')
     parser.add_argument('-s', '--sparse')
+    parser.add_argument('-w', '--workers', type=int)
     args = parser.parse_args()
 
     if args.help:
@@ -85,7 +182,7 @@ def parse(options):
     options['config']       = args.config
     options['interactive']  = args.interactive
     options['persist']      = args.persist_all
-    options['persist-fail'] = args.persist_on_fail or args.persist_all
+    options['persist-fail'] = args.persist_on_fail or args.persist_all or args.resume
     options['tmp_dir']      = args.tmp_dir
     options['out_dir']      = args.out_dir
     options['rserver']      = args.rserver
@@ -93,3 +190,30 @@ def parse(options):
     options['image']        = args.image_name
     options['volname']      = args.volume_name
     options['sparse']       = args.sparse
+    options['workers']      = args.workers
+    options['pipeline']     = args.pipeline
+    options['pipeline_depth'] = args.pipeline_depth
+    options['cache_dir']    = args.cache_dir
+    options['cache_size']   = args.cache_size
+    options['warm_start']   = args.warm_start
+    options['skip_unchanged'] = args.skip_unchanged
+    options['metrics_dir']  = args.metrics_dir
+    options['backend_name'] = args.backend
+    options['format']       = args.format
+    options['archive_dir']  = args.archive_dir
+    options['restore']      = args.restore
+    options['decompress']   = args.decompress
+    options['sparsebundle'] = args.sparsebundle
+    options['compact']      = not args.no_compact
+    options['rebuild_base'] = args.rebuild_base
+    options['daemon']       = args.daemon
+    options['socket']       = args.socket
+    options['urgent_workers'] = args.urgent_workers
+    options['submit']       = args.submit
+    options['priority']     = args.priority
+    options['status']       = args.status
+    options['cancel']       = args.cancel
+    options['resume']       = args.resume
+    options['ready_timeout'] = args.ready_timeout
+    options['stall_timeout'] = args.stall_timeout
+    options['stall_retries'] = args.stall_retries
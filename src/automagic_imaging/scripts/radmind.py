@@ -2,7 +2,9 @@ import datetime
 import os
 import re
 import shutil
-import subprocess
+import stat
+
+from automagic_imaging import processes, progress
 
 # Defaults
 defaults = {}
@@ -11,21 +13,35 @@ defaults['comm'] = defaults['path'] + 'client/command.K'
 defaults['port'] = '6223' # For certs
 defaults['auth'] = '2'    # For certs
 defaults['fsdo'] = '/tmp/fsdiff_out.T'
+# The radmind tools
+defaults['ktcheck'] = '/usr/local/bin/ktcheck'
+defaults['fsdiff']  = '/usr/local/bin/fsdiff'
+defaults['lapply']  = '/usr/local/bin/lapply'
+# How long ktcheck or lapply may go without printing anything or writing to the
+# volume before it is considered stalled (such as on a dead connection to the
+# server) and stopped, in seconds (0: never), and how many more times a
+# stalled stage is tried.
+defaults['stall']   = 30 * 60
+defaults['stall_retries'] = 2
+
+# The line of a command file or transcript that names the volume.
+hard_disk_name = re.compile(r'^(# HARD_DISK_NAME =).*$')
 
 def full(cert, rserver, path=defaults['path'], port=defaults['port'],
          auth=defaults['auth'], command=defaults['comm'],
-         fsdiff_out=defaults['fsdo']):
-    run_ktcheck(cert, rserver, path, port, auth, command)
-    run_fsdiff(command, fsdiff_out)
-    run_lapply(cert, rserver, fsdiff_out, path, port, auth, command)
-    run_post_maintenance()
+         fsdiff_out=defaults['fsdo'], root='.'):
+    run_ktcheck(cert, rserver, path, port, auth, command, root=root)
+    run_fsdiff(command, fsdiff_out, root=root)
+    run_lapply(cert, rserver, path, port, auth, command, fsdiff_out, root=root)
+    run_post_maintenance(root=root)
 
 def run_ktcheck(cert, rserver, path=defaults['path'], port=defaults['port'],
-            auth=defaults['auth'], command=defaults['comm'], logfile=None):
-    if not os.path.exists(command):
-        touch(command)
+            auth=defaults['auth'], command=defaults['comm'], output=None,
+            root='.', stall=None):
+    if not os.path.exists(os.path.join(root, command)):
+        touch(os.path.join(root, command))
     ktcheck = [
-        '/usr/local/bin/ktcheck',
+        defaults['ktcheck'],
         '-c', 'sha1',
         '-C',
         '-D', path,
@@ -39,28 +55,20 @@ def run_ktcheck(cert, rserver, path=defaults['path'], port=defaults['port'],
         '-y', cert,
         '-z', cert
     ]
-    STDOUT = None
-    if logfile:
-        if not os.path.isfile(logfile):
-            touch(logfile)
-        STDOUT = open(logfile, 'w')
-    if not logfile:
-        STDOUT = open(os.devnull, 'w')
-    result = subprocess.call(ktcheck,
-                             stderr=subprocess.STDOUT,
-                             stdout=STDOUT)
+    result = run_watched(ktcheck, output, root, stall)
     if result > 1:
         raise RuntimeError("ktcheck did not complete successfully!")
 
-def run_fsdiff(command=defaults['comm'], outfile=None, logfile=None):
+def run_fsdiff(command=defaults['comm'], outfile=None, output=None, root='.'):
     if not outfile:
         outfile = './private/var/log/radmind/fsdiff_output.T'
+    outfile = os.path.join(root, outfile)
     if not os.path.isdir(os.path.dirname(outfile)):
         os.makedirs(os.path.dirname(outfile))
     if os.path.exists(outfile):
         os.remove(outfile)
     fsdiff = [
-        '/usr/local/bin/fsdiff',
+        defaults['fsdiff'],
         '-A',
         '-c', 'sha1',
         '-K', command,
@@ -69,32 +77,25 @@ def run_fsdiff(command=defaults['comm'], outfile=None, logfile=None):
         '-o', outfile,
         '.'
     ]
-    STDOUT = None
-    if logfile:
-        if not os.path.isfile(logfile):
-            touch(logfile)
-        STDOUT = open(logfile, 'w')
-    if not logfile:
-        STDOUT = open(os.devnull, 'w')
-    result = subprocess.call(fsdiff,
-                             stderr=subprocess.STDOUT,
-                             stdout=STDOUT)
+    result = progress.run(fsdiff, output, cwd=root)
     if result != 0:
         raise RuntimeError("fsdiff did not complete successfully!")
 
 def run_lapply(cert, rserver, path=defaults['path'], port=defaults['port'],
                auth=defaults['auth'], command=defaults['comm'], infile=None,
-               logfile=None):
+               output=None, root='.', stall=None):
     if not infile:
         infile = './private/var/log/radmind/lapply_input.T'
+    infile = os.path.join(root, infile)
     if not os.path.isfile(infile):
         raise ValueError("Invalid input file: " + str(infile))
     lapply = [
-        '/usr/local/bin/lapply',
+        defaults['lapply'],
         '-c', 'sha1',
         '-C',
         '-ex_lapply',
         '-F',
+        '-%',
         '-i',
         '-I',
         '-h', rserver,
@@ -104,28 +105,36 @@ def run_lapply(cert, rserver, path=defaults['path'], port=defaults['port'],
         '-z', cert,
         infile
     ]
-    STDOUT = None
-    if logfile:
-        if not os.path.isfile(logfile):
-            touch(logfile)
-        STDOUT = open(logfile, 'w')
-    if not logfile:
-        STDOUT = open(os.devnull, 'w')
-    result = subprocess.call(lapply,
-                             stderr=subprocess.STDOUT,
-                             stdout=STDOUT)
+    result = run_watched(lapply, output, root, stall)
     if result != 0:
         raise RuntimeError("lapply did not complete successfully!")
 
-def run_post_maintenance(volname=None):
+def run_watched(command, output=None, root='.', stall=None):
+    '''Runs a radmind tool that talks to the server in 'root', stopping it
+    (and raising processes.Stalled) if it goes 'stall' seconds (default:
+    defaults['stall']) without printing anything or changing how much space
+    is used on the volume (as it does while it downloads a large file).
+    Returns the exit status.
+    '''
+
+    if stall is None:
+        stall = defaults['stall']
+    return progress.run(command, output, cwd=root, stall=stall, probe=lambda: space_used(root))
+
+def space_used(root):
+    '''Returns the bytes used on the volume that holds 'root'.'''
+    values = os.statvfs(root)
+    return (values.f_blocks - values.f_bfree) * values.f_frsize
+
+def run_post_maintenance(volname=None, root='.'):
     # We use a system called Xhooks to manage our post-maintenance routines.
     # If you don't have Xhooks... you don't need post-maintenance.
-    if not os.path.exists('./Library/Xhooks'):
+    if not os.path.exists(os.path.join(root, 'Library/Xhooks')):
         return
 
     # Common directories used:
-    triggerfiles = './Library/Xhooks/Preferences/triggerfiles/'
-    radmind_log = './private/var/log/radmind/'
+    triggerfiles = os.path.join(root, 'Library/Xhooks/Preferences/triggerfiles/')
+    radmind_log = os.path.join(root, 'private/var/log/radmind/')
     # Remove these files in case radmind had an error and didn't delete them:
     remove_these = [
         triggerfiles + 'run_maintenance',
@@ -144,7 +153,7 @@ def run_post_maintenance(volname=None):
         triggerfiles + 'radmind_finished',
         triggerfiles + 'radmind_xhooks_conf_finished',
         radmind_log + 'maintenance_lastrun',
-        './System/Library/Extensions'
+        os.path.join(root, 'System/Library/Extensions')
     ]
     for file in touch_these:
         try:
@@ -163,47 +172,89 @@ def run_post_maintenance(volname=None):
         # Put the date (formatted a particular way) in this file.
         # (This method of acquiring the date is used because datetime lacks
         # the timezone information.)
-        date = subprocess.check_output(['date', '+%H:%M:%S %D %Z'])
+        date = processes.check_output(['date', '+%H:%M:%S %D %Z'])
         with open(radmind_log + 'maintenance_lastrun', 'w') as f:
             f.write(date)
 
     # Set the volume name through HARD_DISK_NAME:
-    if volname and os.path.isdir('./private/var/radmind/client'):
-        grep = subprocess.check_output(['egrep', '-lr', '^# HARD_DISK_NAME', './private/var/radmind/client']).split('\n')
-        # Remove any blank entries (the split('\n') tends to leave one at the end).
-        files = [x for x in grep if x != '']
-        # Preserve the originals, if this has been run multiple times.
-        files = [x for x in files if not x.endswith('.imager-replaced')]
-        for file in files:
-            # Copy the file, then rewrite the line with HARD_DISK_NAME to use the
-            # new value.
-            shutil.copy2(file, file + '.imager-replaced')
-            with open(file, 'r') as source:
-                lines = source.readlines()
-            with open(file, 'w') as source:
-                for i in range(len(lines)):
-                    source.write(
-                        re.sub(
-                            r'^(# HARD_DISK_NAME =).*$',
-                            r'\1 {volume}'.format(volume=volname),
-                            lines[i]
-                        )
-                    )
-
+    client = os.path.join(root, 'private/var/radmind/client')
+    if volname and os.path.isdir(client):
+        set_hard_disk_name(client, volname)
 
     # Run some scripts:
-    result = subprocess.call(['./Library/Xhooks/Modules/xhooks/bin/radmind_xhooks_conf.pl'],
-                             stderr=subprocess.STDOUT,
-                             stdout=open(os.devnull, 'w'))
+    result = processes.call(['./Library/Xhooks/Modules/xhooks/bin/radmind_xhooks_conf.pl'],
+                            cwd=root)
     if result != 0:
         raise RuntimeError("./Library/Xhooks/Modules/xhooks/bin/radmind_xhooks_conf.pl was unsuccesful.")
-    result = subprocess.call(['./usr/bin/update_dyld_shared_cache',
-                              '-root', '.', '-force', '-universal_boot'],
-                             stderr=subprocess.STDOUT,
-                             stdout=open(os.devnull, 'w'))
+    result = processes.call(['./usr/bin/update_dyld_shared_cache',
+                             '-root', '.', '-force', '-universal_boot'],
+                            cwd=root)
     if result != 0:
         raise RuntimeError("./usr/bin/update_dyld_shared_cache was unsuccesful.")
 
+def set_hard_disk_name(client, volname):
+    '''Rewrites the HARD_DISK_NAME line of every file in 'client' that has one
+    to use 'volname', and returns the paths of the files that were changed.
+
+    The original of each file is kept as FILE.imager-replaced (the first time
+    it is changed), and each file is replaced all at once.
+    '''
+
+    changed = []
+    for path, dirs, names in os.walk(client):
+        for name in names:
+            file = os.path.join(path, name)
+            # Preserve the originals, if this has been run multiple times.
+            if file.endswith('.imager-replaced') or not os.path.isfile(file) or os.path.islink(file):
+                continue
+            if replace_hard_disk_name(file, volname):
+                changed.append(file)
+    return changed
+
+def replace_hard_disk_name(file, volname):
+    '''Rewrites the HARD_DISK_NAME line of 'file' to use 'volname'. Returns
+    whether anything needed to change. The file as it was is kept beside it,
+    with '.imager-replaced' added to its name.
+    '''
+
+    def rewrite(line):
+        match = hard_disk_name.match(line)
+        if not match:
+            return line
+        return match.group(1) + ' ' + volname + line[len(line.rstrip('\r\n')):]
+
+    with open(file, 'r') as source:
+        # Most files don't have the line at all, so look before writing.
+        for line in source:
+            if rewrite(line) != line:
+                break
+        else:
+            return False
+        source.seek(0)
+        new = file + '.imager-new'
+        with open(new, 'w') as destination:
+            for line in source:
+                destination.write(rewrite(line))
+    # Keep the owner and permissions, but not the modification time, so that
+    # the change shows up like any other.
+    info = os.stat(file)
+    # Ownership first, since chown clears the setuid/setgid bits.
+    os.chown(new, info.st_uid, info.st_gid)
+    os.chmod(new, stat.S_IMODE(info.st_mode))
+    # The file still has the line as radmind sent it, so it is the current
+    # original; replace any backup of an earlier one (ktcheck downloads the
+    # file again whenever it changes on the server).
+    backup = file + '.imager-replaced'
+    if os.path.lexists(backup):
+        os.remove(backup)
+    # The original becomes the backup without being copied.
+    try:
+        os.link(file, backup)
+    except OSError:
+        shutil.copy2(file, backup)
+    os.rename(new, file)
+    return True
+
 def touch(path):
     if not os.path.exists(os.path.dirname(path)):
         os.makedirs(os.path.dirname(path))
@@ -0,0 +1,235 @@
+import math
+import os
+import threading
+import time
+
+import images
+import transcript
+
+# The size of an allocation block on the image's volume; every file takes up
+# a whole number of them.
+block_size = 4096
+# The space each entry (file, directory, or link) takes in the volume's
+# catalog, beyond its contents.
+entry_overhead = 1024
+# How much room is left in a sparse image beyond the estimate, as a fraction
+# of it, for files that aren't in the transcripts (such as logs and caches).
+headroom = 0.25
+# The smallest sparse image that is created, whatever the estimate.
+minimum_size = 1024 ** 3
+# How large a converted image is expected to be, as a fraction of the volume,
+# when there is no earlier build of it to go by.
+compression_ratio = 0.6
+# How often a build that is waiting for space checks again, and how long it
+# waits in all before giving up, in seconds.
+poll_interval = 60
+defer_limit = 4 * 3600
+
+class Estimate:
+    '''How much space a volume built from a set of transcripts will take.
+
+    files   - the number of files in the transcripts
+    entries - the number of entries of every kind
+    bytes   - the total size of the files
+    blocks  - the space the files take up on the volume (whole blocks)
+    '''
+
+    def __init__(self, files=0, entries=0, bytes=0, blocks=0):
+        self.files = files
+        self.entries = entries
+        self.bytes = bytes
+        self.blocks = blocks
+
+    def __repr__(self):
+        return ("Estimate: " + str(self.files) + " files (" + str(self.bytes) + " bytes), " +
+                str(self.entries) + " entries, " + str(self.volume_size()) + " bytes on the volume")
+
+    def volume_size(self):
+        '''Returns the space the finished volume is expected to use.'''
+        return self.blocks + self.entries * entry_overhead
+
+    def sparse_size(self):
+        '''Returns the size to create the sparse image with, in a form hdiutil
+        understands (such as '4500m'): the estimate plus headroom, and at least
+        'minimum_size'.
+        '''
+
+        size = max(self.volume_size() * (1 + headroom), minimum_size)
+        return str(int(math.ceil(size / float(1024 ** 2)))) + 'm'
+
+    def output_size(self, ratio=None):
+        '''Returns the size the converted image is expected to be: the volume
+        compressed to 'ratio' of its size (default: compression_ratio).
+        '''
+
+        return int(self.volume_size() * (compression_ratio if ratio is None else ratio))
+
+def command_transcripts(client, command='command.K'):
+    '''Returns the paths of the transcripts listed (directly, or through the
+    command files it includes) in the command file 'command' in the radmind
+    client directory 'client', from lowest to highest precedence.
+    '''
+
+    result = []
+    seen = set()
+
+    def read(name):
+        path = os.path.join(client, name)
+        if path in seen or not os.path.isfile(path):
+            return
+        seen.add(path)
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2 or fields[0].startswith('#'):
+                    continue
+                if fields[0] in ['p', 'n']:
+                    result.append(os.path.join(client, transcript.decode(fields[1])))
+                elif fields[0] == 'k':
+                    read(transcript.decode(fields[1]))
+
+    read(command)
+    return result
+
+def estimate(client, command='command.K'):
+    '''Returns an Estimate of the volume that the transcripts of the command
+    file 'command' (in the radmind client directory 'client', as downloaded by
+    ktcheck) describe.
+
+    Where a path is in more than one transcript, the one with the highest
+    precedence counts. Only a hash of each path is kept in memory, so large
+    transcripts can be estimated.
+    '''
+
+    # Maps the hash of each path to its size in whole blocks (or None if it
+    # isn't a file) and its actual size.
+    sizes = {}
+    for path in command_transcripts(client, command):
+        if not os.path.isfile(path):
+            raise ValueError("Missing transcript: '" + path + "'")
+        for entry in transcript.parse(path):
+            if entry.action == '-':
+                sizes.pop(hash(entry.path), None)
+                continue
+            blocks = None
+            if entry.is_file():
+                blocks = (entry.size + block_size - 1) // block_size * block_size
+            sizes[hash(entry.path)] = (blocks, entry.size)
+    result = Estimate(entries=len(sizes))
+    for blocks, size in sizes.itervalues():
+        if blocks is not None:
+            result.files += 1
+            result.bytes += size
+            result.blocks += blocks
+    return result
+
+def free_space(path):
+    '''Returns the number of bytes available to this user on the volume that
+    holds 'path'.
+    '''
+
+    values = os.statvfs(path)
+    return values.f_bavail * values.f_frsize
+
+class Reservations:
+    '''Keeps track of the space that builds in progress expect to need, so
+    that builds running at the same time don't all count on the same free
+    space.
+
+    Reserving space for a build that doesn't fit waits while other builds
+    hold reservations on the same volume (they may finish and give it back),
+    and fails if no others do, or after 'defer_limit' seconds.
+
+    What a build has already written is no longer free, so once the files it
+    writes are known (see using()), only the part of its reservation that it
+    hasn't used yet is counted against the free space.
+    '''
+
+    def __init__(self):
+        # Maps each build to the bytes it holds on each volume (by device).
+        self.__held = {}
+        # Maps each build to the files it writes, as [path, device, the space
+        # it took up when it was recorded].
+        self.__using = {}
+        self.__condition = threading.Condition()
+
+    def __repr__(self):
+        with self.__condition:
+            return "Reservations: " + ', '.join(sorted(self.__held)) if self.__held else "Reservations: none"
+
+    def reserve(self, name, needs, waiting=None):
+        '''Reserves space for the build 'name'. 'needs' maps directories to the
+        bytes the build will write in each (directories on the same volume
+        are added together). 'waiting' is called with a description of what is
+        lacking if the build has to wait.
+
+        Raises a RuntimeError if the space can't be had.
+        '''
+
+        volumes = {}
+        paths = {}
+        for path in needs:
+            device = os.stat(path).st_dev
+            volumes[device] = volumes.get(device, 0) + max(0, int(needs[path]))
+            paths.setdefault(device, path)
+        deadline = time.time() + defer_limit
+        told = False
+        with self.__condition:
+            self.__held.pop(name, None)
+            self.__using.pop(name, None)
+            while True:
+                lacking = []
+                for device in volumes:
+                    available = free_space(paths[device]) - self.__reserved(device)
+                    if volumes[device] > available:
+                        lacking.append((device, volumes[device], available))
+                if not lacking:
+                    self.__held[name] = volumes
+                    return
+                message = '; '.join("'" + paths[device] + "' needs " + str(needed) + " bytes but has " +
+                                    str(max(0, available)) + " available" for device, needed, available in lacking)
+                if not [x for x in lacking if self.__reserved(x[0])] or time.time() >= deadline:
+                    raise RuntimeError("Not enough space: " + message + ".")
+                if waiting and not told:
+                    waiting(message)
+                    told = True
+                # Builds that finish give their space back; space may also be
+                # freed some other way, so check again every so often.
+                self.__condition.wait(min(poll_interval, max(0, deadline - time.time())))
+
+    def using(self, name, path):
+        '''Records that the build 'name' writes the image 'path' (which may
+        already exist, such as a sparse image to warm start from). Whatever it
+        grows by from now on is taken out of the build's reservation on its
+        volume, since it is no longer free space either.
+        '''
+
+        device = os.stat(os.path.dirname(os.path.abspath(path))).st_dev
+        with self.__condition:
+            if name in self.__held:
+                self.__using.setdefault(name, []).append([path, device, images.allocated(path)])
+
+    def release(self, name):
+        '''Gives back the space reserved for the build 'name' (if any).'''
+        with self.__condition:
+            self.__using.pop(name, None)
+            if self.__held.pop(name, None) is not None:
+                self.__condition.notify_all()
+
+    def held(self, name):
+        '''Returns the bytes reserved for the build 'name' on each volume.'''
+        with self.__condition:
+            return dict(self.__held.get(name, {}))
+
+    def __reserved(self, device):
+        # The space other builds hold on the volume and haven't written yet
+        # (the condition must be held).
+        total = 0
+        for name in self.__held:
+            written = sum(max(0, images.allocated(path) - before)
+                          for path, volume, before in self.__using.get(name, []) if volume == device)
+            total += max(0, self.__held[name].get(device, 0) - written)
+        return total
+
+# Shared by every build in this process.
+reserved = Reservations()
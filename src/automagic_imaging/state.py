@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+
+# The name of the file kept in the temporary directory.
+filename = '.automagic_imaging_state.json'
+
+# Shared State objects, one per directory.
+states = {}
+states_lock = threading.Lock()
+
+def in_directory(directory):
+    '''Returns the State kept in 'directory'. Every caller asking for the same
+    directory gets the same object, so concurrent builds share it safely.
+    '''
+
+    path = os.path.join(os.path.abspath(directory), filename)
+    with states_lock:
+        if path not in states:
+            states[path] = State(path)
+        return states[path]
+
+class State:
+    '''Remembers information about each image (config section) from one run to
+    the next, such as the last sparse image that was built successfully. The
+    information is kept in a JSON file.
+    '''
+
+    def __init__(self, path):
+        self.path = os.path.abspath(str(path))
+        self.__lock = threading.Lock()
+        self.__sections = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.__sections = json.load(f)
+            except (IOError, ValueError):
+                # A damaged state file just means starting over.
+                self.__sections = {}
+
+    def __repr__(self):
+        result = "State: " + self.path
+        with self.__lock:
+            for section in sorted(self.__sections):
+                result += "\n       " + section + ":"
+                for key in sorted(self.__sections[section]):
+                    result += "\n           " + key + ": " + str(self.__sections[section][key])
+        return result
+
+    def get(self, section):
+        '''Returns a copy of what is known about 'section' (or an empty
+        dictionary).
+        '''
+
+        with self.__lock:
+            return dict(self.__sections.get(section, {}))
+
+    def update(self, section, **values):
+        '''Records 'values' for 'section' and saves the state file.'''
+        with self.__lock:
+            self.__sections.setdefault(section, {}).update(values)
+            self.__save()
+
+    def forget(self, section):
+        '''Removes everything known about 'section' and saves the state file.'''
+        with self.__lock:
+            if section in self.__sections:
+                del self.__sections[section]
+                self.__save()
+
+    def __save(self):
+        # Write to a temporary file first so that the state file is never left
+        # half-written.
+        with open(self.path + '.new', 'w') as f:
+            json.dump(self.__sections, f, indent=4, sort_keys=True)
+        os.rename(self.path + '.new', self.path)
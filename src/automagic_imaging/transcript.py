@@ -0,0 +1,316 @@
+import collections
+
+# The fields that follow the path for each type of transcript entry:
+#   f - file, a - applefile: mode uid gid mtime size checksum
+#   d - directory:           mode uid gid [finder info]
+#   l - symlink, h - hardlink: target
+#   p - pipe, s - socket, D - door: mode uid gid
+#   b - block, c - character device: mode uid gid major minor
+file_types = ['f', 'a']
+directory_types = ['d']
+link_types = ['l', 'h']
+special_types = ['p', 's', 'D']
+device_types = ['b', 'c']
+types = file_types + directory_types + link_types + special_types + device_types
+
+# Radmind escapes these characters in paths so that fields can be split on
+# whitespace.
+escapes = {'b': ' ', 't': '\t', 'n': '\n', 'r': '\r', '\\': '\\'}
+unescapes = dict((value, '\\' + key) for key, value in escapes.items())
+
+class Entry(object):
+    '''A single line of a radmind transcript.
+
+    action     - '+' (to be downloaded), '-' (to be removed), or '' (neither;
+                 the usual case outside of applicable transcripts)
+    type       - the one-letter type of the entry (see 'types')
+    path       - the path as written in the transcript (still escaped; see
+                 name() for the real path)
+    mode       - the permissions as an integer, or None
+    uid, gid   - the owner and group, or None
+    mtime      - the modification time (files only), or None
+    size       - the size in bytes (files only), or 0
+    checksum   - the checksum (files only), or None
+    extra      - the link target, device numbers or Finder info, or None
+    transcript - the transcript the entry came from, if known
+
+    Entries use __slots__ (so this is a new-style class) to keep them small
+    when large numbers of them are kept in memory.
+    '''
+
+    __slots__ = ('action', 'type', 'path', 'mode', 'uid', 'gid', 'mtime',
+                 'size', 'checksum', 'extra', 'transcript')
+
+    def __init__(self, action, type, path, mode=None, uid=None, gid=None,
+                 mtime=None, size=0, checksum=None, extra=None, transcript=None):
+        self.action = action
+        self.type = type
+        self.path = path
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.mtime = mtime
+        self.size = size
+        self.checksum = checksum
+        self.extra = extra
+        self.transcript = transcript
+
+    def __repr__(self):
+        return "Entry: " + self.line()
+
+    def name(self):
+        '''Returns the real (unescaped) path of the entry.'''
+        return decode(self.path)
+
+    def is_file(self):
+        return self.type in file_types
+
+    def line(self):
+        '''Returns the entry as a transcript line (without a newline).'''
+        fields = []
+        if self.action:
+            fields.append(self.action)
+        fields.append(self.type)
+        fields.append(self.path)
+        if self.type in link_types:
+            fields.append(self.extra)
+            return ' '.join(fields)
+        fields.append('%04o' % self.mode)
+        fields.append(str(self.uid))
+        fields.append(str(self.gid))
+        if self.type in file_types:
+            fields.append(str(self.mtime))
+            fields.append(str(self.size))
+            fields.append(self.checksum)
+        elif self.extra:
+            fields.extend(self.extra.split(' '))
+        return ' '.join(fields)
+
+class Summary:
+    '''Counts the entries of a transcript by type and action, and totals the
+    size of its files.
+    '''
+
+    def __init__(self):
+        self.entries = 0
+        self.bytes = 0
+        self.types = collections.defaultdict(int)
+        self.actions = collections.defaultdict(int)
+        self.added_bytes = 0
+
+    def __repr__(self):
+        result = "Summary: " + str(self.entries) + " entries, " + str(self.bytes) + " bytes"
+        for type in sorted(self.types):
+            result += "\n       " + type + ": " + str(self.types[type])
+        for action in sorted(self.actions):
+            result += "\n       '" + action + "': " + str(self.actions[action])
+        return result
+
+    def add(self, entry):
+        self.entries += 1
+        self.bytes += entry.size
+        self.types[entry.type] += 1
+        self.actions[entry.action] += 1
+        if entry.action == '+':
+            self.added_bytes += entry.size
+
+class Changes:
+    '''The differences between two versions of a transcript: how many entries
+    were added, removed, or changed, how many file bytes that represents, and
+    a few example paths of each.
+    '''
+
+    kinds = ['added', 'removed', 'changed']
+
+    def __init__(self, examples=5):
+        self.count = dict((kind, 0) for kind in self.kinds)
+        self.bytes = dict((kind, 0) for kind in self.kinds)
+        self.examples = dict((kind, []) for kind in self.kinds)
+        self.__limit = examples
+
+    def __repr__(self):
+        result = "Changes:"
+        for kind in self.kinds:
+            result += "\n       " + kind + ": " + str(self.count[kind]) + " (" + str(self.bytes[kind]) + " bytes)"
+        return result
+
+    def total(self):
+        return sum(self.count.values())
+
+    def add(self, kind, path, size=0):
+        self.count[kind] += 1
+        self.bytes[kind] += size
+        if len(self.examples[kind]) < self.__limit:
+            self.examples[kind].append(decode(path))
+
+def decode(path):
+    '''Undoes radmind's escaping of special characters in a transcript path.'''
+    if '\\' not in path:
+        return path
+    result = []
+    i = 0
+    while i < len(path):
+        if path[i] == '\\' and i + 1 < len(path) and path[i + 1] in escapes:
+            result.append(escapes[path[i + 1]])
+            i += 2
+        else:
+            result.append(path[i])
+            i += 1
+    return ''.join(result)
+
+def encode(path):
+    '''Escapes special characters in a path the way radmind does.'''
+    for character in ['\\', ' ', '\t', '\n', '\r']:
+        if character in path:
+            path = path.replace(character, unescapes[character])
+    return path
+
+def parse_line(line, transcript=None):
+    '''Parses a single transcript line. Returns an Entry, or None for blank
+    lines, comments, and the 'name.T:' headers of applicable transcripts.
+    Raises a ValueError if the line is not valid.
+    '''
+
+    return from_fields(line.split(), line, transcript)
+
+def from_fields(fields, line, transcript=None):
+    '''Builds an Entry from the whitespace-separated 'fields' of 'line' (see
+    parse_line()).
+    '''
+
+    if not fields or fields[0].startswith('#'):
+        return None
+    if len(fields) == 1 and fields[0].endswith(':'):
+        return None
+    action = ''
+    if fields[0] == '+' or fields[0] == '-':
+        action = fields[0]
+        fields = fields[1:]
+    if len(fields) < 2 or fields[0] not in types:
+        raise ValueError("Invalid transcript line: '" + line.rstrip('\n') + "'")
+    type = fields[0]
+    try:
+        if type in file_types:
+            if len(fields) != 8:
+                raise ValueError
+            return Entry(action, type, fields[1], int(fields[2], 8), int(fields[3]),
+                         int(fields[4]), int(fields[5]), int(fields[6]), fields[7],
+                         transcript=transcript)
+        if type in link_types:
+            if len(fields) != 3:
+                raise ValueError
+            return Entry(action, type, fields[1], extra=fields[2], transcript=transcript)
+        if len(fields) < 5:
+            raise ValueError
+        extra = None
+        if len(fields) > 5:
+            extra = ' '.join(fields[5:])
+        return Entry(action, type, fields[1], int(fields[2], 8), int(fields[3]),
+                     int(fields[4]), extra=extra, transcript=transcript)
+    except ValueError:
+        raise ValueError("Invalid transcript line: '" + line.rstrip('\n') + "'")
+
+def parse(source):
+    '''Reads a transcript one line at a time and yields an Entry for each line
+    that describes a filesystem object. Only one line is held in memory at a
+    time, so transcripts of any size can be processed.
+
+    source - the path of the transcript, or an open file
+
+    In applicable transcripts (such as the output of 'fsdiff -A'), each entry
+    records the transcript it came from.
+    '''
+
+    if isinstance(source, basestring):
+        with open(source, 'r') as f:
+            for entry in parse(f):
+                yield entry
+        return
+
+    transcript = None
+    number = 0
+    for line in source:
+        number += 1
+        fields = line.split()
+        if len(fields) == 1 and fields[0].endswith(':'):
+            transcript = fields[0][:-1]
+            continue
+        try:
+            entry = from_fields(fields, line, transcript)
+        except ValueError:
+            raise ValueError("Invalid transcript line " + str(number) + ": '" + line.rstrip('\n') + "'")
+        if entry:
+            yield entry
+
+def select(entries, types=None, actions=None, prefix=None):
+    '''Yields only the entries of the given 'types' (e.g. ['f', 'a']) and
+    'actions' (e.g. ['+']) whose escaped path starts with 'prefix'. Criteria
+    that are not given match every entry.
+    '''
+
+    for entry in entries:
+        if types is not None and entry.type not in types:
+            continue
+        if actions is not None and entry.action not in actions:
+            continue
+        if prefix is not None and not entry.path.startswith(prefix):
+            continue
+        yield entry
+
+def diff(old, new, examples=5):
+    '''Compares two transcripts (paths or open files) and returns the Changes
+    from 'old' to 'new'.
+
+    Only a hash of each path and line of 'old' is kept in memory (rather than
+    the entries themselves), so large transcripts can be compared.
+    '''
+
+    # Maps the hash of each old path to the hash of its whole line and size.
+    previous = {}
+    for entry in parse(old):
+        previous[hash(entry.path)] = (hash(entry.line()), entry.size)
+
+    changes = Changes(examples)
+    for entry in parse(new):
+        key = hash(entry.path)
+        if key not in previous:
+            changes.add('added', entry.path, entry.size)
+            continue
+        line, size = previous.pop(key)
+        if line != hash(entry.line()):
+            changes.add('changed', entry.path, entry.size)
+
+    # Whatever is left over is no longer in the transcript.
+    for line, size in previous.values():
+        changes.count['removed'] += 1
+        changes.bytes['removed'] += size
+    if previous and isinstance(old, basestring):
+        # Only the hashes of the removed paths were kept, so look through the
+        # old transcript again for a few examples.
+        for entry in parse(old):
+            if len(changes.examples['removed']) >= examples:
+                break
+            if hash(entry.path) in previous:
+                changes.examples['removed'].append(entry.name())
+    return changes
+
+def summarize(entries):
+    '''Returns a Summary of all of the given entries.'''
+    summary = Summary()
+    for entry in entries:
+        summary.add(entry)
+    return summary
+
+def write(entries, destination):
+    '''Writes entries to 'destination' (a path or an open file) as a
+    transcript. Returns the number of entries written.
+    '''
+
+    if isinstance(destination, basestring):
+        with open(destination, 'w') as f:
+            return write(entries, f)
+    count = 0
+    for entry in entries:
+        destination.write(entry.line() + '\n')
+        count += 1
+    return count
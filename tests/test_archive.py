@@ -0,0 +1,74 @@
+'''Tests for automagic_imaging.archive.
+
+Run from the top of the checkout with:
+
+    python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+# Prefer the copy of automagic_imaging in this checkout over an installed one.
+sys.path.insert(0, os.path.join(here, '..', 'src'))
+from automagic_imaging import archive
+
+class RebuildIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'archive')
+        # Two images that share their first part.
+        shared = os.urandom(archive.max_chunk)
+        self.first = self.write('first.dmg', shared + 'first' * 1000)
+        self.second = self.write('second.dmg', shared + 'second' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def reload(self):
+        os.remove(os.path.join(self.path, 'index.json'))
+        return archive.Archive(self.path)
+
+    def test_rebuilds_a_lost_index(self):
+        store = archive.Archive(self.path)
+        store.add(self.first)
+        store.add(self.second)
+        stats = store.stats()
+        reloaded = self.reload()
+        self.assertEqual(reloaded.names(), ['first.dmg', 'second.dmg'])
+        self.assertEqual(reloaded.broken, [])
+        self.assertEqual(vars(reloaded.stats()), vars(stats))
+
+    def test_leaves_out_an_image_with_a_missing_chunk(self):
+        store = archive.Archive(self.path)
+        store.add(self.first)
+        store.add(self.second)
+        # The last chunk of the second image is its own.
+        key = store.recipe('second.dmg')['chunks'][-1]
+        self.assertNotIn(key, store.recipe('first.dmg')['chunks'])
+        os.remove(os.path.join(self.path, 'chunks', key[:2], key))
+
+        reloaded = self.reload()
+        self.assertEqual(reloaded.broken, ['second.dmg'])
+        self.assertEqual(reloaded.names(), ['first.dmg'])
+        # The chunks only the first image uses are all that is counted.
+        self.assertEqual(reloaded.stats().chunks, len(set(store.recipe('first.dmg')['chunks'])))
+        restored = os.path.join(self.directory, 'restored.dmg')
+        reloaded.restore('first.dmg', restored)
+        with open(restored, 'rb') as f, open(self.first, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        # The index was saved without it.
+        self.assertEqual(archive.Archive(self.path).names(), ['first.dmg'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+'''Tests for automagic_imaging.cache.
+
+Run from the top of the checkout with:
+
+    python -m unittest discover tests
+'''
+
+import base64
+import hashlib
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+# Prefer the copy of automagic_imaging in this checkout over an installed one.
+sys.path.insert(0, os.path.join(here, '..', 'src'))
+from automagic_imaging import cache
+
+contents = 'cached contents\n'
+
+class PlaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.Cache(os.path.join(self.directory, 'cache'))
+        self.root = os.path.join(self.directory, 'root')
+        os.makedirs(os.path.join(self.root, 'etc'))
+        source = os.path.join(self.directory, 'source')
+        self.write(source, contents)
+        self.key = hashlib.sha1(contents).hexdigest()
+        self.cache.store(self.key, source)
+        # A file outside of the root, which a link in the image points to.
+        self.outside = os.path.join(self.directory, 'outside')
+        self.write(self.outside, 'not to be touched\n')
+        os.chmod(self.outside, 0600)
+        self.path = os.path.join(self.root, 'etc', 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def read(self, path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    def entry(self):
+        line = ('+ f ./etc/file 0640 ' + str(os.getuid()) + ' ' + str(os.getgid()) +
+                ' 1401234567 ' + str(len(contents)) + ' ' +
+                base64.b64encode(hashlib.sha1(contents).digest()) + '\n')
+        return cache.download_entry(line)
+
+    def assertOutsideUntouched(self):
+        self.assertEqual(self.read(self.outside), 'not to be touched\n')
+        self.assertEqual(stat.S_IMODE(os.stat(self.outside).st_mode), 0600)
+
+    def test_places_a_missing_file(self):
+        self.assertTrue(self.cache.place(self.entry(), self.root))
+        self.assertEqual(self.read(self.path), contents)
+        info = os.lstat(self.path)
+        self.assertEqual(stat.S_IMODE(info.st_mode), 0640)
+        self.assertEqual(info.st_mtime, 1401234567)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['file'])
+
+    def test_replaces_a_regular_file(self):
+        self.write(self.path, 'old\n')
+        self.assertTrue(self.cache.place(self.entry(), self.root))
+        self.assertEqual(self.read(self.path), contents)
+
+    def test_leaves_a_link_alone(self):
+        os.symlink(self.outside, self.path)
+        self.assertFalse(self.cache.place(self.entry(), self.root))
+        self.assertTrue(os.path.islink(self.path))
+        self.assertOutsideUntouched()
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['file'])
+
+    def test_fetch_leaves_a_link_alone(self):
+        os.symlink(self.outside, self.path)
+        self.assertFalse(self.cache.fetch(self.key, self.path))
+        self.assertTrue(os.path.islink(self.path))
+        self.assertOutsideUntouched()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+'''Tests for automagic_imaging.scripts.radmind.
+
+Run from the top of the checkout with:
+
+    python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+# Prefer the copy of automagic_imaging in this checkout over an installed one.
+sys.path.insert(0, os.path.join(here, '..', 'src'))
+from automagic_imaging.scripts import radmind
+
+class ReplaceHardDiskNameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'rc.conf')
+        self.backup = self.path + '.imager-replaced'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, contents):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+
+    def read(self, path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    def test_rewrites_the_line_and_backs_up_the_original(self):
+        original = 'A=1\n# HARD_DISK_NAME = Server\n'
+        self.write(original)
+        self.assertTrue(radmind.replace_hard_disk_name(self.path, 'Lab'))
+        self.assertEqual(self.read(self.path), 'A=1\n# HARD_DISK_NAME = Lab\n')
+        self.assertEqual(self.read(self.backup), original)
+
+    def test_leaves_a_rewritten_file_alone(self):
+        self.write('# HARD_DISK_NAME = Lab\n')
+        self.assertFalse(radmind.replace_hard_disk_name(self.path, 'Lab'))
+        self.assertFalse(os.path.exists(self.backup))
+
+    def test_backup_follows_the_latest_original(self):
+        # As when ktcheck downloads the file again after it changed on the
+        # server.
+        self.write('A=1\n# HARD_DISK_NAME = Server\n')
+        radmind.replace_hard_disk_name(self.path, 'Lab')
+        second = 'A=2\n# HARD_DISK_NAME = Server\n'
+        self.write(second)
+        self.assertTrue(radmind.replace_hard_disk_name(self.path, 'Lab'))
+        self.assertEqual(self.read(self.path), 'A=2\n# HARD_DISK_NAME = Lab\n')
+        self.assertEqual(self.read(self.backup), second)
+
+if __name__ == '__main__':
+    unittest.main()
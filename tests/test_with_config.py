@@ -0,0 +1,89 @@
+'''Tests for with_config() in the imaging script.
+
+Run from the top of the checkout with:
+
+    python -m unittest discover tests
+'''
+
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+# Prefer the copy of automagic_imaging in this checkout over an installed one.
+sys.path.insert(0, os.path.join(here, '..', 'src'))
+import automagic_imaging
+
+class QuietLogger:
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+    error = info
+
+class LayeredImageTest(unittest.TestCase):
+    '''Selecting only a variant with '-I' builds its base only when it is
+    missing, or with '--rebuild-base'.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tmp_dir = os.path.join(self.directory, 'tmp')
+        os.makedirs(self.tmp_dir)
+        config = os.path.join(self.directory, 'config.ini')
+        with open(config, 'w') as f:
+            f.write('[Global]\n')
+            f.write('tmp_dir: ' + self.tmp_dir + '\n')
+            f.write('out_dir: ' + os.path.join(self.directory, 'out') + '\n')
+            f.write('rserver: radmind.example.com\n')
+            for name in ['Base', 'Lab']:
+                cert = os.path.join(self.directory, name + '.pem')
+                open(cert, 'w').close()
+                f.write('\n[' + name + ']\n')
+                f.write('cert: ' + cert + '\n')
+                f.write('volume: ' + name + '\n')
+            f.write('base: Base\n')
+
+        self.script = imp.load_source('radmind_auto_image_creator',
+                                      os.path.join(here, '..', 'scripts', 'radmind_auto_image_creator.py'))
+        self.script.set_globals()
+        self.script.logger = QuietLogger()
+        self.script.options['config'] = config
+        self.script.options['image'] = 'Lab'
+        self.built = []
+        self.script.produce_image = self.produce_image
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def produce_image(self, image, **overrides):
+        self.built.append(image)
+        return True
+
+    def build_base(self):
+        path = automagic_imaging.images.image_path(self.tmp_dir, 'Base')
+        open(path, 'w').close()
+
+    def test_builds_a_missing_base(self):
+        self.script.with_config()
+        self.assertEqual(self.built, ['Base', 'Lab'])
+
+    def test_uses_a_base_that_was_built_before(self):
+        self.build_base()
+        self.script.with_config()
+        self.assertEqual(self.built, ['Lab'])
+        self.assertEqual(self.script.options['results'], {'Lab': True})
+
+    def test_rebuilds_the_base_when_asked(self):
+        self.build_base()
+        self.script.options['rebuild_base'] = True
+        self.script.with_config()
+        self.assertEqual(self.built, ['Base', 'Lab'])
+
+if __name__ == '__main__':
+    unittest.main()